@@ -1,6 +1,6 @@
 import logging
 
-from flask import Flask, g, request
+from flask import Flask, current_app, g, request
 from flask_apispec.extension import FlaskApiSpec
 from flask_babel import Babel
 from flask_httpauth import HTTPBasicAuth
@@ -8,9 +8,12 @@ from flask_mail import Mail, Message
 from flask_marshmallow import Marshmallow
 from flask_migrate import Migrate
 from flask_restful import Api, Resource, abort, reqparse
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import MetaData
 
+from api.cache import CredentialCache, TagCache, TagIndex, TokenVersionCache
+from api.engine import SQLAlchemy
+from api.mailer import MailDispatcher
+from api.thumbnails import Thumbnailer
 from config import Config
 
 # Это из документации:
@@ -18,40 +21,109 @@ from config import Config
 convention = {
     "ix": 'ix_%(column_0_label)s',
     "uq": "uq_%(table_name)s_%(column_0_name)s",
-    "ck": "ck_%(table_name)s_%(constraint_name)s",
+    "ck": "ck_%(table_name)s_%(column_0_name)s",
     "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
     "pk": "pk_%(table_name)s"
 }
 
 metadata = MetaData(naming_convention=convention)
 
-app = Flask(__name__, static_folder=Config.UPLOAD_FOLDER)
-app.config.from_object(Config)
-
-api = Api(app)
-db = SQLAlchemy(app, metadata=metadata)
+api = Api()
+db = SQLAlchemy(metadata=metadata)
 
 # Про render_as_batch тут: https://alembic.sqlalchemy.org/en/latest/batch.html
 # Суть кратко: База данных SQLite представляет собой проблему для инструментов миграции,
 # поскольку она почти не поддерживает оператор ALTER
 # Команда ALTER TABLE используется для добавления, удаления или модификации колонки в уже существующей таблице
-migrate = Migrate(app, db, render_as_batch=True)
-ma = Marshmallow(app)
+migrate = Migrate(db=db, render_as_batch=True)
+ma = Marshmallow()
 auth = HTTPBasicAuth()
-mail = Mail(app)
-babel = Babel(app)
+mail = Mail()
+mail_dispatcher = MailDispatcher(mail, workers=Config.MAIL_WORKERS, queue_size=Config.MAIL_QUEUE_SIZE,
+                                 batch_size=Config.MAIL_BATCH_SIZE, retries=Config.MAIL_RETRIES,
+                                 backoff=Config.MAIL_RETRY_BACKOFF, idle_timeout=Config.MAIL_IDLE_TIMEOUT)
+babel = Babel()
 
-docs = FlaskApiSpec(app)
+credential_cache = CredentialCache(maxsize=Config.AUTH_CACHE_SIZE, ttl=Config.AUTH_CACHE_TTL)
+token_versions = TokenVersionCache(refresh_interval=Config.TOKEN_VERSIONS_REFRESH, token_ttl=Config.TOKEN_EXPIRATION)
+tag_index = TagIndex(refresh_interval=Config.TAG_INDEX_REFRESH)
+tag_cache = TagCache(maxsize=Config.TAG_CACHE_SIZE, ttl=Config.TAG_CACHE_TTL)
+thumbnailer = Thumbnailer()
 logging.basicConfig(filename='record.log',
                     level=logging.INFO,
                     format=f'%(asctime)s %(levelname)s %(name)s : %(message)s')
-app.logger.setLevel(logging.INFO)
 logging.getLogger('werkzeug').setLevel(logging.INFO)
 
 
+def create_app(config=Config):
+    """
+    Приложение с настройками config: расширения, ресурсы, хуки запросов, документация и команды CLI.
+    Подключение к базе не открывается, поэтому приложение можно создать в мастере gunicorn до fork.
+    Первое созданное приложение - приложение по умолчанию для кода вне контекста (тесты, скрипты),
+    как раньше с SQLAlchemy(app).
+    Загрузки, миниатюры, импорт и экспорт берут настройки из app.config. Кэши (credential_cache,
+    token_versions, tag_index, tag_cache) и mail_dispatcher - общие объекты модуля, их размеры, ttl
+    и число потоков заданы глобальным Config при импорте api
+    """
+    # ресурсы регистрируются в api при импорте модулей
+    from api import counters, metrics, replica, seed, views
+    from api.resources.auth import AuthCacheResource, TokenResource  # noqa: F401 - без документации
+    from api.resources.file import (UploadCompleteResource, UploadPictureResource,
+                                    UploadSessionResource, UploadSessionsResource)
+    from api.resources.note import (NoteFilterTagsResource, NoteResource,
+                                    NoteRestoreResource, NotesBulkTagsResource,
+                                    NotesExportResource, NotesImportResource,
+                                    NotesListResource, NoteTagsResource,
+                                    NoteTexResource)
+    from api.resources.tag import TagsListResource, TagsResource
+    from api.resources.user import (UserAddPhotoResource, UserFindLikeResource,
+                                    UserFindOrResource, UserResource,
+                                    UsersListResource)
+
+    app = Flask(__name__, static_folder=config.UPLOAD_FOLDER)
+    app.config.from_object(config)
+    api.init_app(app)
+    db.init_app(app)
+    if db.app is None:
+        db.app = app
+    migrate.init_app(app)
+    ma.init_app(app)
+    mail.init_app(app)
+    babel.init_app(app)
+    thumbnailer.init_app(app)
+    metrics.init_app(app)
+    replica.init_app(app)
+    views.init_app(app)
+    app.cli.add_command(seed.seed_command)
+    app.cli.add_command(counters.repair_counters_command)
+
+    docs = FlaskApiSpec(app)
+    for resource in (UserResource, UsersListResource, UserAddPhotoResource, UserFindOrResource, UserFindLikeResource,
+                     NoteResource, NotesListResource, NoteRestoreResource, NoteTagsResource, NoteTexResource,
+                     NoteFilterTagsResource, NotesBulkTagsResource, NotesImportResource, NotesExportResource,
+                     TagsResource, TagsListResource,
+                     UploadPictureResource, UploadSessionsResource, UploadSessionResource, UploadCompleteResource):
+        docs.register(resource)
+    app.extensions['apispec'] = docs
+    app.logger.setLevel(logging.INFO)
+    return app
+
+
+def warm_up(app):
+    """
+    Готовит процесс-воркер к первому запросу: строит индекс тегов, проверяет реплики
+    и запускает их фоновое обновление. Вызывается после fork (gunicorn post_fork) и при старте ASGI сервера
+    """
+    from api import replica
+    from api.models.note import NoteModel
+
+    tag_index.start(app, NoteModel.get_tag_pairs)
+    replica.start_monitor(app)
+
+
 @babel.localeselector
 def get_locale():
-    res = request.accept_languages.best_match(app.config['LANGUAGES'])
+    res = request.accept_languages.best_match(current_app.config['LANGUAGES'])
     return res
 
 
@@ -63,11 +135,23 @@ def verify_password(username_or_token, password):
     # print("username_or_token = ", username_or_token)
     # print("password = ", password)
     user = UserModel.verify_auth_token(username_or_token)
+    if not user:
+        # потом кэш успешных проверок, чтобы не гонять sha512_crypt на каждый запрос
+        cached = credential_cache.get(username_or_token, password)
+        if cached is not None:
+            user = UserModel.query.get(cached[0])
+            # пароль или имя могли сменить (или удалить пользователя) в другом воркере:
+            # запись верна, пока имя и хэш пароля в базе те же, что при проверке
+            if (user is None or user.username != username_or_token
+                    or credential_cache.stamp(user.password_hash) != cached[1]):
+                credential_cache.invalidate_user(cached[0])
+                user = None
     if not user:
         # потом авторизация
         user = UserModel.query.filter_by(username=username_or_token).first()
         if not user or not user.verify_password(password):
             return False
+        credential_cache.add(username_or_token, password, user.id, user.password_hash)
     g.user = user
     return True
 
@@ -0,0 +1,187 @@
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from werkzeug.wsgi import FileWrapper
+
+
+class AsgiApp:
+    """
+    ASGI приложение поверх WSGI приложения Flask: те же маршруты, схемы и авторизация.
+    Все общение с клиентом идет в цикле событий: тело запроса и ответа целиком собираются в SpooledTemporaryFile
+    (в память, больше buffer_size - во временный файл), файлы (send_file) читаются и отправляются циклом.
+    Поток из пула threads занят только самой обработкой запроса, поэтому медленные клиенты (загрузки,
+    плохая сеть) не держат ни потоки, ни соединения с БД. Цена: большой потоковый ответ (экспорт)
+    клиент начинает получать, только когда он сформирован целиком.
+    Ресурсы и SQLAlchemy остаются синхронными: threads стоит держать не больше пула соединений
+    """
+
+    def __init__(self, wsgi_app, threads, buffer_size, max_body=None, on_startup=()):
+        self.wsgi_app = wsgi_app
+        self.on_startup = on_startup
+        self.buffer_size = buffer_size
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        request = await self.read_body(receive, send)
+        if request is None:
+            return
+        body, size = request
+        loop = asyncio.get_running_loop()
+        response = PendingResponse(send, self.buffer_size)
+        try:
+            try:
+                await loop.run_in_executor(self.executor, self.run, environ(scope, body, size), response)
+            finally:
+                body.close()
+            await response.finish()
+        finally:
+            response.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # синхронные приготовления (индекс тегов) - в пуле, чтобы не останавливать цикл событий
+                for callback in self.on_startup:
+                    await asyncio.get_running_loop().run_in_executor(self.executor, callback)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive, send):
+        """
+        (тело запроса в SpooledTemporaryFile, размер);
+        None - клиент ушел или тело больше max_body (тогда уже отвечено 413)
+        """
+        body = SpooledTemporaryFile(max_size=self.buffer_size)
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if self.max_body is not None and size > self.max_body:
+                body.close()
+                await send({'type': 'http.response.start', 'status': 413,
+                            'headers': [(b'content-type', b'text/plain'), (b'connection', b'close')]})
+                await send({'type': 'http.response.body', 'body': b'Request Entity Too Large'})
+                return None
+            body.write(chunk)
+            if not message.get('more_body', False):
+                body.seek(0)
+                return body, size
+
+    def run(self, environ, response):
+        """
+        Вызов WSGI приложения в потоке пула. Ответ собирается в response целиком, до конца генератора:
+        курсор потокового запроса и соединение с БД освобождаются, не дожидаясь клиента.
+        Файл из send_file не читается здесь, его отправит цикл событий после освобождения потока
+        """
+        iterable = self.wsgi_app(environ, response.start_response)
+        if isinstance(iterable, FileWrapper):
+            response.file = iterable
+            return
+        try:
+            for chunk in iterable:
+                response.write(chunk)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+
+class PendingResponse:
+    """
+    Ответ одного запроса: start_response и write вызываются из потока пула, отправка - в цикле событий
+    """
+
+    def __init__(self, send, buffer_size):
+        self.send = send
+        self.buffer_size = buffer_size
+        self.status = None
+        self.headers = []
+        # тело ответа: до buffer_size в памяти, больше (экспорт) - во временном файле
+        self.body = SpooledTemporaryFile(max_size=buffer_size)
+        self.file = None
+
+    def start_response(self, status, headers, exc_info=None):
+        # клиенту до конца обработки ничего не отправлено: ответ об ошибке (exc_info) просто заменяет заголовки
+        self.status = int(status.split(' ', 1)[0])
+        self.headers = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+        return self.write
+
+    def write(self, chunk):
+        self.body.write(chunk)
+
+    def chunks(self):
+        self.body.seek(0)
+        for file in (self.body, self.file.file if self.file is not None else None):
+            # чтение локального файла короткое, клиент при этом сколько угодно медленный
+            while file is not None:
+                chunk = file.read(self.buffer_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def finish(self):
+        await self.send({'type': 'http.response.start', 'status': self.status, 'headers': self.headers})
+        chunks = self.chunks()
+        chunk = next(chunks, b'')
+        while True:
+            # последняя часть уходит с more_body=False: маленький ответ - одним сообщением
+            following = next(chunks, None)
+            await self.send({'type': 'http.response.body', 'body': chunk, 'more_body': following is not None})
+            if following is None:
+                return
+            chunk = following
+
+    def close(self):
+        self.body.close()
+        if self.file is not None:
+            self.file.close()
+
+
+def environ(scope, body, size):
+    """
+    WSGI environ (PEP 3333) из ASGI scope и прочитанного тела
+    """
+    server = scope.get('server') or ('localhost', 80)
+    result = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI передает путь байтами в latin-1, ASGI - уже декодированной строкой
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    if scope.get('client'):
+        result['REMOTE_ADDR'], result['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin1')
+        result[name] = f'{result[name]},{value}' if name in result else value
+    # тело уже целиком у нас: длина известна и для chunked запросов
+    result['CONTENT_LENGTH'] = str(size)
+    return result
@@ -0,0 +1,466 @@
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialCache:
+    """
+    Кэш успешных проверок логина/пароля для HTTP Basic auth.
+    Ключ - HMAC от username и password на случайном ключе процесса,
+    сам пароль в памяти не хранится. Вместе с id пользователя хранится отпечаток
+    его password_hash (stamp): запись годна, только пока хэш в базе тот же, поэтому смена пароля
+    в другом воркере сразу делает ее недействительной.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, secret=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._secret = secret or os.urandom(32)
+        self._entries = OrderedDict()  # key -> (user_id, stamp, expires_at)
+        self._keys_by_user = {}  # user_id -> set(key)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, username, password):
+        msg = f"{username}\0{password}".encode('utf-8')
+        return hmac.new(self._secret, msg, hashlib.sha256).digest()
+
+    def stamp(self, password_hash):
+        return hmac.new(self._secret, password_hash.encode('utf-8'), hashlib.sha256).digest()
+
+    def get(self, username, password):
+        """
+        (user_id, stamp) или None
+        """
+        key = self._key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[:2]
+
+    def add(self, username, password, user_id, password_hash):
+        key = self._key(username, password)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (user_id, self.stamp(password_hash), time.monotonic() + self.ttl)
+            self._keys_by_user.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in self._keys_by_user.pop(user_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._keys_by_user.get(entry[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_user[entry[0]]
+
+
+class TokenVersionCache:
+    """
+    Текущие версии токенов пользователей для stateless токенов.
+    Хранятся только пользователи, чьи токены предъявлялись в этом процессе за последние token_ttl секунд
+    (дольше токен не живет), поэтому набор компактный. Версия нового пользователя читается из базы
+    при первом предъявлении, а раз в refresh_interval секунд версии всех хранимых перечитываются
+    одним проходом, чтобы увидеть отзывы и удаления, сделанные другими воркерами.
+    Пользователя, которого нет в базе, токен не пропускает: отзыв определяется только состоянием базы
+    """
+
+    def __init__(self, refresh_interval=30, token_ttl=600):
+        self.refresh_interval = refresh_interval
+        self.token_ttl = token_ttl
+        self._versions = {}  # user_id -> token_version, None - пользователя нет в базе
+        self._seen = {}  # user_id -> когда токен предъявлялся последний раз
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def is_current(self, user_id, version, loader):
+        """
+        loader(ids) -> [(id, token_version)] существующих пользователей из ids
+        """
+        now = time.monotonic()
+        self._maybe_refresh(loader, now)
+        with self._lock:
+            self._seen[user_id] = now
+            if user_id not in self._versions:
+                self._versions[user_id] = dict(loader([user_id])).get(user_id)
+            current = self._versions[user_id]
+        return current is not None and current == version
+
+    def set(self, user_id, version):
+        with self._lock:
+            self._versions[user_id] = version
+
+    def revoke_user(self, user_id):
+        # до следующего перечитывания; потом версию снова определит база
+        with self._lock:
+            self._versions[user_id] = None
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+            self._seen.clear()
+            self._loaded_at = None
+
+    def _maybe_refresh(self, loader, now):
+        if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+                return
+            self._seen = {user_id: seen for user_id, seen in self._seen.items() if now - seen < self.token_ttl}
+            versions = dict(loader(list(self._seen))) if self._seen else {}
+            self._versions = {user_id: versions.get(user_id) for user_id in self._seen}
+            self._loaded_at = now
+
+
+class Bitmap:
+    """
+    Сжатое множество неотрицательных id: словарь чанков по 2**16 id (как в Roaring),
+    каждый чанк - битовая маска в int. Пустые чанки не хранятся
+    """
+    CHUNK_BITS = 16
+    __slots__ = ('chunks',)
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks or {}
+
+    @classmethod
+    def from_ids(cls, ids):
+        buffers = {}
+        for id in ids:
+            buffer = buffers.get(id >> cls.CHUNK_BITS)
+            if buffer is None:
+                buffer = buffers[id >> cls.CHUNK_BITS] = bytearray(1 << (cls.CHUNK_BITS - 3))
+            low = id & ((1 << cls.CHUNK_BITS) - 1)
+            buffer[low >> 3] |= 1 << (low & 7)
+        return cls({high: int.from_bytes(buffer, 'little') for high, buffer in buffers.items()})
+
+    def add(self, id):
+        high = id >> self.CHUNK_BITS
+        self.chunks[high] = self.chunks.get(high, 0) | (1 << (id & ((1 << self.CHUNK_BITS) - 1)))
+
+    def discard(self, id):
+        high = id >> self.CHUNK_BITS
+        value = self.chunks.get(high, 0) & ~(1 << (id & ((1 << self.CHUNK_BITS) - 1)))
+        if value:
+            self.chunks[high] = value
+        else:
+            self.chunks.pop(high, None)
+
+    def __and__(self, other):
+        chunks = {}
+        for high in self.chunks.keys() & other.chunks.keys():
+            value = self.chunks[high] & other.chunks[high]
+            if value:
+                chunks[high] = value
+        return Bitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for high, value in other.chunks.items():
+            chunks[high] = chunks.get(high, 0) | value
+        return Bitmap(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for high, value in self.chunks.items():
+            value &= ~other.chunks.get(high, 0)
+            if value:
+                chunks[high] = value
+        return Bitmap(chunks)
+
+    def __len__(self):
+        return sum(bin(value).count('1') for value in self.chunks.values())
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    def iter_from(self, start=0):
+        """
+        id из множества, не меньшие start, по возрастанию
+        """
+        start_high = start >> self.CHUNK_BITS
+        for high in sorted(self.chunks):
+            if high < start_high:
+                continue
+            base = high << self.CHUNK_BITS
+            bits = bin(self.chunks[high])[:1:-1]  # младший бит первым
+            position = bits.find('1', start - base if high == start_high else 0)
+            while position != -1:
+                yield base + position
+                position = bits.find('1', position + 1)
+
+
+class TagIndex:
+    """
+    Инвертированный индекс тег -> Bitmap id заметок.
+    Строится из таблицы tags при старте процесса (start), поддерживается инкрементально
+    при привязке/отвязке тегов и раз в refresh_interval секунд перестраивается целиком
+    в фоновом потоке, чтобы увидеть изменения из других воркеров. Запрос перестройку не ждет:
+    новый индекс собирается без блокировки, а изменения, сделанные за это время, накладываются
+    на него перед подменой
+    """
+
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self._bitmaps = {}  # tag_id -> Bitmap
+        self._loaded_at = None
+        self._generation = 0  # растет при clear(): перестройка, начатая до него, результат не кладет
+        self._journal = None  # [(метод, tag_id, note_id)] за время фоновой перестройки
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, app, loader):
+        """
+        Строит индекс и запускает поток перестройки в этом процессе (после fork - заново)
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        if has_app_context():
+            self.rebuild(loader)
+        else:
+            with app.app_context():
+                self.rebuild(loader)
+        threading.Thread(target=self._refresh_loop, args=(app, loader), name='tag-index', daemon=True).start()
+
+    def rebuild(self, loader):
+        with self._lock:
+            generation = self._generation
+            self._journal = []
+        try:
+            note_ids = {}
+            for tag_id, note_id in loader():
+                note_ids.setdefault(tag_id, []).append(note_id)
+            bitmaps = {tag_id: Bitmap.from_ids(ids) for tag_id, ids in note_ids.items()}
+        finally:
+            with self._lock:
+                journal, self._journal = self._journal, None
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._bitmaps = bitmaps
+            self._loaded_at = time.monotonic()
+            for method, tag_id, note_id in journal:
+                method(self, tag_id, note_id)
+
+    def select(self, loader, all_of=(), any_of=(), none_of=()):
+        """
+        Bitmap заметок, у которых есть все теги all_of, хотя бы один из any_of и нет ни одного из none_of.
+        Без all_of и any_of множество не ограничено сверху - возвращается None
+        """
+        if self._pid != os.getpid():
+            # приложение запущено без start (flask run, тесты, скрипты) - индекс строит первый запрос
+            self.start(current_app._get_current_object(), loader)
+        with self._lock:
+            if self._loaded_at is None:
+                # сброшен clear()
+                self._generation += 1
+                self._bitmaps = {}
+                for tag_id, note_id in loader():
+                    self._bitmaps.setdefault(tag_id, Bitmap()).add(note_id)
+                self._loaded_at = time.monotonic()
+            result = None
+            for tag_id in all_of:
+                bitmap = self._bitmaps.get(tag_id, Bitmap())
+                result = bitmap if result is None else result & bitmap
+            if any_of:
+                union = Bitmap()
+                for tag_id in any_of:
+                    union = union | self._bitmaps.get(tag_id, Bitmap())
+                result = union if result is None else result & union
+            if result is None:
+                return None
+            for tag_id in none_of:
+                result = result - self._bitmaps.get(tag_id, Bitmap())
+            return result
+
+    def add(self, tag_id, note_id):
+        with self._lock:
+            self._add(tag_id, note_id)
+            if self._journal is not None:
+                self._journal.append((TagIndex._add, tag_id, note_id))
+
+    def remove(self, tag_id, note_id):
+        with self._lock:
+            self._remove(tag_id, note_id)
+            if self._journal is not None:
+                self._journal.append((TagIndex._remove, tag_id, note_id))
+
+    def drop_tag(self, tag_id):
+        with self._lock:
+            self._bitmaps.pop(tag_id, None)
+            if self._journal is not None:
+                self._journal.append((TagIndex._drop, tag_id, None))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._bitmaps = {}
+            self._loaded_at = None
+
+    def _add(self, tag_id, note_id):
+        if self._loaded_at is not None:
+            self._bitmaps.setdefault(tag_id, Bitmap()).add(note_id)
+
+    def _remove(self, tag_id, note_id):
+        bitmap = self._bitmaps.get(tag_id)
+        if bitmap is not None:
+            bitmap.discard(note_id)
+
+    def _drop(self, tag_id, note_id):
+        self._bitmaps.pop(tag_id, None)
+
+    def _refresh_loop(self, app, loader):
+        while self._pid == os.getpid():
+            time.sleep(self.refresh_interval)
+            try:
+                # свой контекст на проход: сессия и ее транзакция закрываются сразу после чтения
+                with app.app_context():
+                    self.rebuild(loader)
+            except Exception:
+                logger.exception("Tag index refresh failed")
+
+
+class TagCache:
+    """
+    Read-through кэш справочника тегов: id -> name и name -> id, плюс весь список тегов.
+    Ограничен по размеру (LRU) и по времени жизни записей: изменения из других воркеров
+    видны не позже чем через ttl секунд, свои - сразу через invalidate().
+    Каждая инвалидация увеличивает version; загрузка, начатая до инвалидации,
+    свой результат в кэш не кладет
+    """
+
+    def __init__(self, maxsize=4096, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self._names = OrderedDict()  # id -> (name, expires_at)
+        self._ids = OrderedDict()  # name -> (id, expires_at)
+        self._catalogue = None  # ([(id, name)], expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_names(self, ids, loader):
+        """
+        {id: name} для существующих тегов из ids; недостающие читаются одним вызовом loader(ids)
+        """
+        return self._get(self._names, ids, loader, lambda id, name: (id, name))
+
+    def get_ids(self, names, loader):
+        """
+        {name: id} для существующих тегов из names; недостающие читаются одним вызовом loader(names)
+        """
+        return self._get(self._ids, names, loader, lambda id, name: (name, id))
+
+    def all(self, loader):
+        """
+        Все теги [(id, name)] по возрастанию id, loader() читает их из базы
+        """
+        with self._lock:
+            if self._catalogue is not None and self._catalogue[1] >= time.monotonic():
+                self.hits += 1
+                return self._catalogue[0]
+            self.misses += 1
+            version = self.version
+        catalogue = list(loader())
+        with self._lock:
+            if version == self.version and len(catalogue) <= self.maxsize:
+                self._catalogue = (catalogue, time.monotonic() + self.ttl)
+                for id, name in catalogue:
+                    self._store(self._names, id, name)
+                    self._store(self._ids, name, id)
+        return catalogue
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._names.clear()
+            self._ids.clear()
+            self._catalogue = None
+
+    clear = invalidate
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._names),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _get(self, entries, keys, loader, pair):
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = entries.get(key)
+                if entry is not None and entry[1] >= now:
+                    entries.move_to_end(key)
+                    found[key] = entry[0]
+                elif key not in missing:
+                    missing.append(key)
+            self.hits += len(found)
+            self.misses += len(missing)
+            version = self.version
+        if not missing:
+            return found
+        rows = list(loader(missing))
+        with self._lock:
+            for id, name in rows:
+                key, value = pair(id, name)
+                found[key] = value
+                if version == self.version:
+                    self._store(self._names, id, name)
+                    self._store(self._ids, name, id)
+        return found
+
+    def _store(self, entries, key, value):
+        entries[key] = (value, time.monotonic() + self.ttl)
+        entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
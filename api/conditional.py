@@ -0,0 +1,51 @@
+import hashlib
+import hmac
+from functools import wraps
+
+from flask import Response, current_app, request
+from werkzeug.http import http_date
+
+from api import g
+from api.models.version import ResourceVersionModel
+
+
+def conditional(*keys, per_user=False, readable=None):
+    """
+    Условный GET: ETag и Last-Modified из счетчиков версий ресурсов.
+    keys - шаблоны ключей версий, подставляются аргументы вьюхи: 'note:{note_id}'.
+    Если клиент прислал актуальный If-None-Match (или If-Modified-Since без него),
+    отвечаем 304 без чтения и сериализации ресурса.
+    ETag - HMAC на SECRET_KEY: по id и номерам версий его не вычислить.
+    per_user=True добавляет в ETag id пользователя: чужой ETag не обходит проверку доступа.
+    readable(**kwargs) - дешевая проверка, что ресурс есть и виден пользователю; без нее 304 не отдается,
+    а вьюха сама отвечает 404/403, поэтому условный запрос не выдает существование и число правок чужого ресурса
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if readable is not None and not readable(**kwargs):
+                return view(*args, **kwargs)
+            resource_keys = [key.format(**kwargs) for key in keys]
+            versions = ResourceVersionModel.get_versions(resource_keys)
+            parts = [f"{key}={versions.get(key, (0, None))[0]}" for key in resource_keys]
+            if per_user:
+                parts.append(f"user={g.user.id}")
+            etag = hmac.new(current_app.config['SECRET_KEY'].encode(), ';'.join(parts).encode(),
+                            hashlib.sha1).hexdigest()
+            modified = [updated_at for version, updated_at in versions.values()]
+            last_modified = max(modified).replace(microsecond=0) if modified else None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = bool(last_modified and request.if_modified_since
+                                    and last_modified <= request.if_modified_since.replace(tzinfo=None))
+            headers = {'ETag': f'"{etag}"'}
+            if last_modified:
+                headers['Last-Modified'] = http_date(last_modified)
+            if not_modified:
+                return Response(status=304, headers=headers)
+            data, code = view(*args, **kwargs)
+            return data, code, headers
+        return wrapper
+    return decorator
@@ -0,0 +1,79 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.sql import expression
+
+from api import db
+
+# счетчики заметок у автора и у тега: все, публичные (видны всем - не private и не в архиве), в архиве
+COUNTERS = ('note_count', 'public_note_count', 'archived_note_count')
+ZERO = (0, 0, 0)
+
+
+def note_counts(private, archive):
+    """
+    Вклад одной заметки в счетчики COUNTERS
+    """
+    return 1, int(not private and not archive), int(bool(archive))
+
+
+def add(deltas, key, counts, sign=1):
+    """
+    Прибавляет вклад counts (со знаком sign) к deltas[key]
+    """
+    deltas[key] = tuple(total + sign * count for total, count in zip(deltas.get(key, ZERO), counts))
+
+
+def apply(model, deltas):
+    """
+    Прибавляет {id: (d_note_count, d_public, d_archived)} к счетчикам строк model одним executemany.
+    UPDATE ... SET note_count = note_count + :d атомарен, параллельные транзакции не теряют изменений
+    """
+    rows = [{'row_id': id, **{f'd_{name}': delta for name, delta in zip(COUNTERS, counts)}}
+            for id, counts in deltas.items() if id is not None and any(counts)]
+    if rows:
+        table = model.__table__
+        db.session.execute(table.update().where(table.c.id == db.bindparam('row_id'))
+                           .values({name: table.c[name] + db.bindparam(f'd_{name}') for name in COUNTERS}), rows)
+
+
+def recount(connection):
+    """
+    Пересчитывает счетчики пользователей и тегов по note_model и tags и исправляет расходящиеся.
+    Возвращает {таблица: число исправленных строк}
+    """
+    from api.models.note import NoteModel, tags
+    from api.models.tag import TagModel
+    from api.models.user import UserModel
+
+    note = NoteModel.__table__
+    if connection.dialect.name == 'postgresql':
+        # пишущие транзакции ждут конца пересчета, иначе их приращения затрутся старыми итогами
+        connection.execute(db.text(f'LOCK TABLE {note.name}, {tags.name} IN SHARE MODE'))
+    public = db.and_(note.c.private == expression.false(), note.c.archive == expression.false())
+    aggregates = [db.func.count(), db.func.sum(db.case([(public, 1)], else_=0)),
+                  db.func.sum(db.case([(note.c.archive == expression.true(), 1)], else_=0))]
+    sources = {
+        UserModel: db.select([note.c.author_id, *aggregates]).group_by(note.c.author_id),
+        TagModel: db.select([tags.c.tag_id, *aggregates]).select_from(tags.join(note)).group_by(tags.c.tag_id),
+    }
+    fixed = {}
+    for model, source in sources.items():
+        table = model.__table__
+        expected = {id: tuple(counts) for id, *counts in connection.execute(source)}
+        current = connection.execute(db.select([table.c.id, *(table.c[name] for name in COUNTERS)]))
+        rows = [{'row_id': id, **{f'v_{name}': count for name, count in zip(COUNTERS, expected.get(id, ZERO))}}
+                for id, *counts in current if tuple(counts) != expected.get(id, ZERO)]
+        if rows:
+            connection.execute(table.update().where(table.c.id == db.bindparam('row_id'))
+                               .values({name: db.bindparam(f'v_{name}') for name in COUNTERS}), rows)
+        fixed[table.name] = len(rows)
+    return fixed
+
+
+@click.command('repair-counters')
+@with_appcontext
+def repair_counters_command():
+    """Recompute note counters of users and tags from the notes."""
+    with db.engine.begin() as connection:
+        fixed = recount(connection)
+    click.echo(', '.join(f'{table}: {count} fixed' for table, count in fixed.items()))
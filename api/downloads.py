@@ -0,0 +1,58 @@
+import os
+from urllib.parse import quote
+
+from flask import current_app, request, url_for
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+
+def file_version(path):
+    """
+    Версия содержимого файла из mtime и размера: меняется при перезаписи, считается одним stat
+    """
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def download_url(url):
+    """
+    Адрес скачивания файла FileModel.url с версией (?v=): такой ответ кешируется навсегда
+    """
+    filename = os.path.relpath(url, current_app.config['UPLOAD_FOLDER_NAME'])
+    try:
+        version = file_version(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+    except OSError:
+        return url_for('download_file', filename=filename)
+    return url_for('download_file', filename=filename, v=version)
+
+
+def send_upload(filename):
+    """
+    Отдает файл из UPLOAD_FOLDER с поддержкой Range, If-None-Match и If-Modified-Since.
+    UPLOAD_SENDFILE передает саму отдачу прокси (X-Sendfile для Apache/lighttpd,
+    X-Accel-Redirect для nginx), воркер только проверяет файл и пишет заголовки.
+    Запрос с актуальной версией (?v=) получает Cache-Control: immutable на год,
+    без версии - no-cache: клиент каждый раз сверяет ETag и обычно получает 304
+    """
+    path = safe_join(current_app.config['UPLOAD_FOLDER'], filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    version = file_version(path)
+    immutable = request.args.get('v') == version
+    mode = current_app.config['UPLOAD_SENDFILE']
+    # Range при отдаче через прокси обрабатывает сам прокси
+    response = send_file(path, request.environ, as_attachment=True, etag=version, conditional=not mode,
+                         max_age=current_app.config['UPLOAD_CACHE_MAX_AGE'] if immutable else None,
+                         use_x_sendfile=bool(mode), response_class=current_app.response_class)
+    if immutable:
+        response.cache_control.immutable = True
+    if mode:
+        response = response.make_conditional(request.environ)
+        sendfile = response.headers.pop('X-Sendfile')
+        if response.status_code != 304:
+            if mode == 'x-accel':
+                response.headers['X-Accel-Redirect'] = current_app.config['UPLOAD_ACCEL_PREFIX'] + quote(filename)
+            else:
+                response.headers['X-Sendfile'] = sendfile
+    return response
@@ -0,0 +1,66 @@
+from functools import partial
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import event, orm
+
+# у SQLite пула нет (NullPool), эти параметры create_engine для него не примет
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping')
+
+
+def set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    """
+    Сессия, которая читает с реплики, если запрос ее выбрал (g.replica_engine, см. api.replica).
+    Запись (flush) всегда идет в основную базу
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = g.get('replica_engine') if has_app_context() else None
+        if engine is not None and not self._flushing:
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Flask-SQLAlchemy с профилями движка из Config:
+    параметры пула - только для серверных БД, для PostgreSQL еще и пакетный executemany,
+    для SQLite - PRAGMA на каждом соединении.
+    Сессии - RoutingSession, чтобы GET запросы могли читать с реплик
+    """
+
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.get_backend_name() == 'postgresql' and sa_url.get_driver_name() == 'psycopg2':
+            engine_opts = dict(self.get_app().config.get('POSTGRESQL_ENGINE_OPTIONS') or {}, **engine_opts)
+        if not sa_url.drivername.startswith('sqlite'):
+            return super().create_engine(sa_url, engine_opts)
+        engine = super().create_engine(sa_url, {option: value for option, value in engine_opts.items()
+                                                if option not in POOL_OPTIONS})
+        pragmas = self.get_app().config.get('SQLITE_PRAGMAS')
+        if pragmas:
+            event.listen(engine, 'connect', partial(set_sqlite_pragmas, pragmas))
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def dispose_engines(self, app, close=True):
+        """
+        Сбрасывает пулы соединений основной базы и реплик приложения.
+        close=False - для процесса после fork: унаследованные соединения принадлежат родителю,
+        их закрытие оборвало бы и его сессии, поэтому пул просто создается заново пустым
+        """
+        for bind in [None, *(app.config['SQLALCHEMY_BINDS'] or {})]:
+            engine = self.get_engine(app, bind)
+            if close:
+                engine.dispose()
+            else:
+                engine.pool = engine.pool.recreate()
@@ -0,0 +1,60 @@
+import json
+from itertools import islice
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+from api import db
+from api.models.note import NoteModel, tags
+from api.models.tag import TagModel
+from api.models.user import UserModel
+from api.schemas.note import NoteAuthorSchema, NoteSchema
+
+# автор у всех выгружаемых заметок один, его сериализуем один раз - той же схемой, что и в NoteSchema
+note_schema = NoteSchema(exclude=('author',))
+author_schema = NoteAuthorSchema()
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_notes(author_id, batch_size):
+    """
+    Сериализованные заметки пользователя по возрастанию id.
+    Заметки читаются серверным курсором (yield_per) пачками по batch_size,
+    теги пачки догружаются одним запросом, автор - один на всех,
+    так что в памяти никогда не больше одной пачки
+    """
+    author_data = author_schema.dump(UserModel.get_detailed(author_id))
+    notes = NoteModel.query.filter_by(author_id=author_id).order_by(NoteModel.id) \
+        .execution_options(stream_results=True).yield_per(batch_size)
+    for chunk in chunked(notes, batch_size):
+        note_tags = {note.id: [] for note in chunk}
+        tag_rows = db.session.query(TagModel, tags.c.note_model_id) \
+            .join(tags, tags.c.tag_id == TagModel.id) \
+            .filter(tags.c.note_model_id.in_(list(note_tags)))
+        for tag, note_id in tag_rows:
+            note_tags[note_id].append(tag)
+        for note in chunk:
+            set_committed_value(note, 'tags', note_tags[note.id])
+            yield dict(note_schema.dump(note), author=author_data)
+
+
+def export_notes(author_id, batch_size, format='ndjson'):
+    """
+    Сериализует заметки по одной: NDJSON или JSON массив, который отдается по частям
+    """
+    notes = (json.dumps(note, ensure_ascii=False) for note in iter_notes(author_id, batch_size))
+    if format == 'ndjson':
+        for note in notes:
+            yield note + '\n'
+        return
+    yield '['
+    for number, note in enumerate(notes):
+        yield note if number == 0 else ',' + note
+    yield ']\n'
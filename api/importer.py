@@ -0,0 +1,121 @@
+import json
+
+from marshmallow import ValidationError
+
+from api import counters, db, tag_cache, tag_index
+from api.models.note import NoteModel, insert_ignore, tags
+from api.models.tag import TagModel
+from api.models.user import UserModel
+from api.models.version import ResourceVersionModel
+from api.schemas.note import NoteCreateSchema
+
+note_create_schema = NoteCreateSchema()
+
+
+def read_lines(stream, max_line):
+    """
+    Строки NDJSON из потока по одной, без чтения тела целиком
+    """
+    while True:
+        line = stream.readline(max_line + 1)
+        if not line:
+            return
+        if len(line) > max_line and not line.endswith(b'\n'):
+            # хвост слишком длинной строки пропускаем
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line)
+            yield None
+            continue
+        yield line
+
+
+def parse_line(line):
+    """
+    Возвращает (строка для note_model, имена тегов) или бросает ValidationError
+    """
+    try:
+        data = json.loads(line)
+    except ValueError:
+        raise ValidationError("Invalid JSON")
+    if not isinstance(data, dict):
+        raise ValidationError("Line must be a JSON object")
+    tag_names = data.pop('tags', [])
+    if not isinstance(tag_names, list) or not all(isinstance(name, str) and 0 < len(name) <= 255
+                                                   for name in tag_names):
+        raise ValidationError({'tags': ["Must be a list of tag names"]})
+    note = note_create_schema.load(data)
+    note.setdefault('private', True)
+    return note, set(tag_names)
+
+
+def get_tag_ids(names):
+    """
+    ({name: id}, были ли созданы теги) по именам, недостающие теги создаются
+    """
+    if not names:
+        return {}, False
+    tag_ids = tag_cache.get_ids(names, TagModel.get_ids)
+    missing = names - tag_ids.keys()
+    if missing:
+        db.session.execute(insert_ignore(TagModel.__table__), [{'name': name} for name in missing])
+        ResourceVersionModel.bump('tags')
+        # новые теги еще не закоммичены, поэтому читаем их мимо кэша
+        tag_ids.update((name, id) for id, name in TagModel.get_ids(missing))
+    return tag_ids, bool(missing)
+
+
+def flush(author_id, batch):
+    """
+    Записывает пачку разобранных строк одной транзакцией, возвращает результаты по строкам
+    """
+    valid = [item for item in batch if 'note' in item]
+    if valid:
+        ids = NoteModel.bulk_create([dict(item['note'], author_id=author_id, archive=False) for item in valid])
+        tag_ids, created = get_tag_ids(set().union(*(item['tags'] for item in valid)))
+        links = [{'note_model_id': note_id, 'tag_id': tag_ids[name]}
+                 for item, note_id in zip(valid, ids) for name in item['tags']]
+        if links:
+            db.session.execute(tags.insert(), links)
+        # заметки новые и не в архиве, поэтому связи тоже все новые: вклад известен без запросов
+        author_deltas, tag_deltas = {}, {}
+        for item in valid:
+            item_counts = counters.note_counts(item['note']['private'], False)
+            counters.add(author_deltas, author_id, item_counts)
+            for name in item['tags']:
+                counters.add(tag_deltas, tag_ids[name], item_counts)
+        counters.apply(UserModel, author_deltas)
+        counters.apply(TagModel, tag_deltas)
+        ResourceVersionModel.bump(f'user:{author_id}')
+        db.session.commit()
+        if created:
+            tag_cache.invalidate()
+        for item, note_id in zip(valid, ids):
+            item['result'] = {'line': item['line'], 'status': 'ok', 'id': note_id}
+        for link in links:
+            tag_index.add(link['tag_id'], link['note_model_id'])
+    return [item['result'] for item in batch]
+
+
+def import_notes(stream, author_id, batch_size, max_line):
+    """
+    Импорт заметок из NDJSON потока: по объекту {"text", "private", "tags": [имена]} на строку.
+    Пачки по batch_size строк вставляются через executemany, каждая в своей транзакции.
+    Отдает результаты по строкам по мере записи пачек
+    """
+    batch = []
+    for number, line in enumerate(read_lines(stream, max_line), start=1):
+        if line is not None and not line.strip():
+            continue
+        item = {'line': number}
+        try:
+            if line is None:
+                raise ValidationError(f"Line is longer than {max_line} bytes")
+            item['note'], item['tags'] = parse_line(line)
+        except ValidationError as error:
+            item['result'] = {'line': number, 'status': 'error', 'errors': error.messages}
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield from flush(author_id, batch)
+            batch = []
+    if batch:
+        yield from flush(author_id, batch)
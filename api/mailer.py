@@ -0,0 +1,184 @@
+import atexit
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class MailDispatcher:
+    """
+    Фоновая отправка писем, чтобы SMTP никогда не задерживал запрос.
+    send() только кладет письмо в ограниченную очередь; рабочие потоки забирают письма пачками
+    и отправляют через одно SMTP соединение, которое держат открытым, пока есть работа
+    (закрывают после idle_timeout секунд простоя). Временные ошибки повторяются
+    с экспоненциальной задержкой, при переполненной очереди письмо отбрасывается
+    """
+
+    def __init__(self, mail, workers=1, queue_size=1000, batch_size=50, retries=3, backoff=1.0, idle_timeout=30):
+        self.mail = mail
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._pid = None
+        self._app = None
+        self._stop_registered = False
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.connections = 0
+
+    def send(self, message):
+        """
+        Ставит письмо в очередь. False, если очередь переполнена и письмо отброшено
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("Mail queue is full, message %r dropped", message.subject)
+            return False
+        return True
+
+    def join(self):
+        """
+        Ждет, пока очередь опустеет (для тестов и остановки)
+        """
+        self._queue.join()
+
+    def stop(self, timeout=5):
+        with self._lock:
+            threads, self._threads, self._pid = self._threads, [], None
+        for _ in threads:
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                # очередь не разбирается - потоки демоны, выход процесса не ждем
+                logger.warning("Mail queue is full on stop, %d messages dropped", self._queue.qsize())
+                return
+        for thread in threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'workers': len(self._threads),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'connections': self.connections,
+            }
+
+    def _ensure_started(self):
+        # потоки не переживают fork, поэтому в новом процессе (воркере gunicorn) запускаем заново;
+        # поток, который все же упал, тоже заменяется
+        if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+            return
+        with self._lock:
+            if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+                return
+            if not self._stop_registered:
+                atexit.register(self.stop)
+                self._stop_registered = True
+            self._app = current_app._get_current_object()
+            if self._pid != os.getpid():
+                self._threads = []
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for number in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._work, name=f'mail-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def _work(self):
+        with self._app.app_context():
+            connection = None
+            try:
+                while True:
+                    try:
+                        message = self._queue.get(timeout=self.idle_timeout)
+                    except queue.Empty:
+                        connection = self._close(connection)
+                        continue
+                    if message is _STOP:
+                        self._queue.task_done()
+                        return
+                    batch = [message]
+                    stopping = False
+                    while len(batch) < self.batch_size:
+                        try:
+                            message = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if message is _STOP:
+                            # stop() кладет по одному _STOP на поток: этот - наш, останавливаемся после пачки,
+                            # а не возвращаем его в очередь (блокирующий put в полную очередь мог бы зависнуть)
+                            self._queue.task_done()
+                            stopping = True
+                            break
+                        batch.append(message)
+                    for message in batch:
+                        try:
+                            connection = self._deliver(connection, message)
+                        except Exception:
+                            # не SMTP ошибка (BadHeaderError, кривой адрес): повтор не поможет, письмо
+                            # отбрасывается, а поток продолжает работу
+                            logger.exception("Mail %r dropped", getattr(message, 'subject', None))
+                            with self._lock:
+                                self.failed += 1
+                            connection = self._close(connection)
+                        finally:
+                            self._queue.task_done()
+                    if stopping:
+                        return
+            finally:
+                self._close(connection)
+
+    def _deliver(self, connection, message):
+        attempt = 0
+        while True:
+            try:
+                if connection is None:
+                    connection = self.mail.connect().__enter__()
+                    with self._lock:
+                        self.connections += 1
+                connection.send(message)
+                with self._lock:
+                    self.sent += 1
+                return connection
+            except (smtplib.SMTPException, OSError) as error:
+                if not isinstance(error, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                    # соединение оборвалось - следующая попытка откроет новое
+                    connection = self._close(connection)
+                permanent = isinstance(error, smtplib.SMTPRecipientsRefused) or \
+                    isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+                if permanent or attempt >= self.retries:
+                    logger.error("Mail %r not sent: %s", message.subject, error)
+                    with self._lock:
+                        self.failed += 1
+                    return connection
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
@@ -0,0 +1,261 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+UNMATCHED = 'unmatched'
+DEAD_SNAPSHOT = 'dead.json'  # сумма снимков завершившихся воркеров
+
+
+class Registry:
+    """
+    Метрики запросов одного процесса: по (ресурс, метод) число запросов, гистограмма времени ответа,
+    число и время SQL запросов; по (ресурс, метод, статус) - число ответов.
+    Снимок (snapshot) - обычный JSON, снимки воркеров складываются в merge()
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._requests = {}  # (resource, method) -> [count, seconds, [по корзинам], sql_count, sql_seconds]
+        self._statuses = {}  # (resource, method, status) -> count
+        self._lock = threading.Lock()
+
+    def observe(self, resource, method, status, seconds, sql_count, sql_seconds):
+        key = (resource, method)
+        bucket = bisect_left(self.buckets, seconds)
+        with self._lock:
+            stats = self._requests.get(key)
+            if stats is None:
+                stats = self._requests[key] = [0, 0.0, [0] * (len(self.buckets) + 1), 0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2][bucket] += 1
+            stats[3] += sql_count
+            stats[4] += sql_seconds
+            key = (resource, method, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return self.pack(self.buckets, self._requests, self._statuses)
+
+    def clear(self):
+        with self._lock:
+            self._requests.clear()
+            self._statuses.clear()
+
+    @staticmethod
+    def pack(buckets, requests, statuses):
+        """
+        Снимок из результата merge() - например, сумма счетчиков завершившихся воркеров
+        """
+        return {
+            'buckets': list(buckets),
+            'requests': [[*key, count, seconds, list(counts), sql_count, sql_seconds]
+                         for key, (count, seconds, counts, sql_count, sql_seconds) in requests.items()],
+            'statuses': [[*key, count] for key, count in statuses.items()],
+        }
+
+    @staticmethod
+    def merge(snapshots):
+        requests, statuses, buckets = {}, {}, []
+        for snapshot in snapshots:
+            if buckets and snapshot['buckets'] != buckets:
+                # воркер со старыми настройками корзин (до перезапуска) - гистограммы не складываются
+                continue
+            buckets = snapshot['buckets']
+            for resource, method, count, seconds, counts, sql_count, sql_seconds in snapshot['requests']:
+                stats = requests.setdefault((resource, method), [0, 0.0, [0] * len(counts), 0, 0.0])
+                stats[0] += count
+                stats[1] += seconds
+                stats[2] = [total + number for total, number in zip(stats[2], counts)]
+                stats[3] += sql_count
+                stats[4] += sql_seconds
+            for resource, method, status, count in snapshot['statuses']:
+                statuses[(resource, method, status)] = statuses.get((resource, method, status), 0) + count
+        return buckets, requests, statuses
+
+
+def labels(**values):
+    """
+    Метки Prometheus; в значениях экранируются обратная косая черта, кавычка и перевод строки
+    (метод запроса приходит от клиента)
+    """
+    return ','.join(f'{name}="{escape_label(value)}"' for name, value in values.items())
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(buckets, requests, statuses):
+    """
+    Текстовый формат Prometheus (exposition format 0.0.4)
+    """
+    lines = [
+        '# HELP http_requests_total Requests by resource, method and status.',
+        '# TYPE http_requests_total counter',
+    ]
+    for (resource, method, status), count in sorted(statuses.items()):
+        lines.append(f'http_requests_total{{{labels(resource=resource, method=method, status=status)}}} {count}')
+    lines += [
+        '# HELP http_request_duration_seconds Request latency by resource and method.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for (resource, method), (count, seconds, counts, sql_count, sql_seconds) in sorted(requests.items()):
+        request_labels = labels(resource=resource, method=method)
+        cumulative = 0
+        for le, number in zip([*map(str, buckets), '+Inf'], counts):
+            cumulative += number
+            lines.append(f'http_request_duration_seconds_bucket{{{request_labels},le="{le}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_sum{{{request_labels}}} {seconds}')
+        lines.append(f'http_request_duration_seconds_count{{{request_labels}}} {count}')
+    for name, index, kind in (('sql_statements_total', 3, 'SQL statements executed'),
+                              ('sql_duration_seconds_total', 4, 'Time spent in SQL statements')):
+        lines += [f'# HELP {name} {kind} by resource and method.', f'# TYPE {name} counter']
+        for (resource, method), stats in sorted(requests.items()):
+            lines.append(f'{name}{{{labels(resource=resource, method=method)}}} {stats[index]}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry(Config.METRICS_BUCKETS)
+_local = threading.local()  # текущий запрос этого потока: начало и счетчики SQL
+_resources = {}  # endpoint -> имя класса ресурса
+_flushed_at = [0.0]
+
+
+def resource_name(endpoint):
+    name = _resources.get(endpoint)
+    if name is None:
+        view = current_app.view_functions.get(endpoint)
+        name = _resources[endpoint] = getattr(view, 'view_class', view).__name__ if view else UNMATCHED
+    return name
+
+
+def snapshot_path(directory, pid):
+    return os.path.join(directory, f'{pid}.json')
+
+
+def write_snapshot(path, snapshot):
+    # пишем во временный файл и переименовываем, чтобы читатель не увидел половину
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(f'{path}.tmp', path)
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logger.warning("Metrics snapshot %s skipped: %s", path, error)
+        return None
+
+
+def flush():
+    """
+    Сохраняет снимок процесса в METRICS_DIR, откуда /metrics собирает все воркеры
+    """
+    write_snapshot(snapshot_path(current_app.config['METRICS_DIR'], os.getpid()), registry.snapshot())
+    _flushed_at[0] = time.monotonic()
+
+
+def mark_process_dead(directory, pid):
+    """
+    Снимок завершившегося воркера pid добавляется к общему снимку завершившихся (dead.json)
+    и удаляется: счетчики не теряются и не растут от уже не существующих воркеров, а новый
+    воркер с тем же pid не затирает чужие итоги. Вызывается мастером gunicorn (child_exit).
+    Запросы после последнего flush() воркера не учитываются
+    """
+    path = snapshot_path(directory, pid)
+    snapshot = read_snapshot(path)
+    if snapshot is not None:
+        dead = os.path.join(directory, DEAD_SNAPSHOT)
+        write_snapshot(dead, Registry.pack(*Registry.merge(filter(None, (read_snapshot(dead), snapshot)))))
+    for name in (path, f'{path}.tmp'):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def clear_snapshots(directory):
+    """
+    Удаляет снимки прошлого запуска (вызывается мастером gunicorn при старте)
+    """
+    for path in glob.glob(os.path.join(directory, '*.json')) + glob.glob(os.path.join(directory, '*.json.tmp')):
+        os.remove(path)
+
+
+def collect():
+    """
+    Метрики всех воркеров: снимки из METRICS_DIR (свой - свежий), без METRICS_DIR - только этот процесс.
+    и итоги завершившихся воркеров (mark_process_dead)
+    """
+    if not current_app.config['METRICS_DIR']:
+        return render(*Registry.merge([registry.snapshot()]))
+    flush()
+    snapshots = map(read_snapshot, glob.glob(os.path.join(current_app.config['METRICS_DIR'], '*.json')))
+    return render(*Registry.merge(filter(None, snapshots)))
+
+
+def start_request():
+    _local.start = time.perf_counter()
+    _local.sql_count = 0
+    _local.sql_seconds = 0.0
+
+
+def record_request(response):
+    start = getattr(_local, 'start', None)
+    if start is None:
+        return response
+    _local.start = None
+    registry.observe(resource_name(request.endpoint), request.method, response.status_code,
+                     time.perf_counter() - start, _local.sql_count, _local.sql_seconds)
+    if current_app.config['METRICS_DIR'] and \
+            time.monotonic() - _flushed_at[0] > current_app.config['METRICS_FLUSH_INTERVAL']:
+        flush()
+    return response
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(record_request)
+
+
+# события на классе Engine - для всех движков: основной базы и реплик
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'start', None) is not None:
+        conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('statement_start')
+    if starts and getattr(_local, 'start', None) is not None:
+        _local.sql_count += 1
+        _local.sql_seconds += time.perf_counter() - starts.pop()
+
+
+@event.listens_for(Engine, 'handle_error')
+def drop_statement(context):
+    # after_cursor_execute для упавшего запроса не вызывается
+    if context.connection is not None and getattr(_local, 'start', None) is not None:
+        starts = context.connection.info.get('statement_start')
+        if starts:
+            starts.pop()
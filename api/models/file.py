@@ -1,10 +1,23 @@
 from api import db
+from api.models.version import ResourceVersionModel
 
 
 class FileModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(255), unique=True, nullable=False)
+    # уменьшенные копии {"64": url, ...}; None, пока они не готовы
+    derivatives = db.Column(db.JSON, nullable=True)
 
     def save(self):
         db.session.add(self)
         db.session.commit()
+
+    def set_derivatives(self, derivatives):
+        from api.models.user import UserModel
+
+        self.derivatives = derivatives
+        # фото вложено в пользователя (и в автора заметок), поэтому меняются и их версии
+        user_ids = [user_id for user_id, in db.session.query(UserModel.id).filter_by(photo_id=self.id)]
+        if user_ids:
+            ResourceVersionModel.bump(*(f'user:{user_id}' for user_id in user_ids), 'users')
+        db.session.commit()
@@ -1,41 +1,245 @@
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import expression
 
-from api import db
+from api import counters, db
 from api.models.tag import TagModel
 from api.models.user import UserModel
+from api.models.version import ResourceVersionModel
 
 tags = db.Table('tags',
                 db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
-                db.Column('note_model_id', db.Integer, db.ForeignKey('note_model.id'), primary_key=True)
+                db.Column('note_model_id', db.Integer, db.ForeignKey('note_model.id'), primary_key=True),
+                # первичный ключ ведет от тега к заметкам, этот - от заметки к тегам
+                db.Index('ix_tags_note_model_id_tag_id', 'note_model_id', 'tag_id'),
                 )
 
 
+def insert_ignore(table):
+    """
+    INSERT, пропускающий строки, которые нарушают уникальность
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('OR IGNORE')
+
+
 class NoteModel(db.Model):
+    # индексы под две ветки видимости (см. visibility): свои заметки по автору, публичные - частичный.
+    # В частичных индексах литералы false: SQLite сопоставляет их только с такими же константами в запросе
+    __table_args__ = (
+        db.Index('ix_note_model_author_id_id', 'author_id', 'id'),
+        db.Index('ix_note_model_public_id', 'id',
+                 sqlite_where=db.text('private = 0 AND archive = 0'),
+                 postgresql_where=db.text('NOT private AND NOT archive')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author_id = db.Column(db.Integer, db.ForeignKey(UserModel.id))
     text = db.Column(db.String(255), unique=False, nullable=False)
-    tags = db.relationship(TagModel, secondary=tags, lazy='subquery', backref=db.backref('notes', lazy=True))
+    # lazy='raise': связи загружаются только явно через list_options/detail_options,
+    # случайная ленивая загрузка (N+1) падает с ошибкой.
+    # passive_deletes: строки tags при удалении удаляются явно в delete()
+    tags = db.relationship(TagModel, secondary=tags, lazy='raise', passive_deletes=True,
+                           backref=db.backref('notes', lazy='raise', passive_deletes=True))
     private = db.Column(db.Boolean(), default=True, server_default=expression.true(), nullable=False)
     archive = db.Column(db.Boolean(), default=False, server_default=expression.false(), nullable=False)
 
+    @classmethod
+    def list_options(cls):
+        # для списков: теги одним SELECT ... IN на страницу, автор с фото через JOIN
+        return [selectinload(cls.tags), joinedload(cls.author).joinedload(UserModel.photo)]
+
+    @classmethod
+    def detail_options(cls):
+        # автор с фото через JOIN, теги вторым запросом по индексу tags(note_model_id):
+        # JOIN с (tags JOIN tag) SQLite материализует целиком, это просмотр всей tags на каждую заметку
+        return [selectinload(cls.tags), joinedload(cls.author).joinedload(UserModel.photo)]
+
+    @classmethod
+    def get_detailed(cls, note_id):
+        return cls.query.options(*cls.detail_options()).filter_by(id=note_id).first()
+
+    @classmethod
+    def visibility(cls, author):
+        """
+        Ветки условия видимости: свои заметки или публичные. Для каждой есть свой индекс,
+        поэтому страницы списков собираются по веткам (см. paginate(branches=...))
+        """
+        return [cls.author_id == author.id, cls.private == expression.false()]
+
     @classmethod
     def get_all_for_user(cls, author):
-        return cls.query.filter((NoteModel.author.has(id=author.id)) | (NoteModel.private == False)) \
-            .filter_by(archive=False)
+        return cls.query.filter(db.or_(*cls.visibility(author))).filter(cls.archive == expression.false())
+
+    @classmethod
+    def is_visible(cls, author, note_id):
+        """
+        Есть ли заметка и видна ли она author: только id по первичному ключу, без загрузки заметки
+        """
+        return cls.get_all_for_user(author).filter_by(id=note_id).with_entities(cls.id).first() is not None
+
+    @staticmethod
+    def tags_filter(all_of=(), any_of=(), none_of=()):
+        """
+        То же условие по тегам, что у tag_index.select, в SQL: EXISTS по индексу tags(note_model_id, tag_id)
+        """
+        def linked(*conditions):
+            return db.exists().where(tags.c.note_model_id == NoteModel.id).where(*conditions)
+        conditions = [linked(tags.c.tag_id == tag_id) for tag_id in all_of]
+        if any_of:
+            conditions.append(linked(tags.c.tag_id.in_(any_of)))
+        if none_of:
+            conditions.append(~linked(tags.c.tag_id.in_(none_of)))
+        return db.and_(*conditions)
+
+    @staticmethod
+    def get_tag_pairs():
+        return db.session.query(tags.c.tag_id, tags.c.note_model_id)
+
+    @staticmethod
+    def bulk_update_tags(note_ids, add=(), remove=()):
+        """
+        Привязывает теги add и отвязывает теги remove у заметок note_ids одной транзакцией,
+        без загрузки заметок и тегов. Счетчики тегов меняются только на реально
+        вставленные и удаленные связи
+        """
+        # состояние заметок и уже существующие связи одним запросом; заметки блокируются до коммита,
+        # чтобы параллельная смена тегов тех же заметок не посчитала те же связи второй раз
+        link = db.and_(tags.c.note_model_id == NoteModel.id, tags.c.tag_id.in_(set(add) | set(remove)))
+        rows = db.session.query(NoteModel.id, NoteModel.private, NoteModel.archive, tags.c.tag_id) \
+            .outerjoin(tags, link).filter(NoteModel.id.in_(note_ids)).with_for_update(of=NoteModel)
+        linked, states = {}, {}
+        for note_id, private, archive, tag_id in rows:
+            states[note_id] = counters.note_counts(private, archive)
+            linked.setdefault(note_id, set()).add(tag_id)
+        deltas = {}
+        for note_id, counts in states.items():
+            for tag_id in linked[note_id] & set(remove):
+                counters.add(deltas, tag_id, counts, -1)
+            for tag_id in set(add) - (linked[note_id] - set(remove)):
+                counters.add(deltas, tag_id, counts)
+        if remove:
+            db.session.execute(tags.delete()
+                               .where(tags.c.note_model_id.in_(note_ids))
+                               .where(tags.c.tag_id.in_(remove)))
+        if add:
+            # связи только с тегами, которые есть в момент вставки: SQLite внешние ключи не проверяет,
+            # а тег могли удалить после проверки в ресурсе
+            pairs = db.select([NoteModel.id, TagModel.id]).where(NoteModel.id.in_(note_ids)) \
+                .where(TagModel.id.in_(add))
+            db.session.execute(insert_ignore(tags).from_select(['note_model_id', 'tag_id'], pairs))
+        counters.apply(TagModel, deltas)
+        ResourceVersionModel.bump(*(f'note:{note_id}' for note_id in note_ids))
+        db.session.commit()
+
+    @staticmethod
+    def bulk_create(rows):
+        """
+        Вставляет заметки одним executemany и возвращает их id в порядке rows.
+        Коммит за вызывающим
+        """
+        table = NoteModel.__table__
+        if db.engine.dialect.name == 'postgresql':
+            ids = [id for id, in db.session.execute(
+                db.text("SELECT nextval('note_model_id_seq') FROM generate_series(1, :count)"),
+                {'count': len(rows)})]
+            db.session.execute(table.insert(), [dict(row, id=id) for row, id in zip(rows, ids)])
+            return ids
+        db.session.execute(table.insert(), rows)
+        # SQLite выдает новым строкам max(rowid) + 1 подряд, а пишущая транзакция одна
+        last_id = db.session.execute(db.select([db.func.max(table.c.id)])).scalar()
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def stored_state(self):
+        """
+        (private, archive) по значениям до изменений в этой сессии; None - заметки еще нет в базе
+        """
+        state = db.inspect(self)
+        if not state.persistent:
+            return None
+
+        def stored(name):
+            history = state.attrs[name].history
+            return history.deleted[0] if history.deleted else getattr(self, name)
+        return stored('private'), stored('archive')
+
+    def stored_counts(self):
+        """
+        Вклад заметки, уже учтенный в счетчиках: по значениям до изменений в этой сессии
+        """
+        stored = self.stored_state()
+        return counters.ZERO if stored is None else counters.note_counts(*stored)
+
+    def write_state(self):
+        """
+        Записывает измененные private и archive сохраненной заметки условным UPDATE: строка меняется,
+        только если в базе то же состояние, в котором заметку прочитали. Если ее успел изменить
+        параллельный запрос, состояние перечитывается под блокировкой строки (SQLite уже держит
+        блокировку записи с первого UPDATE), и вклад в счетчики считается от него: один переход
+        не учитывается дважды. Возвращает ключи версий
+        """
+        table = NoteModel.__table__
+        state = db.inspect(self)
+        stored = self.stored_state()
+        changes = {name: getattr(self, name) for name in ('private', 'archive')
+                   if state.attrs[name].history.has_changes()}
+        if not changes:
+            return []
+        result = db.session.execute(table.update().values(changes).where(table.c.id == self.id)
+                                    .where(table.c.private == stored[0]).where(table.c.archive == stored[1]))
+        if result.rowcount != 1:
+            stored = tuple(db.session.query(NoteModel.private, NoteModel.archive).filter_by(id=self.id)
+                           .with_for_update().one())
+            db.session.execute(table.update().values(changes).where(table.c.id == self.id))
+        current = dict(zip(('private', 'archive'), stored), **changes)
+        # в объекте - то, что теперь в базе; flush сессии эти поля больше не отправит
+        for name, value in current.items():
+            set_committed_value(self, name, value)
+        return self.update_counters(counters.note_counts(*stored), counters.note_counts(**current))
+
+    def update_counters(self, stored, counts):
+        """
+        Переносит изменение вклада заметки stored -> counts в счетчики автора и ее тегов.
+        Возвращает ключи версий, которые от этого меняются
+        """
+        delta = tuple(now - before for now, before in zip(counts, stored))
+        if not any(delta):
+            return []
+        counters.apply(UserModel, {self.author_id: delta})
+        if stored != counters.ZERO:
+            # у новой заметки тегов еще нет
+            tag_ids = db.session.query(tags.c.tag_id).filter(tags.c.note_model_id == self.id)
+            counters.apply(TagModel, {tag_id: delta for tag_id, in tag_ids})
+        return [f'user:{self.author_id}']
 
     def save(self):
-        db.session.add(self)
+        if db.inspect(self).persistent:
+            keys = self.write_state()
+        else:
+            db.session.add(self)
+            db.session.flush()
+            keys = self.update_counters(counters.ZERO, counters.note_counts(self.private, self.archive))
+        ResourceVersionModel.bump(f'note:{self.id}', *keys)
         db.session.commit()
 
     def restore(self):
         self.archive = False
+        keys = self.write_state()
+        ResourceVersionModel.bump(f'note:{self.id}', *keys)
         db.session.commit()
 
     def archivated(self):
         self.archive = True
+        keys = self.write_state()
+        ResourceVersionModel.bump(f'note:{self.id}', *keys)
         db.session.commit()
 
     def delete(self):
+        keys = self.update_counters(self.stored_counts(), counters.ZERO)
+        db.session.execute(tags.delete().where(tags.c.note_model_id == self.id))
+        ResourceVersionModel.bump(f'note:{self.id}', *keys)
         db.session.delete(self)
         db.session.commit()
 
@@ -1,23 +1,66 @@
 from sqlalchemy.exc import IntegrityError
 
-from api import db
+from api import db, tag_cache
+from api.models.version import ResourceVersionModel
 
 
 class TagModel(db.Model):
     __tablename__ = 'tag'
+    # популярные теги (get_popular) читаются обратным проходом по индексу, без сортировки
+    __table_args__ = (db.Index('ix_tag_note_count_id', 'note_count', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), unique=True, nullable=False)
+    # счетчики заметок с тегом (api.counters), меняются в тех же транзакциях, что и заметки
+    note_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    public_note_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    archived_note_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    @staticmethod
+    def get_names(ids):
+        return db.session.query(TagModel.id, TagModel.name).filter(TagModel.id.in_(ids))
+
+    @staticmethod
+    def lock(ids):
+        """
+        (id, name) существующих тегов из ids для записи связей: на PostgreSQL строки блокируются
+        (FOR SHARE) до конца транзакции, и параллельное удаление тега ждет ее коммита
+        """
+        return TagModel.get_names(ids).with_for_update(read=True)
+
+    @staticmethod
+    def get_ids(names):
+        return db.session.query(TagModel.id, TagModel.name).filter(TagModel.name.in_(names))
+
+    @staticmethod
+    def get_catalogue():
+        return db.session.query(TagModel.id, TagModel.name).order_by(TagModel.id)
+
+    @staticmethod
+    def get_popular(limit):
+        # при равных счетчиках первыми идут новые теги: так порядок совпадает с индексом
+        return TagModel.query.order_by(TagModel.note_count.desc(), TagModel.id.desc()).limit(limit)
 
     def save(self):
         try:
             db.session.add(self)
+            db.session.flush()
+            ResourceVersionModel.bump('tags')
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
+        tag_cache.invalidate()
 
     def delete(self):
+        from api.models.note import tags
+
+        # сначала строка тега, как и при записи связей (lock): ждем транзакции, которые к нему привязывают
+        db.session.query(TagModel.id).filter_by(id=self.id).with_for_update().first()
+        db.session.execute(tags.delete().where(tags.c.tag_id == self.id))
+        ResourceVersionModel.bump('tags')
         db.session.delete(self)
         db.session.commit()
+        tag_cache.invalidate()
 
     def __repr__(self):
         return f"Tag {self.name}"
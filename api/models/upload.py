@@ -0,0 +1,63 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from api import db
+
+
+class UploadSessionModel(db.Model):
+    """
+    Незавершенная загрузка файла по частям.
+    Принятые байты лежат в UPLOAD_PARTIAL_FOLDER/<id>, размер этого файла и есть текущее смещение
+    """
+    __tablename__ = 'upload_session'
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    @property
+    def path(self):
+        return os.path.join(current_app.config['UPLOAD_PARTIAL_FOLDER'], self.id)
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    @classmethod
+    def delete_expired(cls):
+        expired = datetime.utcnow() - timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+        for session in cls.query.filter(cls.created_at < expired):
+            session.delete()
+
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+        os.makedirs(current_app.config['UPLOAD_PARTIAL_FOLDER'], exist_ok=True)
+        open(self.path, 'ab').close()
+
+    def claim(self):
+        """
+        Забирает сессию для завершения: удаляет ее строку условным DELETE.
+        False - ее уже завершил или отменил другой запрос (строки нет, rowcount 0)
+        """
+        deleted = UploadSessionModel.query.filter_by(id=self.id).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted == 1
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return f"UploadSession {self.id}:{self.filename}"
@@ -2,21 +2,31 @@ from itsdangerous import BadSignature, SignatureExpired
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from passlib.apps import custom_app_context as pwd_context
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import expression
 
-from api import Config, db, ma
+from api import Config, credential_cache, db, ma, token_versions
 from api.models.file import FileModel
+from api.models.version import ResourceVersionModel
 
 
 class UserModel(db.Model):
+    # id удаленного пользователя не достается новому: иначе его неистекшие токены подошли бы новому
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(32), unique=True)
     password_hash = db.Column(db.String(128))
-    notes = db.relationship('NoteModel', backref='author', lazy='dynamic')
+    # notes остается dynamic: это запрос, а не коллекция, сам по себе он не грузится
+    notes = db.relationship('NoteModel', backref=db.backref('author', lazy='raise'), lazy='dynamic')
     is_staff = db.Column(db.Boolean(), default=False, server_default=expression.true(), nullable=False)
     role = db.Column(db.String(32), default=False, server_default=expression.true(), nullable=False)
     photo_id = db.Column(db.Integer, db.ForeignKey("file_model.id"), nullable=True)
-    photo = db.relationship(FileModel, backref="user", lazy='joined')
+    photo = db.relationship(FileModel, backref=db.backref("user", lazy='raise'), lazy='raise')
+    token_version = db.Column(db.Integer, default=0, server_default='0', nullable=False, index=True)
+    # счетчики заметок автора (api.counters), меняются в тех же транзакциях, что и заметки
+    note_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    public_note_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    archived_note_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     # photo_url = db.Column(db.String(128))
 
     def __init__(self, **kwargs):
@@ -28,30 +38,62 @@ class UserModel(db.Model):
     #     self.username = username
     #     self.hash_password(password)
 
+    @classmethod
+    def detail_options(cls):
+        return [joinedload(cls.photo)]
+
+    @classmethod
+    def exists(cls, user_id):
+        return cls.query.filter_by(id=user_id).with_entities(cls.id).first() is not None
+
+    @classmethod
+    def get_detailed(cls, user_id):
+        return cls.query.options(*cls.detail_options()).filter_by(id=user_id).first()
+
     def hash_password(self, password):
         self.password_hash = pwd_context.encrypt(password)
+        if self.id is not None:
+            credential_cache.invalidate_user(self.id)
 
     def verify_password(self, password):
         return pwd_context.verify(password, self.password_hash)
 
-    def generate_auth_token(self, expiration=600):
-        s = Serializer(Config.SECRET_KEY, expires_in=expiration)
-        return s.dumps({'id': self.id})
+    def generate_auth_token(self, expiration=Config.TOKEN_EXPIRATION):
+        return generate_auth_token(self.id, self.role, self.token_version, expiration)
+
+    def revoke_tokens(self):
+        """
+        Отзывает все выданные пользователю токены (logout, смена роли)
+        """
+        self.token_version = (self.token_version or 0) + 1
 
     def get_roles(self):
         return self.role
 
     def save(self):
+        if self.id is not None and db.inspect(self).attrs.role.history.has_changes():
+            # в выданных токенах зашита роль, поэтому смена роли их отзывает
+            self.revoke_tokens()
         try:
             db.session.add(self)
+            db.session.flush()
+            # автор вложен в заметки, поэтому меняется и общая версия 'users'
+            ResourceVersionModel.bump(f'user:{self.id}', 'users')
             db.session.commit()
         except IntegrityError:
             print(f"User with username={self.username} already exist")
             db.session.rollback()
+        if self.id is not None:
+            credential_cache.invalidate_user(self.id)
+            token_versions.set(self.id, self.token_version)
 
     def delete(self):
+        user_id = self.id
+        ResourceVersionModel.bump(f'user:{user_id}', 'users')
         db.session.delete(self)
         db.session.commit()
+        credential_cache.invalidate_user(user_id)
+        token_versions.revoke_user(user_id)
 
     @staticmethod
     def verify_auth_token(token):
@@ -62,8 +104,49 @@ class UserModel(db.Model):
             return None  # valid token, but expired
         except BadSignature:
             return None  # invalid token
-        user = UserModel.query.get(data['id'])
-        return user
+        if 'ver' not in data:
+            # токены старого формата содержат только id
+            user = UserModel.query.get(data['id'])
+            return user
+        if not token_versions.is_current(data['id'], data['ver'], UserModel.get_token_versions):
+            return None  # token revoked
+        return UserPrincipal(data['id'], data['role'], data['ver'])
+
+    @staticmethod
+    def get_token_versions(ids):
+        """
+        [(id, token_version)] существующих пользователей из ids
+        """
+        rows = []
+        for start in range(0, len(ids), 500):
+            rows += db.session.query(UserModel.id, UserModel.token_version) \
+                .filter(UserModel.id.in_(ids[start:start + 500])).all()
+        return rows
 
     def __repr__(self):
         return f"User {self.username}, role:{self.role}"
+
+
+class UserPrincipal:
+    """
+    Пользователь, восстановленный из подписанного токена без обращения к базе
+    """
+
+    def __init__(self, id, role, token_version):
+        self.id = id
+        self.role = role
+        self.token_version = token_version
+
+    def generate_auth_token(self, expiration=Config.TOKEN_EXPIRATION):
+        return generate_auth_token(self.id, self.role, self.token_version, expiration)
+
+    def get_roles(self):
+        return self.role
+
+    def __repr__(self):
+        return f"UserPrincipal {self.id}, role:{self.role}"
+
+
+def generate_auth_token(user_id, role, token_version, expiration):
+    s = Serializer(Config.SECRET_KEY, expires_in=expiration)
+    return s.dumps({'id': user_id, 'role': role, 'ver': token_version})
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from api import db
+
+
+class ResourceVersionModel(db.Model):
+    """
+    Счетчики версий ресурсов для ETag/Last-Modified.
+    Увеличиваются в той же транзакции, что и изменение ресурса,
+    поэтому видны всем воркерам сразу после коммита
+    """
+    __tablename__ = 'resource_version'
+    __table_args__ = (
+        # отметки последних записей пользователей (api.replica), их раз в секунду читает каждый процесс
+        db.Index('ix_resource_version_write_updated_at', 'updated_at',
+                 sqlite_where=db.text("key LIKE 'write:%'"),
+                 postgresql_where=db.text("key LIKE 'write:%'")),
+    )
+    key = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    @classmethod
+    def bump(cls, *keys):
+        from api.models.note import insert_ignore
+
+        now = datetime.utcnow()
+        db.session.execute(insert_ignore(cls.__table__), [{'key': key, 'version': 0, 'updated_at': now} for key in keys])
+        db.session.execute(cls.__table__.update().where(cls.key.in_(keys))
+                           .values(version=cls.version + 1, updated_at=now))
+
+    @classmethod
+    def get_versions(cls, keys):
+        """
+        {key: (version, updated_at)} одним запросом, ключей без изменений в ответе нет
+        """
+        rows = db.session.query(cls.key, cls.version, cls.updated_at).filter(cls.key.in_(keys))
+        return {key: (version, updated_at) for key, version, updated_at in rows}
+
+    def __repr__(self):
+        return f"ResourceVersion {self.key}:{self.version}"
@@ -0,0 +1,110 @@
+import base64
+import binascii
+import json
+from itertools import islice
+
+from flask import request, url_for
+from flask_babel import gettext
+from sqlalchemy import and_, or_, select, union_all
+
+from api import abort
+
+
+def encode_cursor(value):
+    raw = json.dumps({'k': value}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, *types):
+    """
+    Значение курсора: ключ (int - все ключи пагинации здесь целые id), а если переданы types - список
+    такой же длины, i-й элемент которого имеет тип types[i]. Подделанный курсор другого вида - 400,
+    а не пустая страница или ошибка базы при сравнении column > value
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value = json.loads(raw)['k']
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        abort(400, error=gettext("Invalid cursor"))
+    keys, expected = ([value], [int]) if not types else (value, types)
+    if (not isinstance(keys, list) or len(keys) != len(expected)
+            or not all(isinstance(key, kinds) and not isinstance(key, bool) for key, kinds in zip(keys, expected))):
+        abort(400, error=gettext("Invalid cursor"))
+    return value
+
+
+def next_link(cursor):
+    args = request.args.to_dict(flat=False)
+    args['after'] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+def paginate(query, column, limit, after=None, branches=None):
+    """
+    Keyset-пагинация по возрастанию column: вместо OFFSET фильтруем column > after,
+    поэтому любая страница стоит столько же, сколько первая.
+    branches - ветки OR, который уже есть в query (например, NoteModel.visibility): по OR индекс
+    в порядке column не пройти, поэтому каждая ветка своим индексом берет limit + 1 первых ключей,
+    а страница собирается из их объединения.
+    Возвращает конверт {'items': [...], 'next': url или None}
+    """
+    if after is not None:
+        query = query.filter(column > decode_cursor(after))
+    if branches:
+        keys = [query.filter(branch).with_entities(column).order_by(column).limit(limit + 1).subquery()
+                for branch in branches]
+        query = query.filter(column.in_(union_all(*[select(list(key.c)) for key in keys])))
+    items = query.order_by(column).limit(limit + 1).all()
+    next_url = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_url = next_link(encode_cursor(getattr(items[-1], column.key)))
+    return {'items': items, 'next': next_url}
+
+
+def paginate_ranked(query, rank, column, limit, after=None):
+    """
+    Keyset-пагинация по паре (rank, column) для запросов, строки которых - (объект, rank, ...).
+    Курсор хранит rank и ключ последнего объекта страницы
+    """
+    if after is not None:
+        last_rank, last_key = decode_cursor(after, (int, float), int)
+        query = query.filter(or_(rank > last_rank, and_(rank == last_rank, column > last_key)))
+    rows = query.order_by(rank, column).limit(limit + 1).all()
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_url = next_link(encode_cursor([rows[-1].rank, getattr(rows[-1][0], column.key)]))
+    return {'items': rows, 'next': next_url}
+
+
+def paginate_ids(query, column, bitmap, condition, limit, after=None, window=500, max_windows=8):
+    """
+    Keyset-пагинация, когда кандидаты заранее известны как Bitmap id (например, из индекса тегов).
+    Кандидаты проверяются запросом окнами по window id, пока не наберется страница.
+    Если видимых среди кандидатов мало, после max_windows окон остаток страницы добирается
+    одним запросом с тем же условием в SQL (condition), чтобы число запросов на страницу было ограничено
+    """
+    start = 0
+    if after is not None:
+        start = decode_cursor(after) + 1
+    candidates = bitmap.iter_from(start)
+    items = []
+    checked = start - 1
+    for _ in range(max_windows):
+        if len(items) > limit:
+            break
+        ids = list(islice(candidates, window))
+        if not ids:
+            break
+        items += query.filter(column.in_(ids)).order_by(column).limit(limit + 1 - len(items)).all()
+        checked = ids[-1]
+    else:
+        if len(items) <= limit:
+            items += query.filter(condition).filter(column > checked) \
+                .order_by(column).limit(limit + 1 - len(items)).all()
+    next_url = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_url = next_link(encode_cursor(getattr(items[-1], column.key)))
+    return {'items': items, 'next': next_url}
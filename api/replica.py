@@ -0,0 +1,215 @@
+import hashlib
+import hmac
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import and_, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from api import db, g
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'primary_until'
+PIN_PREFIX = 'write:'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# отставание реплики PostgreSQL в секундах; если все полученное WAL уже применено - 0
+POSTGRESQL_LAG = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+
+_health = {}  # bind -> (healthy, checked_at)
+_pins = {}  # user_id -> время последней записи (utc), по отметкам основной базы и ответам этого процесса
+_lock = threading.Lock()
+_monitor_pid = None
+
+
+def replica_binds(app=None):
+    app = app or current_app
+    return [bind for bind in app.config['SQLALCHEMY_BINDS'] or {} if bind.startswith('replica_')]
+
+
+def measure_lag(engine):
+    with engine.connect() as connection:
+        if engine.dialect.name == 'postgresql':
+            return connection.execute(POSTGRESQL_LAG).scalar() or 0
+        connection.execute(text("SELECT 1"))
+        return 0
+
+
+def check_replicas(app):
+    """
+    Проверяет доступность и отставание всех реплик app и запоминает результат для is_healthy
+    """
+    for bind in replica_binds(app):
+        try:
+            healthy = measure_lag(db.get_engine(app, bind=bind)) <= app.config['REPLICA_MAX_LAG']
+        except SQLAlchemyError:
+            healthy = False
+        with _lock:
+            _health[bind] = (healthy, time.monotonic())
+
+
+def refresh_pins(app):
+    """
+    Загружает из основной базы отметки записей за последние REPLICA_PIN_SECONDS, в том числе
+    сделанных в других воркерах: один запрос по частичному индексу на процесс, а не на каждое чтение
+    """
+    from api.models.version import ResourceVersionModel
+
+    table = ResourceVersionModel.__table__
+    since = datetime.utcnow() - timedelta(seconds=app.config['REPLICA_PIN_SECONDS'])
+    # условие - та же константа, что в индексе ix_resource_version_write_updated_at
+    query = select([table.c.key, table.c.updated_at]).where(and_(text(f"key LIKE '{PIN_PREFIX}%'"),
+                                                                 table.c.updated_at > since))
+    with db.get_engine(app).connect() as connection:
+        written = {int(key[len(PIN_PREFIX):]): updated_at for key, updated_at in connection.execute(query)}
+    with _lock:
+        # свои отметки, сделанные после запроса, не теряем
+        for user_id, updated_at in _pins.items():
+            if updated_at > written.get(user_id, since):
+                written[user_id] = updated_at
+        _pins.clear()
+        _pins.update(written)
+
+
+def start_monitor(app):
+    """
+    Проверяет реплики и запускает поток, который повторяет проверку раз в REPLICA_LAG_CHECK секунд,
+    а отметки записей обновляет раз в REPLICA_PIN_REFRESH (в каждом процессе свой, после fork - заново).
+    Запросы только читают результат
+    """
+    global _monitor_pid
+    with _lock:
+        if _monitor_pid == os.getpid() or not replica_binds(app):
+            return
+        _monitor_pid = os.getpid()
+    check_replicas(app)
+    refresh_pins(app)
+    threading.Thread(target=_monitor, args=(app,), name='replica-monitor', daemon=True).start()
+
+
+def _monitor(app):
+    checked = time.monotonic()
+    while _monitor_pid == os.getpid():
+        time.sleep(app.config['REPLICA_PIN_REFRESH'])
+        try:
+            refresh_pins(app)
+        except Exception:
+            logger.exception("Pin refresh failed")
+        if time.monotonic() - checked >= app.config['REPLICA_LAG_CHECK']:
+            checked = time.monotonic()
+            try:
+                check_replicas(app)
+            except Exception:
+                logger.exception("Replica check failed")
+
+
+def is_healthy(bind):
+    """
+    Реплика доступна и отстает не больше REPLICA_MAX_LAG по последней проверке фонового потока.
+    Не проверенная или давно не проверявшаяся (поток завис на соединении) считается недоступной
+    """
+    healthy, checked_at = _health.get(bind, (False, None))
+    return healthy and time.monotonic() - checked_at < 3 * current_app.config['REPLICA_LAG_CHECK']
+
+
+def pin_key(user_id):
+    return f'{PIN_PREFIX}{user_id}'
+
+
+def sign_pin(until):
+    return hmac.new(current_app.config['SECRET_KEY'].encode(), f"{PIN_COOKIE}={until}".encode(),
+                    hashlib.sha1).hexdigest()
+
+
+def is_pinned():
+    """
+    Клиент недавно писал: по подписанной cookie или, для клиентов без cookie (Basic auth, токены),
+    по отметке последней записи пользователя. Отметки других воркеров фоновый поток загружает
+    раз в REPLICA_PIN_REFRESH, так что чтение с реплики основную базу не запрашивает
+    """
+    until, _, signature = request.cookies.get(PIN_COOKIE, '').partition(':')
+    if until.isdigit() and int(until) > time.time() and hmac.compare_digest(signature, sign_pin(until)):
+        return True
+    user = g.get('user')
+    if user is None:
+        return False
+    written = _pins.get(user.id)
+    pin = timedelta(seconds=current_app.config['REPLICA_PIN_SECONDS'])
+    return written is not None and written > datetime.utcnow() - pin
+
+
+def replica_read(view):
+    """
+    Читает с реплики, если она есть, здорова и клиент недавно ничего не писал
+    (иначе он мог бы не увидеть свою запись). В остальных случаях - основная база
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        binds = replica_binds()
+        if binds and _monitor_pid != os.getpid():
+            # процесс запущен без warm_up (flask run, тесты)
+            start_monitor(current_app._get_current_object())
+        if binds and not is_pinned():
+            healthy = [bind for bind in binds if is_healthy(bind)]
+            if healthy:
+                g.replica_engine = db.get_engine(bind=random.choice(healthy))
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.pop('replica_engine', None)
+    return wrapper
+
+
+@contextmanager
+def primary():
+    """
+    Чтения внутри блока идут в основную базу, даже если запрос выбрал реплику
+    """
+    engine = g.pop('replica_engine', None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if engine is not None:
+            g.replica_engine = engine
+
+
+def from_primary(loader):
+    """
+    loader общего кэша процесса, читающий основную базу: кэш живет дольше запроса,
+    и данные отставшей реплики остались бы в нем на весь ttl
+    """
+    @wraps(loader)
+    def wrapper(*args):
+        with primary():
+            return list(loader(*args))
+    return wrapper
+
+
+def pin_primary(response):
+    if request.method not in SAFE_METHODS and response.status_code < 400 and replica_binds():
+        from api.models.version import ResourceVersionModel
+
+        pin = current_app.config['REPLICA_PIN_SECONDS']
+        until = str(int(time.time()) + pin)
+        response.set_cookie(PIN_COOKIE, f"{until}:{sign_pin(until)}", max_age=pin, httponly=True)
+        if g.get('user') is not None:
+            # этот процесс видит запись сразу, остальные воркеры - после очередного refresh_pins
+            ResourceVersionModel.bump(pin_key(g.user.id))
+            db.session.commit()
+            with _lock:
+                _pins[g.user.id] = datetime.utcnow()
+    return response
+
+
+def init_app(app):
+    app.after_request(pin_primary)
@@ -1,4 +1,4 @@
-from api import Resource, api, auth, g
+from api import Resource, api, auth, credential_cache, g
 
 
 @api.resource('/auth/token')
@@ -7,3 +7,20 @@ class TokenResource(Resource):
     def get(self):
         token = g.user.generate_auth_token()
         return {'token': token.decode('ascii')}
+
+    @auth.login_required
+    def delete(self):
+        from api.models.user import UserModel
+
+        # logout: все выданные пользователю токены перестают действовать
+        user = UserModel.query.get(g.user.id)
+        user.revoke_tokens()
+        user.save()
+        return {}, 204
+
+
+@api.resource('/auth/cache')
+class AuthCacheResource(Resource):
+    @auth.login_required(role="admin")
+    def get(self):
+        return credential_cache.stats()
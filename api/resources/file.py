@@ -1,14 +1,26 @@
+import fcntl
+import hashlib
 import os
+import shutil
 
+from flask import current_app, request
 from flask_apispec import doc, marshal_with, use_kwargs
 from flask_apispec.views import MethodResource
+from flask_babel import gettext
 from marshmallow import fields
+from werkzeug.http import parse_content_range_header
+from werkzeug.utils import secure_filename
 
-from api import api
+from api import abort, api, thumbnailer
 from api.models.file import FileModel
-from api.schemas.file import FileSchema
+from api.models.upload import UploadSessionModel
+from api.schemas.file import (FileSchema, UploadCompleteSchema,
+                              UploadSessionCreateSchema, UploadSessionSchema)
 from config import Config, ma_plugin
 
+# чтение тела запроса и файла кусками, чтобы память не зависела от размера загрузки
+BUFFER_SIZE = 64 * 1024
+
 
 @ma_plugin.map_to_openapi_type('file', None)
 class FileField(fields.Raw):
@@ -18,13 +30,146 @@ class FileField(fields.Raw):
 @doc(tags=['Files'])
 @api.resource('/upload')
 class UploadPictureResource(MethodResource):
+    @doc(description=f'Upload a file in one multipart request, at most {Config.UPLOAD_MAX_SIZE} bytes. '
+                     'Use /upload/sessions for large files')
     @use_kwargs({"image": FileField(required=True)}, location="files")
     @marshal_with(FileSchema, code=201)
     def put(self, **kwargs):
         uploaded_file = kwargs["image"]
-        target = os.path.join(Config.UPLOAD_FOLDER, uploaded_file.filename)
+        target = os.path.join(current_app.config['UPLOAD_FOLDER'], uploaded_file.filename)
         uploaded_file.save(target)
-        url = os.path.join(Config.UPLOAD_FOLDER_NAME, uploaded_file.filename)
+        url = os.path.join(current_app.config['UPLOAD_FOLDER_NAME'], uploaded_file.filename)
         file = FileModel(url=url)
         file.save()
+        thumbnailer.submit(file)
+        return file, 201
+
+
+def get_session(session_id):
+    session = UploadSessionModel.query.get(session_id)
+    if not session:
+        abort(404, error=gettext("Upload session %(session_id)s not found", session_id=session_id))
+    return session
+
+
+def lock(file):
+    """
+    Эксклюзивная блокировка файла части: одну загрузку одновременно пишет только один запрос
+    """
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        abort(409, error=gettext("Upload is in progress"))
+
+
+@doc(tags=['Files'])
+@api.resource('/upload/sessions')
+class UploadSessionsResource(MethodResource):
+    @doc(summary="Start chunked upload",
+         description=f'Start a resumable upload of a file up to {Config.UPLOAD_MAX_SIZE} bytes. '
+                     'Then PUT byte ranges to the session and POST to complete')
+    @use_kwargs(UploadSessionCreateSchema, location='json')
+    @marshal_with(UploadSessionSchema, code=201)
+    def post(self, filename, size, sha256=None):
+        max_size = current_app.config['UPLOAD_MAX_SIZE']
+        if size > max_size:
+            abort(413, error=gettext("File is larger than %(size)s bytes", size=max_size))
+        UploadSessionModel.delete_expired()
+        session = UploadSessionModel(filename=filename, size=size, sha256=sha256)
+        session.save()
+        return session, 201
+
+
+@doc(tags=['Files'])
+@api.resource('/upload/sessions/<session_id>')
+class UploadSessionResource(MethodResource):
+    @doc(summary="Get upload state", description='Offset is the number of bytes received, resume from it')
+    @marshal_with(UploadSessionSchema, code=200)
+    def get(self, session_id):
+        return get_session(session_id), 200
+
+    @doc(summary="Upload chunk",
+         description=f'Body is raw bytes of the range from the Content-Range header '
+                     f'("bytes start-end/size"), start must be equal to the current offset. '
+                     f'At most {Config.UPLOAD_MAX_CHUNK} bytes per request')
+    @marshal_with(UploadSessionSchema, code=200)
+    def put(self, session_id):
+        session = get_session(session_id)
+        content_range = parse_content_range_header(request.headers.get('Content-Range'))
+        if content_range is None or content_range.units != 'bytes' or content_range.length != session.size:
+            abort(400, error=gettext("Content-Range must be \"bytes start-end/%(size)s\"", size=session.size))
+        length = content_range.stop - content_range.start
+        max_chunk = current_app.config['UPLOAD_MAX_CHUNK']
+        if length > max_chunk:
+            abort(413, error=gettext("Chunk is larger than %(size)s bytes", size=max_chunk))
+        if request.content_length is not None and request.content_length != length:
+            abort(400, error=gettext("Content-Length does not match Content-Range"))
+        try:
+            # без O_CREAT: часть создается вместе с сессией, а если ее уже нет - сессию завершили или отменили
+            file = os.fdopen(os.open(session.path, os.O_WRONLY | os.O_APPEND), 'ab')
+        except FileNotFoundError:
+            abort(409, error=gettext("Upload is already completed"))
+        with file:
+            lock(file)
+            offset = file.seek(0, os.SEEK_END)
+            if content_range.start != offset:
+                abort(409, error=gettext("Upload offset is %(offset)s", offset=offset))
+            # пишем по мере получения: если соединение оборвется, принятое останется и смещение его учтет
+            remaining = length
+            while remaining:
+                chunk = request.stream.read(min(BUFFER_SIZE, remaining))
+                if not chunk:
+                    break
+                file.write(chunk)
+                remaining -= len(chunk)
+        return session, 200
+
+    @doc(summary="Cancel upload")
+    def delete(self, session_id):
+        get_session(session_id).delete()
+        return '', 204
+
+
+@doc(tags=['Files'])
+@api.resource('/upload/sessions/<session_id>/complete')
+class UploadCompleteResource(MethodResource):
+    @doc(summary="Complete chunked upload",
+         description='Checks SHA-256 of the received file (from this request or from the session) '
+                     'and creates the file')
+    @use_kwargs(UploadCompleteSchema, location='json')
+    @marshal_with(FileSchema, code=201)
+    def post(self, session_id, sha256=None):
+        session = get_session(session_id)
+        expected = (sha256 or session.sha256 or '').lower()
+        if not expected:
+            abort(400, error=gettext("SHA-256 of the file is required"))
+        try:
+            file = open(session.path, 'rb')
+        except FileNotFoundError:
+            # параллельный complete уже перенес файл
+            abort(409, error=gettext("Upload is already completed"))
+        with file:
+            lock(file)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: file.read(BUFFER_SIZE), b''):
+                digest.update(chunk)
+            received = file.tell()
+            if received != session.size:
+                abort(409, error=gettext("Upload is incomplete: %(offset)s of %(size)s bytes",
+                                         offset=received, size=session.size))
+            if digest.hexdigest() != expected:
+                session.delete()
+                abort(400, error=gettext("Checksum mismatch, upload is discarded"))
+            path = session.path
+            filename = secure_filename(session.filename) or 'upload'
+            folder = current_app.config['UPLOAD_FOLDER']
+            if os.path.exists(os.path.join(folder, filename)):
+                filename = f"{session.id}_{filename}"
+            # завершает только один запрос: тот, кто удалил строку сессии
+            if not session.claim():
+                abort(409, error=gettext("Upload is already completed"))
+            shutil.move(path, os.path.join(folder, filename))
+        file = FileModel(url=os.path.join(current_app.config['UPLOAD_FOLDER_NAME'], filename))
+        file.save()
+        thumbnailer.submit(file)
         return file, 201
@@ -1,15 +1,42 @@
+import json
+
+from flask import Response, current_app, request, stream_with_context
 from flask_apispec import doc, marshal_with, use_kwargs
 from flask_apispec.views import MethodResource
 from flask_babel import gettext
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm.exc import NoResultFound
-from webargs import fields
+from webargs import fields, validate
 
-from api import abort, api, auth, g
+from api import Message, abort, api, auth, db, g, mail_dispatcher, tag_cache, tag_index
+from api.cache import Bitmap
+from api.conditional import conditional
+from api.exporter import export_notes
+from api.importer import import_notes
 from api.models.note import NoteModel
 from api.models.tag import TagModel
-from api.schemas.note import (NoteCreateSchema, NoteEditSchema,
+from api.models.user import UserModel
+from api.pagination import paginate, paginate_ids, paginate_ranked
+from api.replica import from_primary, replica_read
+from api.schemas.note import (NoteBulkTagsResponseSchema, NoteBulkTagsSchema,
+                              NoteCreateSchema, NoteEditSchema,
                               NoteFilterSchema, NoteFilterTagsSchema,
-                              NoteSchema)
+                              NotePageSchema, NoteSchema,
+                              NoteSearchPageSchema)
+from api.schemas.pagination import PaginationSchema
+from api.search import search_notes
+
+
+def notify_published(note):
+    """
+    Письмо администраторам о том, что заметка стала публичной; отправляется в фоне
+    """
+    if not current_app.config['MAIL_NOTIFICATIONS']:
+        return
+    admins = current_app.config['ADMINS']
+    message = Message(f"Note {note.id} is public now", sender=admins[0], recipients=admins)
+    message.body = f"User {note.author_id} made note {note.id} public:\n\n{note.text}"
+    mail_dispatcher.send(message)
 
 
 @doc(tags=['Note'])
@@ -17,11 +44,15 @@ from api.schemas.note import (NoteCreateSchema, NoteEditSchema,
 class NoteResource(MethodResource):
     @auth.login_required
     @doc(summary="Get Note by id", description='Get note by id', security=[{"basicAuth": []}])
+    @doc(responses={304: {"description": "Not modified"}})
     @marshal_with(NoteSchema, code=200)
+    @conditional('note:{note_id}', 'users', 'tags', per_user=True,
+                 readable=lambda note_id: NoteModel.is_visible(g.user, note_id))
     def get(self, note_id):
         author = g.user
         try:
-            note = NoteModel.get_all_for_user(author).filter_by(id=note_id).one()
+            note = NoteModel.get_all_for_user(author).options(*NoteModel.detail_options()) \
+                .filter_by(id=note_id).one()
             return note, 200
         except NoResultFound:
             abort(404, error=gettext("Note with id %(note_id)s not found", note_id=note_id))
@@ -35,14 +66,17 @@ class NoteResource(MethodResource):
         note = NoteModel.query.get(note_id)
         if not note:
             abort(404, error=gettext("Note with id %(note_id)s not found", note_id=note_id))
-        if note.author != author:
+        if note.author_id != author.id:
             abort(403, error=f"Forbidden")
         if kwargs.get("text") is not None:
             note.text = kwargs.get("text")
+        published = note.private and kwargs.get("private") is False
         if kwargs.get("private") is not None:
             note.private = kwargs.get("private")
         note.save()
-        return note, 200
+        if published:
+            notify_published(note)
+        return NoteModel.get_detailed(note.id), 200
 
     @auth.login_required
     @doc(summary="Move Note by id to archive", description='Move Note by id to archive', security=[{"basicAuth": []}])
@@ -50,12 +84,12 @@ class NoteResource(MethodResource):
     def delete(self, note_id):
         author = g.user
         note = NoteModel.query.get(note_id)
-        if note.author != author:
-            abort(403, error=f"Forbidden")
         if not note:
             abort(404, error=gettext("Note with id %(note_id)s not found", note_id=note_id))
+        if note.author_id != author.id:
+            abort(403, error=f"Forbidden")
         note.archivated()
-        return note, 200
+        return NoteModel.get_detailed(note.id), 200
 
 
 @doc(tags=['Note'])
@@ -63,18 +97,26 @@ class NoteResource(MethodResource):
 class NotesListResource(MethodResource):
     @auth.login_required
     @doc(summary="Get notes list", security=[{"basicAuth": []}])
-    @marshal_with(NoteSchema(many=True), code=200)
+    @marshal_with(NotePageSchema, code=200)
     @use_kwargs(NoteFilterSchema, location='query')
-    def get(self, **kwargs):
+    @replica_read
+    def get(self, limit, after=None, **kwargs):
         author = g.user
-        notes = NoteModel.get_all_for_user(author)
+        notes = NoteModel.get_all_for_user(author).options(*NoteModel.list_options())
+        bitmap = None
         if kwargs.get('tag') is not None:
-            notes = notes.filter(NoteModel.tags.any(name=kwargs['tag']))
+            tag_id = tag_cache.get_ids([kwargs['tag']], from_primary(TagModel.get_ids)).get(kwargs['tag'])
+            bitmap = tag_index.select(from_primary(NoteModel.get_tag_pairs), all_of=[tag_id]) if tag_id else Bitmap()
+            condition = NoteModel.tags_filter(all_of=[tag_id])
         if kwargs.get('private') is not None:
             notes = notes.filter_by(private=kwargs['private'])
         if kwargs.get('username') is not None:
-            notes = notes.filter(NoteModel.author.has(username=kwargs['username']))
-        return notes, 200
+            # id автора подзапросом, а не EXISTS на каждую строку: так работает индекс по author_id
+            notes = notes.filter(NoteModel.author_id == UserModel.query.with_entities(UserModel.id)
+                                 .filter_by(username=kwargs['username']).as_scalar())
+        if bitmap is not None:
+            return paginate_ids(notes, NoteModel.id, bitmap, condition, limit, after), 200
+        return paginate(notes, NoteModel.id, limit, after, branches=NoteModel.visibility(author)), 200
 
     @auth.login_required
     @doc(summary="Post Note", description='Create note', security=[{"basicAuth": []}])
@@ -84,7 +126,9 @@ class NotesListResource(MethodResource):
         author = g.user
         note = NoteModel(author_id=author.id, **kwargs)
         note.save()
-        return note, 201
+        if not note.private:
+            notify_published(note)
+        return NoteModel.get_detailed(note.id), 201
 
 
 @doc(tags=['Note extra options'])
@@ -100,10 +144,10 @@ class NoteRestoreResource(MethodResource):
             abort(404, error=gettext("Note with id %(note_id)s not found", note_id=note_id))
         if not note.archive:
             return {}, 304
-        if note.author != author:
+        if note.author_id != author.id:
             abort(403, error=f"Forbidden")
         note.restore()
-        return note, 200
+        return NoteModel.get_detailed(note.id), 200
 
 
 @doc(tags=['Note extra options'])
@@ -116,17 +160,19 @@ class NoteTagsResource(MethodResource):
     def put(self, note_id, **kwargs):
         author = g.user
         note = NoteModel.query.get(note_id)
-        if note.author != author:
-            abort(403, error=f"Forbidden")
         if not note:
             abort(404, error=gettext("Note with id %(note_id)s not found", note_id=note_id))
+        if note.author_id != author.id:
+            abort(403, error=f"Forbidden")
+        # по базе, а не по кэшу: тег мог удалить другой воркер; строки тегов заблокированы до коммита
+        names = dict(TagModel.lock(kwargs["tags"]))
         for tag_id in kwargs["tags"]:
-            tag = TagModel.query.get(tag_id)
-            if not tag:
+            if tag_id not in names:
                 abort(404, error=gettext("Tag with id %(tag_id)s not found", tag_id=tag_id))
-            note.tags.append(tag)
-        note.save()
-        return note, 200
+        NoteModel.bulk_update_tags([note.id], add=kwargs["tags"])
+        for tag_id in kwargs["tags"]:
+            tag_index.add(tag_id, note.id)
+        return NoteModel.get_detailed(note.id), 200
 
     @auth.login_required
     @doc(summary="Delete tags from Note", description='Delete tags to Note', security=[{"basicAuth": []}])
@@ -134,32 +180,39 @@ class NoteTagsResource(MethodResource):
     @marshal_with(NoteSchema, code=200)
     def delete(self, note_id, **kwargs):
         author = g.user
-        note = NoteModel.query.get(note_id)
+        note = NoteModel.query.options(selectinload(NoteModel.tags)).filter_by(id=note_id).first()
         if not note:
             abort(404, error=gettext("Note with id %(note_id)s not found", note_id=note_id))
         if not set(kwargs['tags']) <= set([el.id for el in note.tags]):
             abort(400, error=gettext("List of tag ids not match to note with id %(note_id)s", note_id=note_id))
-        if note.author != author:
+        if note.author_id != author.id:
             abort(403, error=f"Forbidden")
+        NoteModel.bulk_update_tags([note.id], remove=kwargs["tags"])
         for tag_id in kwargs["tags"]:
-            tag = TagModel.query.get(tag_id)
-            note.tags.remove(tag)
-        note.save()
-        return note, 200
+            tag_index.remove(tag_id, note.id)
+        return NoteModel.get_detailed(note.id), 200
 
 
 @doc(tags=['Note extra options'])
 @api.resource('/notes/like')
 class NoteTexResource(MethodResource):
     @auth.login_required
-    @doc(summary="Find notes with text", description='Find notes with text', security=[{"basicAuth": []}])
+    @doc(summary="Find notes with text",
+         description='Full-text search by words, "word*" for prefix search. Sorted by relevance',
+         security=[{"basicAuth": []}])
     @use_kwargs({"text": fields.String(load_default="")}, location='query')
-    @marshal_with(NoteSchema(many=True), code=200)
-    def get(self, text):
+    @use_kwargs(PaginationSchema, location='query')
+    @marshal_with(NoteSearchPageSchema, code=200)
+    @replica_read
+    def get(self, text, limit, after=None):
         author = g.user
-        if text:
-            notes = NoteModel.get_all_for_user(author).filter(NoteModel.text.like(f"%{text}%"))
-            return notes, 200
+        notes, rank = search_notes(NoteModel.get_all_for_user(author).options(*NoteModel.list_options()), text)
+        if notes is not None:
+            page = paginate_ranked(notes, rank, NoteModel.id, limit, after)
+            for note, _, snippet in page['items']:
+                note.snippet = snippet
+            page['items'] = [row[0] for row in page['items']]
+            return page, 200
         abort(400, error=gettext("Need key to search"))
 
 
@@ -168,13 +221,95 @@ class NoteTexResource(MethodResource):
 class NoteFilterTagsResource(MethodResource):
     @auth.login_required
     @doc(summary="Get user's notes by list tag's id",
-         description="Get user's notes by list tag's id", security=[{"basicAuth": []}])
-    @marshal_with(NoteSchema(many=True), code=200)
+         description="Get user's notes that have all tags from all_of, any tag from any_of (or tags) "
+                     "and no tags from none_of", security=[{"basicAuth": []}])
+    @marshal_with(NotePageSchema, code=200)
     @use_kwargs(NoteFilterTagsSchema, location='query')
-    def get(self, **kwargs):
+    def get(self, limit, after=None, **kwargs):
         author = g.user
-        notes = NoteModel.get_all_for_user(author)
-        if kwargs.get("tags") is not None:
-            notes = notes.filter(NoteModel.tags.any(TagModel.id.in_(kwargs['tags']))).all()
-            return notes, 200
-        abort(400, error=gettext("Need key to search"))
+        all_of = kwargs.get("all_of", [])
+        any_of = kwargs.get("any_of", []) + kwargs.get("tags", [])
+        none_of = kwargs.get("none_of", [])
+        if not (all_of or any_of or none_of):
+            abort(400, error=gettext("Need key to search"))
+        notes = NoteModel.get_all_for_user(author).options(*NoteModel.list_options())
+        bitmap = tag_index.select(from_primary(NoteModel.get_tag_pairs), all_of, any_of, none_of)
+        if bitmap is None:
+            # только none_of: всех заметок индекс не знает, исключаем теги в запросе
+            notes = notes.filter(~NoteModel.tags.any(TagModel.id.in_(none_of)))
+            return paginate(notes, NoteModel.id, limit, after, branches=NoteModel.visibility(author)), 200
+        condition = NoteModel.tags_filter(all_of, any_of, none_of)
+        return paginate_ids(notes, NoteModel.id, bitmap, condition, limit, after), 200
+
+
+@doc(tags=['Note extra options'])
+@api.resource('/notes/tags/bulk')
+class NotesBulkTagsResource(MethodResource):
+    @auth.login_required
+    @doc(summary="Add and delete tags for many Notes",
+         description="Add tags from add and delete tags from remove for every note from note_ids "
+                     "in one transaction. Returns status per note: ok, not_found or forbidden",
+         security=[{"basicAuth": []}])
+    @use_kwargs(NoteBulkTagsSchema, location='json')
+    @marshal_with(NoteBulkTagsResponseSchema, code=200)
+    def post(self, note_ids, add, remove):
+        author = g.user
+        if set(add) & set(remove):
+            abort(400, error=gettext("Tags can not be added and deleted at the same time"))
+        tag_ids = set(add) | set(remove)
+        found_tag_ids = {tag_id for tag_id, name in TagModel.lock(tag_ids)}
+        if tag_ids - found_tag_ids:
+            abort(404, error=gettext("Tag with id %(tag_id)s not found", tag_id=min(tag_ids - found_tag_ids)))
+        authors = dict(db.session.query(NoteModel.id, NoteModel.author_id).filter(NoteModel.id.in_(note_ids)))
+        results = []
+        own_note_ids = []
+        for note_id in note_ids:
+            if note_id not in authors:
+                status = "not_found"
+            elif authors[note_id] != author.id:
+                status = "forbidden"
+            else:
+                status = "ok"
+                own_note_ids.append(note_id)
+            results.append({"note_id": note_id, "status": status})
+        if own_note_ids:
+            NoteModel.bulk_update_tags(own_note_ids, add, remove)
+            for note_id in own_note_ids:
+                for tag_id in add:
+                    tag_index.add(tag_id, note_id)
+                for tag_id in remove:
+                    tag_index.remove(tag_id, note_id)
+        return {"results": results}, 200
+
+
+@doc(tags=['Note extra options'])
+@api.resource('/notes/import')
+class NotesImportResource(MethodResource):
+    @auth.login_required
+    @doc(summary="Import Notes from NDJSON",
+         description='Body is NDJSON: one {"text": ..., "private": ..., "tags": [tag names]} object per line. '
+                     'Response is NDJSON with the result for every line, streamed as notes are written',
+         consumes=['application/x-ndjson'], produces=['application/x-ndjson'],
+         security=[{"basicAuth": []}])
+    def post(self):
+        author_id = g.user.id
+        results = import_notes(request.stream, author_id, current_app.config['IMPORT_BATCH_SIZE'],
+                               current_app.config['IMPORT_MAX_LINE'])
+        lines = (json.dumps(result, ensure_ascii=False) + '\n' for result in results)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
+@doc(tags=['Note extra options'])
+@api.resource('/notes/export')
+class NotesExportResource(MethodResource):
+    @auth.login_required
+    @doc(summary="Export user's Notes",
+         description="All notes of the user, archived included, streamed as NDJSON or as a JSON array",
+         produces=['application/x-ndjson', 'application/json'], security=[{"basicAuth": []}])
+    @use_kwargs({"format": fields.String(load_default="ndjson", validate=validate.OneOf(["ndjson", "json"]))},
+                location='query')
+    def get(self, format):
+        author_id = g.user.id
+        mimetype = 'application/x-ndjson' if format == 'ndjson' else 'application/json'
+        notes = export_notes(author_id, current_app.config['EXPORT_BATCH_SIZE'], format)
+        return Response(stream_with_context(notes), mimetype=mimetype)
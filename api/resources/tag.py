@@ -3,9 +3,11 @@ from flask_apispec.views import MethodResource
 from flask_babel import gettext
 from webargs import fields
 
-from api import abort, api, auth
+from api import abort, api, auth, tag_cache, tag_index
+from api.conditional import conditional
 from api.models.tag import TagModel
-from api.schemas.tag import TagSchema
+from api.replica import from_primary, primary, replica_read
+from api.schemas.tag import TagListSchema, TagSchema
 
 
 @doc(tags=['Tags'])
@@ -14,10 +16,10 @@ class TagsResource(MethodResource):
     @marshal_with(TagSchema, code=200)
     @doc(summary="Get tag by tag id", description='Get tags by tag id')
     def get(self, tag_id):
-        tag = TagModel.query.get(tag_id)
-        if not tag:
+        names = tag_cache.get_names([tag_id], from_primary(TagModel.get_names))
+        if tag_id not in names:
             abort(404, error=gettext("Tag with id %(tag_id)s not found", tag_id=tag_id))
-        return tag, 200
+        return {"id": tag_id, "name": names[tag_id]}, 200
 
     @auth.login_required(role="admin")
     @doc(summary="Edit tag by tag id", description='Edit tags by id', security=[{"basicAuth": []}])
@@ -38,6 +40,7 @@ class TagsResource(MethodResource):
         tag = TagModel.query.get(tag_id)
         if tag:
             tag.delete()
+            tag_index.drop_tag(tag_id)
             return tag, 200
         abort(404, error=gettext("Tag with id %(tag_id)s not found", tag_id=tag_id))
 
@@ -45,13 +48,25 @@ class TagsResource(MethodResource):
 @doc(tags=['Tags'])
 @api.resource('/tags')
 class TagsListResource(MethodResource):
-    @doc(summary="Get all tags", description='Get all tags')
+    @doc(summary="Get all tags", description='Get all tags, sort=popular - top limit tags by note count')
+    @doc(responses={304: {"description": "Not modified"}})
     @marshal_with(TagSchema(many=True), code=200)
-    def get(self):
-        tags = TagModel.query.all()
+    @use_kwargs(TagListSchema, location='query')
+    @replica_read
+    def get(self, sort, limit):
+        if sort == 'popular':
+            # счетчики меняются с каждой заметкой, версии 'tags' они не касаются - без ETag
+            return TagModel.get_popular(limit).all(), 200
+        # справочник целиком из кэша процесса, он и его ETag читаются в основной базе
+        with primary():
+            return self.get_catalogue()
+
+    @conditional('tags')
+    def get_catalogue(self):
+        tags = tag_cache.all(from_primary(TagModel.get_catalogue))
         if not tags:
             abort(404, error=gettext("Tags not found"))
-        return tags, 200
+        return [{"id": id, "name": name} for id, name in tags], 200
 
     @doc(summary="Create tags", description='Create tags')
     @use_kwargs({"name": fields.Str()})
@@ -1,24 +1,33 @@
 import logging
 
+from flask import current_app
 from flask_apispec import doc, marshal_with, use_kwargs
 from flask_apispec.views import MethodResource
 from flask_babel import gettext
 from webargs import fields
 
 from api import abort, api, auth, g
+from api.conditional import conditional
 from api.models.file import FileModel
 from api.models.user import UserModel
+from api.pagination import paginate
+from api.replica import replica_read
+from api.schemas.pagination import PaginationSchema
 from api.schemas.user import (UserCreateSchema, UserEditSchema,
-                              UserPhotoSchema, UserSchema)
+                              UserPageSchema, UserPhotoSchema, UserSchema)
+from api.search import search_users
+from config import Config
 
 
 @doc(tags=['Users'])
 @api.resource('/users/<int:user_id>')
 class UserResource(MethodResource):
     @doc(summary="Get User by id", description='Get user by id')
+    @doc(responses={304: {"description": "Not modified"}})
     @marshal_with(UserSchema, code=200)
+    @conditional('user:{user_id}', readable=UserModel.exists)
     def get(self, user_id):
-        user = UserModel.query.get(user_id)
+        user = UserModel.get_detailed(user_id)
         if not user:
             abort(404, error=gettext("User with id %(user_id)s not found", user_id=user_id))
         return user, 200  # user_schema.dump(user) благодаря @marshal_with(UserSchema) теперь не нужен
@@ -30,14 +39,14 @@ class UserResource(MethodResource):
     def put(self, user_id, **kwargs):
         author = g.user
         user = UserModel.query.get(user_id)
-        if user != author:
+        if user_id != author.id:
             abort(403, error=f"Forbidden")
         if not user:
             abort(404, error=gettext("User with id %(user_id)s not found", user_id=user_id))
         if kwargs.get("username") is not None:
             user.username = kwargs["username"]
         user.save()
-        return user, 200
+        return UserModel.get_detailed(user.id), 200
 
     @auth.login_required(role="admin")
     @doc(summary="Delete User by id", description='Delete user by id.')
@@ -45,7 +54,7 @@ class UserResource(MethodResource):
     @doc(responses={404: {"description": "Not found"}})
     @marshal_with(UserSchema, code=200)
     def delete(self, user_id):
-        user = UserModel.query.get(user_id)
+        user = UserModel.get_detailed(user_id)
         if user:
             user.delete()
             return user, 200
@@ -56,10 +65,11 @@ class UserResource(MethodResource):
 @api.resource('/users')
 class UsersListResource(MethodResource):
     @doc(summary="Get Users", description='Get users')
-    @marshal_with(UserSchema(many=True), code=200)
-    def get(self):
-        users = UserModel.query.all()
-        return users, 200
+    @use_kwargs(PaginationSchema, location='query')
+    @marshal_with(UserPageSchema, code=200)
+    @replica_read
+    def get(self, limit, after=None):
+        return paginate(UserModel.query.options(*UserModel.detail_options()), UserModel.id, limit, after), 200
 
     @doc(summary="Create Users", description='Create users')
     @use_kwargs(UserCreateSchema, location='json')
@@ -75,7 +85,7 @@ class UsersListResource(MethodResource):
         if not user.id:
             abort(400, error=f"User with username:{user.username} already exist")
         logging.info("User create!!!")
-        return user, 201
+        return UserModel.get_detailed(user.id), 201
     # def post(self, **kwargs):
     #     user = UserModel(**kwargs)
     #     user.save()
@@ -93,12 +103,13 @@ class UserFindOrResource(MethodResource):
     @marshal_with(UserSchema(many=True), code=200)
     def get(self, **kwargs):
         if "username" and "username2" in kwargs:
-            users = UserModel.query.filter(
+            users = UserModel.query.options(*UserModel.detail_options()).filter(
                 (UserModel.username == kwargs["username"]) |
                 (UserModel.username == kwargs["username2"]))
             return users, 200
         if "username" in kwargs:
-            users = UserModel.query.filter(UserModel.username == kwargs["username"])
+            users = UserModel.query.options(*UserModel.detail_options()) \
+                .filter(UserModel.username == kwargs["username"])
             return users, 200
         abort(400, error=gettext("Need key to search"))
 
@@ -106,12 +117,13 @@ class UserFindOrResource(MethodResource):
 @doc(tags=['Users extra options'])
 @api.resource('/users/like')
 class UserFindLikeResource(MethodResource):
-    @doc(summary="Find users like ", description='Find users like')
+    @doc(summary="Find users like ",
+         description=f'Find users like, the most similar first, at most {Config.USER_SEARCH_LIMIT}')
     @use_kwargs({"username": fields.String(load_default="")}, location='query')
     @marshal_with(UserSchema(many=True), code=200)
     def get(self, username):
         if username:
-            users = UserModel.query.filter(UserModel.username.like(f"%{username}%"))
+            users = search_users(username, current_app.config['USER_SEARCH_LIMIT']).options(*UserModel.detail_options())
             return users, 200
         abort(400, error=gettext("Need key to search"))
 
@@ -126,9 +138,9 @@ class UserAddPhotoResource(MethodResource):
     def put(self, user_id, photo_id):
         author = g.user
         user = UserModel.query.get(user_id)
-        if user != author:
+        if user_id != author.id:
             abort(403, error=f"Forbidden")
         if photo_id is not None:
             user.photo_id = photo_id
         user.save()
-        return user, 200
+        return UserModel.get_detailed(user.id), 200
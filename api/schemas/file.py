@@ -1,8 +1,56 @@
+from flask import current_app
+from marshmallow import validate
+
 from api import ma
+from api.downloads import download_url
 from api.models.file import FileModel
+from api.models.upload import UploadSessionModel
+
+SHA256 = validate.Regexp(r'^[0-9a-fA-F]{64}$', error="Must be a hex SHA-256 digest")
 
 
 # Сериализация ответа(response)
 class FileSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = FileModel
+        exclude = ('derivatives',)
+
+    # {"64": url, "256": url}; пока копии не готовы - url оригинала
+    thumbnails = ma.Method('get_thumbnails')
+
+    # /uploads/<имя>?v=<версия>: неизменяемый адрес, кешируется клиентом навсегда
+    download = ma.Method('get_download')
+
+    def get_download(self, file):
+        return download_url(file.url)
+
+    def get_thumbnails(self, file):
+        derivatives = file.derivatives or {}
+        return {str(size): derivatives.get(str(size), file.url) for size in current_app.config['THUMBNAIL_SIZES']}
+
+
+class UploadSessionSchema(ma.SQLAlchemySchema):
+    class Meta:
+        model = UploadSessionModel
+
+    id = ma.auto_field()
+    filename = ma.auto_field()
+    size = ma.auto_field()
+    sha256 = ma.auto_field()
+    offset = ma.Integer()
+
+    _links = ma.Hyperlinks({
+        'self': ma.URLFor('uploadsessionresource', values=dict(session_id="<id>")),
+        'complete': ma.URLFor('uploadcompleteresource', values=dict(session_id="<id>")),
+    })
+
+
+# Десериализация запроса(request)
+class UploadSessionCreateSchema(ma.Schema):
+    filename = ma.String(required=True, validate=validate.Length(1, 255))
+    size = ma.Integer(required=True, validate=validate.Range(min=1))
+    sha256 = ma.String(validate=SHA256)
+
+
+class UploadCompleteSchema(ma.Schema):
+    sha256 = ma.String(validate=SHA256)
@@ -1,11 +1,28 @@
+from marshmallow import validate
+
 from api import ma
+from api.counters import COUNTERS
 from api.models.note import NoteModel
+from api.schemas.pagination import PaginationSchema
 from api.schemas.tag import TagSchema
 from api.schemas.user import UserSchema
+from config import Config
 
 #       schema        flask-restful
 # object ------>  dict ----------> json
 
+# автор и теги внутри заметки без счетчиков: они меняются с каждой заметкой автора,
+# а ETag заметки от них не зависит
+class NoteAuthorSchema(UserSchema):
+    class Meta(UserSchema.Meta):
+        exclude = COUNTERS
+
+
+class NoteTagSchema(TagSchema):
+    class Meta(TagSchema.Meta):
+        exclude = COUNTERS
+
+
 class NoteSchema(ma.SQLAlchemySchema):
     class Meta:
         model = NoteModel
@@ -14,8 +31,8 @@ class NoteSchema(ma.SQLAlchemySchema):
     text = ma.auto_field()
     private = ma.auto_field()
     archive = ma.auto_field()
-    author = ma.Nested(UserSchema())
-    tags = ma.Nested(TagSchema(many=True))
+    author = ma.Nested(NoteAuthorSchema())
+    tags = ma.Nested(NoteTagSchema(many=True))
 
     _links = ma.Hyperlinks({
         'self': ma.URLFor('noteresource', values=dict(note_id="<id>")),
@@ -23,6 +40,20 @@ class NoteSchema(ma.SQLAlchemySchema):
     })
 
 
+class NotePageSchema(ma.Schema):
+    items = ma.Nested(NoteSchema(many=True))
+    next = ma.String(allow_none=True)
+
+
+class NoteSearchSchema(NoteSchema):
+    snippet = ma.String()
+
+
+class NoteSearchPageSchema(ma.Schema):
+    items = ma.Nested(NoteSearchSchema(many=True))
+    next = ma.String(allow_none=True)
+
+
 class NoteCreateSchema(ma.SQLAlchemySchema):
     class Meta:
         model = NoteModel
@@ -40,12 +71,30 @@ class NoteEditSchema(ma.SQLAlchemySchema):
     private = ma.auto_field(required=False)
 
 
-class NoteFilterSchema(ma.SQLAlchemySchema):
+class NoteFilterSchema(PaginationSchema):
     private = ma.Bool(required=False)
     tag = ma.String(required=False)
     username = ma.Str(required=False)
 
 
-class NoteFilterTagsSchema(ma.SQLAlchemySchema):
+class NoteFilterTagsSchema(PaginationSchema):
     private = ma.Boolean(required=False)
-    tags = ma.List(ma.String())
+    tags = ma.List(ma.Integer())
+    all_of = ma.List(ma.Integer())
+    any_of = ma.List(ma.Integer())
+    none_of = ma.List(ma.Integer())
+
+
+class NoteBulkTagsSchema(ma.Schema):
+    note_ids = ma.List(ma.Integer(), required=True, validate=validate.Length(min=1, max=Config.BULK_TAGS_LIMIT))
+    add = ma.List(ma.Integer(), load_default=[])
+    remove = ma.List(ma.Integer(), load_default=[])
+
+
+class NoteBulkTagsResultSchema(ma.Schema):
+    note_id = ma.Integer()
+    status = ma.String()
+
+
+class NoteBulkTagsResponseSchema(ma.Schema):
+    results = ma.Nested(NoteBulkTagsResultSchema(many=True))
@@ -0,0 +1,10 @@
+from marshmallow import validate
+
+from api import ma
+from config import Config
+
+
+# Десериализация запроса(request)
+class PaginationSchema(ma.Schema):
+    limit = ma.Integer(load_default=Config.PAGE_SIZE, validate=validate.Range(min=1, max=Config.MAX_PAGE_SIZE))
+    after = ma.String(required=False)
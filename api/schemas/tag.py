@@ -1,5 +1,8 @@
+from marshmallow import validate
+
 from api import ma
 from api.models.tag import TagModel
+from config import Config
 
 #       schema        flask-restful
 # object ------>  dict ----------> json
@@ -12,3 +15,13 @@ class TagSchema(ma.SQLAlchemySchema):
 
     id = ma.auto_field()
     name = ma.auto_field()
+    # счетчики есть только в ответе sort=popular: каталог и /tags/<id> отдаются из кэша имен
+    note_count = ma.auto_field(dump_only=True)
+    public_note_count = ma.auto_field(dump_only=True)
+    archived_note_count = ma.auto_field(dump_only=True)
+
+
+# Десериализация запроса(request)
+class TagListSchema(ma.Schema):
+    sort = ma.String(load_default='id', validate=validate.OneOf(['id', 'popular']))
+    limit = ma.Integer(load_default=Config.PAGE_SIZE, validate=validate.Range(min=1, max=Config.MAX_PAGE_SIZE))
@@ -17,6 +17,9 @@ class UserSchema(ma.SQLAlchemySchema):
     is_staff = ma.auto_field()
     role = ma.auto_field()
     photo = ma.Nested(FileSchema())
+    note_count = ma.auto_field(dump_only=True)
+    public_note_count = ma.auto_field(dump_only=True)
+    archived_note_count = ma.auto_field(dump_only=True)
     # photo_url = ma.auto_field()
 
     _links = ma.Hyperlinks({
@@ -25,6 +28,11 @@ class UserSchema(ma.SQLAlchemySchema):
     })
 
 
+class UserPageSchema(ma.Schema):
+    items = ma.Nested(UserSchema(many=True))
+    next = ma.String(allow_none=True)
+
+
 # Десериализация запроса(request)
 class UserCreateSchema(ma.SQLAlchemySchema):
     class Meta:
@@ -0,0 +1,159 @@
+import re
+
+from sqlalchemy import DDL, event, func, literal_column
+
+from api import db
+from api.models.note import NoteModel
+from api.models.user import UserModel
+
+# Полнотекстовый индекс по тексту заметок.
+# SQLite: FTS5 таблица с внешним контентом note_model, синхронизируется триггерами.
+# PostgreSQL: генерируемая колонка tsvector + GIN индекс.
+# Те же объекты создает миграция для существующих баз.
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5("
+    "text, content='note_model', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note_model BEGIN "
+    "INSERT INTO note_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note_model BEGIN "
+    "INSERT INTO note_fts(note_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE OF text ON note_model BEGIN "
+    "INSERT INTO note_fts(note_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO note_fts(rowid, text) VALUES (new.id, new.text); END",
+]
+SQLITE_DROP = [
+    "DROP TABLE IF EXISTS note_fts",
+]
+POSTGRESQL_CREATE = [
+    "ALTER TABLE note_model ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_note_model_search_vector ON note_model USING gin (search_vector)",
+]
+
+for statement in SQLITE_CREATE:
+    event.listen(NoteModel.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in SQLITE_DROP:
+    event.listen(NoteModel.__table__, 'before_drop', DDL(statement).execute_if(dialect='sqlite'))
+for statement in POSTGRESQL_CREATE:
+    event.listen(NoteModel.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+HIGHLIGHT_START = '<b>'
+HIGHLIGHT_END = '</b>'
+
+
+def parse_terms(text):
+    """
+    Разбивает строку поиска на слова; слово со звездочкой на конце ищется по префиксу: "fla*"
+    """
+    return [(word, bool(star)) for word, star in re.findall(r'(\w+)(\*?)', text)]
+
+
+def search_notes(query, text):
+    """
+    Добавляет к запросу заметок полнотекстовый фильтр.
+    Возвращает (query, rank): строки запроса - (NoteModel, rank, snippet),
+    rank упорядочен по возрастанию - чем меньше, тем релевантнее.
+    Если в строке поиска нет слов, возвращает (None, None)
+    """
+    terms = parse_terms(text)
+    if not terms:
+        return None, None
+    if db.engine.dialect.name == 'postgresql':
+        tsquery = func.to_tsquery('simple', ' & '.join(
+            f"{word}:*" if prefix else word for word, prefix in terms))
+        vector = literal_column('note_model.search_vector')
+        rank = -func.ts_rank_cd(vector, tsquery)
+        snippet = func.ts_headline('simple', NoteModel.text, tsquery,
+                                   f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords=20, MinWords=5')
+        query = query.filter(vector.op('@@')(tsquery))
+    else:
+        match = ' '.join(f'"{word}"*' if prefix else f'"{word}"' for word, prefix in terms)
+        fts = db.table('note_fts', db.column('rowid'))
+        rank = func.bm25(literal_column('note_fts'))
+        snippet = func.snippet(literal_column('note_fts'), 0, HIGHLIGHT_START, HIGHLIGHT_END, '…', 10)
+        query = query.join(fts, fts.c.rowid == NoteModel.id) \
+            .filter(literal_column('note_fts').op('MATCH')(match))
+    return query.add_columns(rank.label('rank'), snippet.label('snippet')), rank
+
+
+# Поиск пользователей по подстроке имени.
+# PostgreSQL: pg_trgm и GIN индекс, по нему работает ILIKE '%x%'.
+# SQLite: боковая таблица триграмм имени, заполняется событиями маппера UserModel
+# (в триггерах SQLite строку на триграммы не разбить).
+USER_SQLITE_CREATE = [
+    "CREATE TABLE IF NOT EXISTS user_trigram ("
+    "trigram VARCHAR(3) NOT NULL, user_id INTEGER NOT NULL, size INTEGER NOT NULL, "
+    "PRIMARY KEY (trigram, user_id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS ix_user_trigram_user_id ON user_trigram (user_id)",
+]
+USER_SQLITE_DROP = [
+    "DROP TABLE IF EXISTS user_trigram",
+]
+USER_POSTGRESQL_CREATE = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_user_model_username_trgm ON user_model USING gin (username gin_trgm_ops)",
+]
+
+for statement in USER_SQLITE_CREATE:
+    event.listen(UserModel.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in USER_SQLITE_DROP:
+    event.listen(UserModel.__table__, 'before_drop', DDL(statement).execute_if(dialect='sqlite'))
+for statement in USER_POSTGRESQL_CREATE:
+    event.listen(UserModel.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+user_trigram = db.table('user_trigram', db.column('trigram'), db.column('user_id'), db.column('size'))
+
+
+def trigrams(value):
+    value = value.lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def index_username(connection, user_id, username):
+    connection.execute(user_trigram.delete().where(user_trigram.c.user_id == user_id))
+    grams = trigrams(username or '')
+    if grams:
+        connection.execute(user_trigram.insert(),
+                           [{'trigram': gram, 'user_id': user_id, 'size': len(grams)} for gram in grams])
+
+
+@event.listens_for(UserModel, 'after_insert')
+def index_new_username(mapper, connection, user):
+    if connection.dialect.name == 'sqlite':
+        index_username(connection, user.id, user.username)
+
+
+@event.listens_for(UserModel, 'after_update')
+def reindex_username(mapper, connection, user):
+    if connection.dialect.name == 'sqlite' and db.inspect(user).attrs.username.history.has_changes():
+        index_username(connection, user.id, user.username)
+
+
+@event.listens_for(UserModel, 'after_delete')
+def unindex_username(mapper, connection, user):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(user_trigram.delete().where(user_trigram.c.user_id == user.id))
+
+
+def search_users(username, limit):
+    """
+    Пользователи, в имени которых есть подстрока username (без учета регистра),
+    самые похожие первыми, не больше limit
+    """
+    escaped = username.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    users = UserModel.query.filter(UserModel.username.ilike(f'%{escaped}%', escape='\\'))
+    if db.engine.dialect.name == 'postgresql':
+        return users.order_by(func.similarity(UserModel.username, username).desc(), UserModel.id).limit(limit)
+    grams = trigrams(username)
+    if not grams:
+        # короче трех символов индекс не поможет, ограничиваемся лимитом
+        return users.order_by(UserModel.id).limit(limit)
+    # кандидаты - пользователи со всеми триграммами запроса;
+    # похожесть (Жаккар) = len(grams) / size, поэтому сортируем по size
+    candidates = db.session.query(user_trigram.c.user_id, func.min(user_trigram.c.size).label('size')) \
+        .filter(user_trigram.c.trigram.in_(sorted(grams))) \
+        .group_by(user_trigram.c.user_id) \
+        .having(func.count() == len(grams)) \
+        .subquery()
+    return users.join(candidates, candidates.c.user_id == UserModel.id) \
+        .order_by(candidates.c.size, UserModel.id).limit(limit)
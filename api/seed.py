@@ -0,0 +1,122 @@
+import random
+import time
+from itertools import accumulate
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+
+from api import db
+from api.counters import recount
+from api.models.note import NoteModel, tags as note_tags
+from api.models.tag import TagModel
+from api.models.user import UserModel, pwd_context
+from api.search import SQLITE_CREATE, trigrams, user_trigram
+
+# словарь текстов заметок; частота слова падает с номером по Ципфу, lorem0 - самое частое
+WORDS = [f'lorem{number}' for number in range(1000)]
+WORDS_PER_NOTE = (5, 20)
+# триггер FTS на вставку: на время заливки снимаем, индекс потом строится одним rebuild
+FTS_INSERT_TRIGGER = 'note_fts_ai'
+
+
+def zipf_weights(count, skew):
+    """
+    Накопленные веса рангов 1..count с вероятностью ~ 1 / rank ** skew, skew=0 - равномерно
+    """
+    return list(accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def generate(connection, users, notes, tags, password='password', public_ratio=0.5, archived=0.05,
+             author_skew=1.0, tag_skew=1.0, max_tags=3, seed=0, batch=50000, progress=None):
+    """
+    Синтетические данные в пустую базу: пользователи user1..userN (пароль у всех password),
+    теги tag1..tagT, заметки с авторами и тегами по Ципфу.
+    Пишет пачками по batch строк через Core в переданном соединении (транзакция - у вызывающего).
+    Один и тот же seed дает одни и те же данные
+    """
+    rnd = random.Random(seed)
+    word_weights = zipf_weights(len(WORDS), 1.0)
+    author_ids, author_weights = range(1, users + 1), zipf_weights(users, author_skew)
+    tag_ids, tag_weights = range(1, tags + 1), zipf_weights(tags, tag_skew)
+    sqlite = connection.dialect.name == 'sqlite'
+
+    # хеш считается сотни миллисекунд, поэтому он один на всех
+    password_hash = pwd_context.hash(password)
+    for start in range(1, users + 1, batch):
+        rows = [{'id': id, 'username': f'user{id}', 'password_hash': password_hash, 'is_staff': False, 'role': '0'}
+                for id in range(start, min(start + batch, users + 1))]
+        connection.execute(UserModel.__table__.insert(), rows)
+        if sqlite:
+            connection.execute(user_trigram.insert(), [
+                {'trigram': gram, 'user_id': row['id'], 'size': len(grams)}
+                for row in rows for grams in [trigrams(row['username'])] for gram in grams])
+    if tags:
+        connection.execute(TagModel.__table__.insert(), [{'id': id, 'name': f'tag{id}'} for id in tag_ids])
+
+    if sqlite:
+        connection.execute(text(f'DROP TRIGGER IF EXISTS {FTS_INSERT_TRIGGER}'))
+    links = 0
+    for start in range(1, notes + 1, batch):
+        ids = range(start, min(start + batch, notes + 1))
+        authors = rnd.choices(author_ids, cum_weights=author_weights, k=len(ids))
+        connection.execute(NoteModel.__table__.insert(), [
+            {'id': id, 'author_id': author_id,
+             'text': ' '.join(rnd.choices(WORDS, cum_weights=word_weights, k=rnd.randint(*WORDS_PER_NOTE))),
+             'private': rnd.random() >= public_ratio, 'archive': rnd.random() < archived}
+            for id, author_id in zip(ids, authors)])
+        if tags and max_tags:
+            # повторы одного тега схлопываются, поэтому тегов у заметки бывает меньше выпавшего числа
+            rows = [{'note_model_id': id, 'tag_id': tag_id} for id in ids
+                    for tag_id in set(rnd.choices(tag_ids, cum_weights=tag_weights, k=rnd.randint(0, max_tags)))]
+            if rows:
+                connection.execute(note_tags.insert(), rows)
+            links += len(rows)
+        if progress:
+            progress(ids[-1], notes)
+    # счетчики заметок пользователей и тегов - одним пересчетом по готовым таблицам
+    recount(connection)
+    if sqlite:
+        connection.execute(text("INSERT INTO note_fts(note_fts) VALUES ('rebuild')"))
+        connection.execute(text(next(statement for statement in SQLITE_CREATE if FTS_INSERT_TRIGGER in statement)))
+    elif connection.dialect.name == 'postgresql':
+        # id задавались явно, последовательности сами не сдвинулись
+        for table in (UserModel.__table__, TagModel.__table__, NoteModel.__table__):
+            connection.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                                    f"(SELECT coalesce(max(id), 1) FROM {table.name}))"))
+    return {'users': users, 'tags': tags, 'notes': notes, 'note_tags': links}
+
+
+@click.command('seed')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--notes', default=100000, show_default=True)
+@click.option('--tags', default=200, show_default=True)
+@click.option('--password', default='password', show_default=True, help='Password of every generated user.')
+@click.option('--public-ratio', default=0.5, show_default=True, help='Fraction of public notes.')
+@click.option('--archived', default=0.05, show_default=True, help='Fraction of archived notes.')
+@click.option('--author-skew', default=1.0, show_default=True, help='Zipf exponent of notes per author, 0 - uniform.')
+@click.option('--tag-skew', default=1.0, show_default=True, help='Zipf exponent of tag popularity, 0 - uniform.')
+@click.option('--max-tags', default=3, show_default=True, help='Tags per note are uniform in 0..max-tags.')
+@click.option('--seed', default=0, show_default=True, help='Same seed - same data.')
+@click.option('--batch', default=50000, show_default=True, help='Rows per INSERT.')
+@click.option('--drop', is_flag=True, help='Drop and recreate all tables first.')
+@with_appcontext
+def seed_command(drop, **options):
+    """Fill the database with synthetic users, tags and notes."""
+    if drop:
+        db.drop_all()
+        db.create_all()
+    for model in (UserModel, TagModel, NoteModel):
+        if db.session.execute(select([func.count()]).select_from(model.__table__)).scalar():
+            raise click.ClickException(f'Table {model.__tablename__} is not empty, use --drop')
+    db.session.remove()
+
+    started = time.monotonic()
+
+    def progress(done, total):
+        click.echo(f'{done}/{total} notes, {time.monotonic() - started:.0f}s')
+
+    with db.engine.begin() as connection:
+        counts = generate(connection, progress=progress, **options)
+    click.echo(', '.join(f'{count} {name}' for name, count in counts.items()) +
+               f' in {time.monotonic() - started:.1f}s')
@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+
+def make_thumbnails(source, folder, stem, sizes, format, quality):
+    """
+    Уменьшенные копии картинки source со стороной не больше size, с сохранением пропорций.
+    Выполняется в процессе пула. Возвращает {size: имя файла в folder}
+    """
+    from PIL import Image, ImageOps
+
+    os.makedirs(folder, exist_ok=True)
+    names = {}
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        for size in sorted(sizes, reverse=True):
+            # каждую копию уменьшаем из предыдущей, большей: так быстрее
+            image.thumbnail((size, size), Image.LANCZOS)
+            name = f"{stem}_{size}.{format.lower()}"
+            image.save(os.path.join(folder, name), format, quality=quality)
+            names[size] = name
+    return names
+
+
+class Thumbnailer:
+    """
+    Фоновое построение уменьшенных копий загруженных картинок на пуле процессов,
+    чтобы ни декодирование, ни ресайз не занимали воркер во время запроса.
+    Одновременно в работе не больше max_pending файлов, лишние остаются без копий
+    (клиенты получают оригинал). Папки, размеры и формат копий берутся из настроек приложения,
+    от которого пришел файл
+    """
+
+    def __init__(self, workers=2, max_pending=100):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pid = None
+        self._pending = set()
+        self._lock = threading.Condition()
+
+    def init_app(self, app):
+        self.workers = app.config['THUMBNAIL_WORKERS']
+        self.max_pending = app.config['THUMBNAIL_MAX_PENDING']
+
+    def submit(self, file):
+        """
+        Ставит в очередь построение копий для FileModel file. False, если очередь переполнена
+        """
+        app = current_app._get_current_object()
+        config = app.config
+        file_id, name = file.id, os.path.basename(file.url)
+        source = os.path.join(config['UPLOAD_FOLDER'], name)
+        folder = os.path.join(config['UPLOAD_FOLDER'], config['THUMBNAIL_FOLDER_NAME'])
+        stem = f"{file_id}_{os.path.splitext(name)[0]}"
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                logger.warning("Thumbnail queue is full, %s left without thumbnails", file.url)
+                return False
+            future = self._get_executor().submit(make_thumbnails, source, folder, stem, config['THUMBNAIL_SIZES'],
+                                                 config['THUMBNAIL_FORMAT'], config['THUMBNAIL_QUALITY'])
+            self._pending.add(future)
+        future.add_done_callback(lambda future: self._save(app, file_id, future))
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Ждет, пока все поставленные копии будут построены и записаны в базу (для тестов и остановки)
+        """
+        with self._lock:
+            self._lock.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor, self._pid = self._executor, None, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _get_executor(self):
+        # пул не переживает fork: в новом процессе (воркере gunicorn) создаем свой
+        if self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._pending = set()
+            self._pid = os.getpid()
+        return self._executor
+
+    @staticmethod
+    def _set_derivatives(file_id, derivatives):
+        from api.models.file import FileModel
+
+        file = FileModel.query.get(file_id)
+        if file is not None:
+            file.set_derivatives(derivatives)
+
+    def _save(self, app, file_id, future):
+        try:
+            names = future.result()
+        except Exception as error:
+            # не картинка или битый файл - копий не будет, отдается оригинал
+            logger.warning("Thumbnails for file %s failed: %s", file_id, error)
+            names = {}
+        folder_url = '/'.join((app.config['UPLOAD_FOLDER_NAME'], app.config['THUMBNAIL_FOLDER_NAME']))
+        derivatives = {str(size): f"{folder_url}/{name}" for size, name in names.items()}
+        try:
+            # уже готовый future вызывает callback сразу, в потоке запроса: свой app_context
+            # при выходе закрыл бы сессию запроса
+            if has_app_context():
+                self._set_derivatives(file_id, derivatives)
+            else:
+                with app.app_context():
+                    self._set_derivatives(file_id, derivatives)
+        finally:
+            with self._lock:
+                self._pending.discard(future)
+                self._lock.notify_all()
@@ -0,0 +1,28 @@
+import hmac
+
+from flask import Response, current_app, render_template, request
+
+from api.downloads import send_upload
+from api.metrics import collect
+
+
+def main_page():
+    return render_template('index.html')
+
+
+def download_file(filename):
+    return send_upload(filename)
+
+
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                         f'Bearer {token}'.encode()):
+        return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'}, mimetype='text/plain')
+    return Response(collect(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.add_url_rule('/', view_func=main_page)
+    app.add_url_rule('/uploads/<path:filename>', view_func=download_file)
+    app.add_url_rule('/metrics', view_func=metrics)
@@ -0,0 +1,8 @@
+from api import warm_up
+from api.asgi import AsgiApp
+from app import app
+from config import Config
+
+# uvicorn asgi:application --workers 4
+application = AsgiApp(app, threads=Config.ASGI_THREADS, buffer_size=Config.ASGI_BUFFER_SIZE,
+                      max_body=Config.MAX_CONTENT_LENGTH, on_startup=[lambda: warm_up(app)])
@@ -0,0 +1,230 @@
+"""
+Горячие пути API на заполненной базе разных размеров.
+
+Для каждого размера создается свежая SQLite база с заметками, тегами и пользователями (api.seed),
+затем каждый сценарий гоняется через тестовый клиент Flask (без сети и сервера).
+Для сценария считаем операции в секунду, p50/p99 времени и SQL запросов на операцию.
+Результаты пишутся в JSON; с --baseline сравниваются с сохраненным прогоном,
+замедление p50 больше --threshold или рост числа запросов считаются регрессией (код выхода 1).
+
+    python benchmarks/api_hot_paths.py --sizes 1000 100000 --output benchmarks/results/run.json
+    python benchmarks/api_hot_paths.py --sizes 1000 100000 1000000 --baseline benchmarks/results/run.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from datetime import datetime
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TAGS = 200
+# sha512_crypt на каждой операции: столько же итераций, сколько у остальных, заняло бы минуты
+SLOW = {'verify_password': 10}
+# первый пользователь генератора; у него больше всего заметок (авторы распределены по Ципфу)
+USERNAME, PASSWORD = 'user1', 'bench'
+
+
+def setup_app(profile):
+    os.environ['APP_PROFILE'] = profile
+    sys.path.insert(0, base_dir)
+    from app import app
+    # лог SQL и письма меряют не API, а вывод и SMTP
+    app.config.update(SQLALCHEMY_ECHO=False, MAIL_NOTIFICATIONS=False)
+    return app
+
+
+def seed(size, seed_value):
+    """
+    Заметки size штук, пользователей size / 100 - тем же генератором, что и flask seed
+    """
+    from api import db
+    from api.seed import generate
+
+    with db.engine.begin() as connection:
+        generate(connection, users=max(10, size // 100), notes=size, tags=TAGS, password=PASSWORD, seed=seed_value)
+
+
+def scenarios(client, rnd):
+    """
+    {имя: функция одной операции}; функция возвращает статус ответа
+    """
+    from api import credential_cache, verify_password
+    from api.seed import WORDS, WORDS_PER_NOTE, zipf_weights
+
+    headers = {'Authorization': 'Basic ' + b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()}
+    created = []
+    word_weights = zipf_weights(len(WORDS), 1.0)
+
+    def get(url):
+        return lambda: client.get(url, headers=headers).status_code
+
+    def verify(cached):
+        def run():
+            if not cached:
+                credential_cache.clear()
+            with client.application.test_request_context():
+                return 200 if verify_password(USERNAME, PASSWORD) else 401
+        return run
+
+    def create():
+        note_text = ' '.join(rnd.choices(WORDS, cum_weights=word_weights, k=rnd.randint(*WORDS_PER_NOTE)))
+        res = client.post('/notes', headers=headers, json={"text": note_text, "private": rnd.random() < 0.5})
+        created.append(json.loads(res.data)["id"])
+        return res.status_code
+
+    def attach_detach():
+        # отвязать можно только привязанное, поэтому одна операция - пара запросов
+        if not created:
+            create()
+        url = f'/notes/{created[-1]}/tags?tags=1&tags=2'
+        return max(client.put(url, headers=headers).status_code, client.delete(url, headers=headers).status_code)
+
+    return {
+        'verify_password': verify(cached=False),
+        'verify_password_cached': verify(cached=True),
+        'notes_list': get('/notes?limit=20'),
+        'notes_public': get('/notes?private=false&limit=20'),
+        'notes_by_tag': get('/notes?tag=tag1&limit=20'),
+        'notes_by_username': get('/notes?username=user2&limit=20'),
+        'notes_like': get(f'/notes/like?text={WORDS[0]}&limit=20'),
+        'notes_like_rare': get(f'/notes/like?text={WORDS[-1]}&limit=20'),
+        'notes_tags': get('/notes/tags?all_of=1&any_of=2&any_of=3&limit=20'),
+        'notes_tags_none_of': get('/notes/tags?none_of=1&limit=20'),
+        'tags_popular': get('/tags?sort=popular&limit=20'),
+        'note_create': create,
+        'tag_attach_detach': attach_detach,
+    }
+
+
+def measure(operation, iterations, warmup, counter):
+    for _ in range(warmup):
+        operation()
+    timings, statuses = [], set()
+    queries = counter[0]
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        statuses.add(operation())
+        timings.append(time.perf_counter() - start)
+    total = time.perf_counter() - started
+    timings.sort()
+    return {
+        'ops_per_sec': round(iterations / total, 1),
+        'p50_ms': round(statistics.median(timings) * 1000, 3),
+        'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000, 3),
+        'queries_per_op': round((counter[0] - queries) / iterations, 2),
+        'statuses': sorted(statuses),
+    }
+
+
+def run_size(app, size, iterations, warmup, seed_value, only=None):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    from api import credential_cache, db, tag_cache, tag_index
+
+    rnd = random.Random(seed_value)
+    counter = [0]
+
+    def count(*args):
+        counter[0] += 1
+
+    with tempfile.TemporaryDirectory() as directory:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        for cache in (credential_cache, tag_cache, tag_index):
+            cache.clear()
+        with app.app_context():
+            db.create_all()
+            started = time.perf_counter()
+            seed(size, seed_value)
+            print(f'size={size} seeded in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+        event.listen(Engine, 'before_cursor_execute', count)
+        try:
+            client = app.test_client()
+            results = {}
+            for name, operation in scenarios(client, rnd).items():
+                if only and name not in only:
+                    continue
+                divisor = SLOW.get(name, 1)
+                results[name] = measure(operation, max(5, iterations // divisor), warmup // divisor, counter)
+                print(f'size={size} {name} ' + ' '.join(f'{key}={value}' for key, value in results[name].items()),
+                      file=sys.stderr)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+            with app.app_context():
+                db.session.remove()
+                db.get_engine().dispose()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Регрессии относительно baseline: p50 медленнее больше чем на threshold или больше запросов на операцию
+    """
+    regressions = []
+    for size, scenarios in results.items():
+        for name, current in scenarios.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            if current['p50_ms'] > previous['p50_ms'] * (1 + threshold):
+                regressions.append(f"size={size} {name}: p50 {previous['p50_ms']}ms -> {current['p50_ms']}ms")
+            if current['queries_per_op'] > previous['queries_per_op']:
+                regressions.append(f"size={size} {name}: queries {previous['queries_per_op']} -> "
+                                   f"{current['queries_per_op']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 100000])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scenarios', nargs='+', help='run only these scenarios')
+    parser.add_argument('--profile', default='prod')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed p50 slowdown, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    app = setup_app(args.profile)
+    report = {
+        'meta': {
+            'date': datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlite': sqlite3.sqlite_version,
+            'profile': args.profile,
+            'iterations': args.iterations,
+            'seed': args.seed,
+        },
+        'results': {str(size): run_size(app, size, args.iterations, args.warmup, args.seed,
+                                          args.scenarios) for size in args.sizes},
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report['results'], json.load(file)['results'], args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+WSGI (поток на соединение, как воркер gunicorn gthread) против ASGI режима (asgi.py) при медленных клиентах.
+
+Оба режима обслуживаются одним процессом с одинаковым числом потоков (--threads) и одной базой.
+--slow клиентов все время шлют POST /notes, отдавая тело по частям с паузами (плохая сеть, загрузки),
+--fast клиентов параллельно гоняют GET /notes. В WSGI медленный клиент занимает поток, пока тянется его тело,
+в ASGI тело собирает цикл событий, а поток занят только обработкой. Сравниваются задержки и ops/sec быстрых
+запросов, число обслуженных медленных и ошибок (5xx, на SQLite - "database is locked": в ASGI все потоки
+пишут одновременно, и пределом становится сама база). Сервер и сеть не участвуют: меряется модель
+обслуживания, а не uvicorn.
+
+    python benchmarks/asgi_vs_wsgi.py --slow 100 --fast 10 --duration 10
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+
+from api_hot_paths import PASSWORD, USERNAME, seed, setup_app
+
+AUTHORIZATION = 'Basic ' + b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()
+BODY = json.dumps({"text": 'Slow client note', "private": True}).encode()
+FAST_PATH, FAST_QUERY = '/notes', 'limit=20'
+
+
+class SlowInput(io.RawIOBase):
+    """
+    wsgi.input медленного клиента: каждая часть тела приходит через delay секунд
+    """
+
+    def __init__(self, body, chunks, delay):
+        size = -(-len(body) // chunks)
+        self.parts = [body[start:start + size] for start in range(0, len(body), size)]
+        self.delay = delay
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.parts:
+            return 0
+        time.sleep(self.delay)
+        part = self.parts.pop(0)
+        buffer[:len(part)] = part
+        return len(part)
+
+
+def summary(timings, duration):
+    timings.sort()
+    return {
+        'ops_per_sec': round(len(timings) / duration, 1),
+        'p50_ms': round(statistics.median(timings) * 1000, 3) if timings else None,
+        'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000, 3) if timings else None,
+    }
+
+
+def run_wsgi(app, args):
+    from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+    workers = ThreadPoolExecutor(args.threads)
+    stop = time.monotonic() + args.duration
+    fast, slow, errors, lock = [], [0], [0], threading.Lock()
+
+    def handle(environ):
+        try:
+            app_iter, status, headers = run_wsgi_app(app, environ)
+            b''.join(app_iter)
+            failed = not status.startswith(('2', '3', '4'))
+        except Exception:
+            failed = True
+        if failed:
+            with lock:
+                errors[0] += 1
+
+    def slow_client():
+        while time.monotonic() < stop:
+            environ = EnvironBuilder(method='POST', path='/notes', headers={'Authorization': AUTHORIZATION},
+                                     content_type='application/json').get_environ()
+            environ['wsgi.input'] = io.BufferedReader(SlowInput(BODY, args.chunks, args.delay))
+            environ['CONTENT_LENGTH'] = str(len(BODY))
+            workers.submit(handle, environ).result()
+            with lock:
+                slow[0] += 1
+
+    def fast_client():
+        while time.monotonic() < stop:
+            environ = EnvironBuilder(method='GET', path=FAST_PATH, query_string=FAST_QUERY,
+                                     headers={'Authorization': AUTHORIZATION}).get_environ()
+            start = time.perf_counter()
+            workers.submit(handle, environ).result()
+            with lock:
+                fast.append(time.perf_counter() - start)
+
+    clients = [threading.Thread(target=slow_client) for _ in range(args.slow)]
+    clients += [threading.Thread(target=fast_client) for _ in range(args.fast)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    workers.shutdown()
+    return dict(summary(fast, args.duration), slow_completed=slow[0], errors=errors[0])
+
+
+def run_asgi(app, args):
+    from api.asgi import AsgiApp
+
+    application = AsgiApp(app, threads=args.threads, buffer_size=1024 * 1024)
+    fast, slow, errors = [], [0], [0]
+
+    async def request(method, path, query, chunks, delay):
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': number < len(chunks) - 1}
+                    for number, chunk in enumerate(chunks)]
+
+        async def receive():
+            if delay:
+                await asyncio.sleep(delay)
+            return messages.pop(0)
+
+        async def send(message):
+            if message['type'] == 'http.response.start' and message['status'] >= 500:
+                errors[0] += 1
+
+        headers = [(b'authorization', AUTHORIZATION.encode()), (b'content-type', b'application/json')]
+        try:
+            await application({'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+                               'path': path, 'query_string': query.encode(), 'root_path': '', 'headers': headers,
+                               'client': ('127.0.0.1', 50000), 'server': ('localhost', 80)}, receive, send)
+        except Exception:
+            # без сервера необработанное исключение не превращается в 500
+            errors[0] += 1
+
+    async def main():
+        stop = time.monotonic() + args.duration
+        size = -(-len(BODY) // args.chunks)
+        parts = [BODY[start:start + size] for start in range(0, len(BODY), size)]
+
+        async def slow_client():
+            while time.monotonic() < stop:
+                await request('POST', '/notes', '', parts, args.delay)
+                slow[0] += 1
+
+        async def fast_client():
+            while time.monotonic() < stop:
+                start = time.perf_counter()
+                await request('GET', FAST_PATH, FAST_QUERY, [b''], 0)
+                fast.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(slow_client() for _ in range(args.slow)), *(fast_client() for _ in range(args.fast)))
+
+    asyncio.run(main())
+    application.executor.shutdown()
+    return dict(summary(fast, args.duration), slow_completed=slow[0], errors=errors[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=None, help='worker threads, default Config.ASGI_THREADS')
+    parser.add_argument('--slow', type=int, default=100, help='slow clients')
+    parser.add_argument('--fast', type=int, default=10, help='fast clients')
+    parser.add_argument('--chunks', type=int, default=5, help='parts of a slow request body')
+    parser.add_argument('--delay', type=float, default=0.2, help='seconds between parts')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per mode')
+    parser.add_argument('--notes', type=int, default=10000)
+    parser.add_argument('--profile', default='prod')
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args()
+
+    app = setup_app(args.profile)
+    from api import db
+    from config import Config
+    args.threads = args.threads or Config.ASGI_THREADS
+
+    report = {'meta': {key: value for key, value in vars(args).items() if key != 'output'}, 'results': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        with app.app_context():
+            db.create_all()
+            seed(args.notes, 0)
+        for mode, run in (('wsgi', run_wsgi), ('asgi', run_asgi)):
+            report['results'][mode] = run(app, args)
+            print(f'{mode} ' + ' '.join(f'{key}={value}' for key, value in report['results'][mode].items()),
+                  file=sys.stderr)
+        with app.app_context():
+            db.session.remove()
+            db.get_engine().dispose()
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Пропускная способность конкурентной записи в SQLite для профилей движка.
+
+Несколько процессов (как воркеры gunicorn) создают заметки через NoteModel.save,
+еще несколько параллельно читают; считаем записи в секунду и ошибки "database is locked".
+
+    python benchmarks/concurrent_writes.py --profiles baseline dev prod --writers 4 --readers 2 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_app(profile, database):
+    # baseline - как было до профилей: журнал отката, без busy_timeout
+    os.environ['APP_PROFILE'] = 'dev' if profile == 'baseline' else profile
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    sys.path.insert(0, base_dir)
+    from app import app
+    # лог SQL меряет не базу, а вывод, поэтому выключен во всех профилях
+    app.config['SQLALCHEMY_ECHO'] = False
+    if profile == 'baseline':
+        app.config['SQLITE_PRAGMAS'] = {}
+    return app
+
+
+def prepare(profile, database):
+    app = setup_app(profile, database)
+    from api import db
+    from api.models.user import UserModel
+
+    with app.app_context():
+        db.create_all()
+        UserModel(username='bench', password='bench').save()
+
+
+def writer(profile, database, seconds, results):
+    app = setup_app(profile, database)
+    from sqlalchemy.exc import OperationalError
+
+    from api import db
+    from api.models.note import NoteModel
+
+    done = errors = 0
+    with app.app_context():
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            try:
+                NoteModel(author_id=1, text=f'Benchmark note {done}', private=False).save()
+                done += 1
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+    results.put(('write', done, errors))
+
+
+def reader(profile, database, seconds, results):
+    app = setup_app(profile, database)
+    from sqlalchemy.exc import OperationalError
+
+    from api import db
+    from api.models.note import NoteModel
+
+    done = errors = 0
+    with app.app_context():
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            try:
+                NoteModel.query.order_by(NoteModel.id.desc()).limit(20).all()
+                db.session.commit()
+                done += 1
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+    results.put(('read', done, errors))
+
+
+def run(profile, writers, readers, seconds):
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'bench.db')
+        # каждый профиль - в свежих процессах: Config читает APP_PROFILE при импорте
+        process = context.Process(target=prepare, args=(profile, database))
+        process.start()
+        process.join()
+
+        results = context.Queue()
+        processes = [context.Process(target=writer, args=(profile, database, seconds, results))
+                     for _ in range(writers)]
+        processes += [context.Process(target=reader, args=(profile, database, seconds, results))
+                      for _ in range(readers)]
+        for process in processes:
+            process.start()
+        totals = {'write': [0, 0], 'read': [0, 0]}
+        for _ in processes:
+            kind, done, errors = results.get()
+            totals[kind][0] += done
+            totals[kind][1] += errors
+        for process in processes:
+            process.join()
+    return {
+        'profile': profile,
+        'writes_per_second': round(totals['write'][0] / seconds, 1),
+        'write_errors': totals['write'][1],
+        'reads_per_second': round(totals['read'][0] / seconds, 1),
+        'read_errors': totals['read'][1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', nargs='+', default=['baseline', 'dev', 'prod'])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    for profile in args.profiles:
+        result = run(profile, args.writers, args.readers, args.seconds)
+        print(' '.join(f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,16 +13,89 @@ security_definitions = {
 
 ma_plugin = MarshmallowPlugin()
 
+# Профили движка БД, выбираются переменной окружения APP_PROFILE (по умолчанию dev).
+# pool - параметры пула для PostgreSQL (для SQLite отбрасываются),
+# sqlite_pragmas - PRAGMA, которые выполняются на каждом новом соединении SQLite
+ENGINE_PROFILES = {
+    'dev': {
+        'echo': True,
+        'pool': {'pool_size': 5, 'max_overflow': 5, 'pool_pre_ping': True, 'pool_recycle': 1800},
+        'sqlite_pragmas': {'busy_timeout': 5000},
+    },
+    'test': {
+        'echo': False,
+        'pool': {'pool_size': 2, 'max_overflow': 0, 'pool_pre_ping': True},
+        'sqlite_pragmas': {'journal_mode': 'MEMORY', 'synchronous': 'OFF', 'busy_timeout': 5000},
+    },
+    'prod': {
+        'echo': False,
+        'pool': {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 30, 'pool_pre_ping': True,
+                 'pool_recycle': 1800},
+        # WAL: читатели не блокируют писателя, synchronous=NORMAL в WAL не теряет целостность
+        'sqlite_pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000,
+                           'mmap_size': 256 * 1024 * 1024, 'cache_size': -64 * 1024, 'temp_store': 'MEMORY'},
+    },
+}
+
+
+# Для PostgreSQL (psycopg2) во всех профилях: без executemany_mode psycopg2 выполняет executemany построчно,
+# запрос на каждую строку. values собирает INSERT (импорт, связи тегов) в многострочные VALUES
+# по executemany_values_page_size строк, остальные executemany (UPDATE счетчиков) идут через execute_batch
+POSTGRESQL_ENGINE_OPTIONS = {'executemany_mode': 'values', 'executemany_values_page_size': 1000,
+                             'executemany_batch_page_size': 500}
+
+
+# Процессы gunicorn по тому же APP_PROFILE (gunicorn.conf.py): класс воркера, воркеров на ядро, потоков.
+# gthread - потоки воркера делят один пул соединений; gevent - тысячи медленных клиентов на воркер,
+# только для PostgreSQL (нужны gevent и psycogreen; запрос к SQLite под gevent останавливает весь воркер)
+SERVER_PROFILES = {
+    'dev': {'worker_class': 'gthread', 'workers_per_cpu': 1, 'threads': 2},
+    'test': {'worker_class': 'sync', 'workers_per_cpu': 1, 'threads': 1},
+    'prod': {'worker_class': 'gthread', 'workers_per_cpu': 2, 'threads': 4},
+    'gevent': {'worker_class': 'gevent', 'workers_per_cpu': 1, 'worker_connections': 1000},
+}
+# под gevent запросы воркера идут параллельно сотнями: пул больше, чем у потоков
+ENGINE_PROFILES['gevent'] = dict(ENGINE_PROFILES['prod'],
+                                 pool=dict(ENGINE_PROFILES['prod']['pool'], pool_size=20, max_overflow=30))
+
 
 class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(base_dir, 'base.db')
-    TEST_DATABASE_URI = 'sqlite:///' + os.path.join(base_dir, 'test.db')
+    # TEST_DATABASE_URL=postgresql://... прогоняет тесты (и проверку планов запросов) на PostgreSQL,
+    # без нее тесты берут SQLite во временном каталоге прогона
+    TEST_DATABASE_URI = os.environ.get('TEST_DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ECHO = True
+    PROFILE = os.environ.get('APP_PROFILE', 'dev')
+    SQLALCHEMY_ECHO = ENGINE_PROFILES[PROFILE]['echo']
+    SQLALCHEMY_ENGINE_OPTIONS = ENGINE_PROFILES[PROFILE]['pool']
+    SQLITE_PRAGMAS = ENGINE_PROFILES[PROFILE]['sqlite_pragmas']
+    POSTGRESQL_ENGINE_OPTIONS = POSTGRESQL_ENGINE_OPTIONS
+    SERVER = SERVER_PROFILES[PROFILE]
+    # реплики для чтения через запятую: DATABASE_REPLICA_URLS=postgresql://r1/db,postgresql://r2/db
+    SQLALCHEMY_BINDS = {f'replica_{number}': uri for number, uri
+                        in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')))}
+    REPLICA_PIN_SECONDS = 5  # после записи клиент читает из основной базы
+    REPLICA_MAX_LAG = 10  # seconds
+    REPLICA_LAG_CHECK = 5  # seconds
+    REPLICA_PIN_REFRESH = 1  # seconds, через сколько запись в одном воркере закрепляет клиента и в остальных
     # SQLALCHEMY_RECORD_QUERIES = True
     DEBUG = True
     PORT = 5000
     SECRET_KEY = "My secret key =)"
+    AUTH_CACHE_SIZE = 1024
+    AUTH_CACHE_TTL = 300  # seconds
+    TOKEN_EXPIRATION = 600  # seconds
+    TOKEN_VERSIONS_REFRESH = 30  # seconds
+    TAG_INDEX_REFRESH = 60  # seconds
+    TAG_CACHE_SIZE = 4096
+    TAG_CACHE_TTL = 60  # seconds
+    PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+    USER_SEARCH_LIMIT = 50
+    BULK_TAGS_LIMIT = 1000  # notes per request
+    IMPORT_BATCH_SIZE = 1000  # notes per INSERT
+    IMPORT_MAX_LINE = 64 * 1024  # bytes
+    EXPORT_BATCH_SIZE = 1000  # notes per fetch
     RESTFUL_JSON = {
         'ensure_ascii': False,
     }
@@ -43,8 +116,45 @@ class Config:
     MAIL_USE_SSL = True
     MAIL_USERNAME = '***'
     MAIL_PASSWORD = '***'
+    MAIL_NOTIFICATIONS = os.environ.get('MAIL_NOTIFICATIONS') == '1'  # письма о публикации заметок
+    MAIL_WORKERS = 1
+    MAIL_QUEUE_SIZE = 1000  # писем; сверх этого новые отбрасываются
+    MAIL_BATCH_SIZE = 50  # писем за один проход по SMTP соединению
+    MAIL_RETRIES = 3
+    MAIL_RETRY_BACKOFF = 1.0  # seconds, удваивается с каждой попыткой
+    MAIL_IDLE_TIMEOUT = 30  # seconds, после простоя SMTP соединение закрывается
     UPLOAD_FOLDER_NAME = 'upload'
     UPLOAD_FOLDER = os.path.join(base_dir, UPLOAD_FOLDER_NAME)
+    # недогруженные части - вне UPLOAD_FOLDER, который раздается как статика
+    UPLOAD_PARTIAL_FOLDER = os.path.join(base_dir, 'upload_partial')
+    UPLOAD_MAX_SIZE = 50 * 1024 * 1024  # bytes per file
+    UPLOAD_MAX_CHUNK = 8 * 1024 * 1024  # bytes per PUT
+    UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds
+    # отдача /uploads через прокси: None - сам воркер, 'x-sendfile' - Apache/lighttpd,
+    # 'x-accel' - nginx (internal location с alias на UPLOAD_FOLDER по UPLOAD_ACCEL_PREFIX)
+    UPLOAD_SENDFILE = os.environ.get('UPLOAD_SENDFILE') or None
+    UPLOAD_ACCEL_PREFIX = os.environ.get('UPLOAD_ACCEL_PREFIX', '/internal/upload/')
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # seconds, для адресов с версией (?v=)
+    # одним запросом multipart/form-data (PUT /upload) больше файла не принять
+    MAX_CONTENT_LENGTH = UPLOAD_MAX_SIZE + 64 * 1024
+    THUMBNAIL_SIZES = (64, 256)  # px, по большей стороне
+    THUMBNAIL_FORMAT = 'WEBP'
+    THUMBNAIL_QUALITY = 80
+    THUMBNAIL_FOLDER_NAME = 'thumbnails'
+    THUMBNAIL_WORKERS = 2  # процессов
+    THUMBNAIL_MAX_PENDING = 100  # файлов в работе; остальные остаются без копий
+    # /metrics: без METRICS_DIR - счетчики одного процесса; с ним каждый воркер gunicorn
+    # сбрасывает туда снимок не реже раза в METRICS_FLUSH_INTERVAL секунд, /metrics их складывает
+    METRICS_DIR = os.environ.get('METRICS_DIR') or None
+    METRICS_FLUSH_INTERVAL = 5  # seconds
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+    # если задан, /metrics отдается только с заголовком Authorization: Bearer <METRICS_TOKEN>
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+    # ASGI режим (asgi.py): потоков под синхронную обработку столько же, сколько соединений в пуле БД -
+    # лишние все равно ждали бы соединения. Тело запроса и ответ до ASGI_BUFFER_SIZE держатся в памяти,
+    # больше - во временном файле
+    ASGI_THREADS = SQLALCHEMY_ENGINE_OPTIONS['pool_size'] + SQLALCHEMY_ENGINE_OPTIONS['max_overflow']
+    ASGI_BUFFER_SIZE = 1024 * 1024  # bytes
     LANGUAGES = ['en', 'ru']
 
     # administrator list
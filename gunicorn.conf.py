@@ -0,0 +1,75 @@
+"""
+Настройки gunicorn (читаются из текущей папки сами): gunicorn app:app
+Класс воркера, воркеров на ядро и потоки берутся из профиля APP_PROFILE (config.SERVER_PROFILES),
+WEB_CONCURRENCY и GUNICORN_THREADS их переопределяют
+"""
+import gc
+import multiprocessing
+import os
+
+from config import Config
+
+profile = Config.SERVER
+
+if profile['worker_class'] == 'gevent':
+    # до загрузки приложения в мастере (preload_app): блокировки, очереди и потоки, которые создаются
+    # при импорте api (кэши, рассылка почты), должны быть уже из gevent, а не из обычного threading
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', Config.PORT)}"
+worker_class = profile['worker_class']
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * profile['workers_per_cpu']))
+threads = int(os.environ.get('GUNICORN_THREADS', profile.get('threads', 1)))
+worker_connections = profile.get('worker_connections', 1000)
+
+# приложение импортируется один раз в мастере, воркеры делят его страницы памяти (copy-on-write)
+preload_app = True
+# перезапуск воркера через столько запросов (с разбросом, чтобы не все сразу) ограничивает рост RSS
+max_requests = 10000
+max_requests_jitter = 1000
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    from api.metrics import clear_snapshots
+
+    if Config.METRICS_DIR and os.path.isdir(Config.METRICS_DIR):
+        # снимки прошлого запуска: их pid могли достаться новым воркерам
+        clear_snapshots(Config.METRICS_DIR)
+
+
+def when_ready(server):
+    # объекты, созданные при импорте, уходят из-под сборщика мусора: его проходы больше не трогают
+    # их заголовки, и общие с мастером страницы не копируются в каждый воркер
+    gc.collect()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    from api import db
+
+    # соединения, которые мастер успел открыть (миграции, проверки), закрываются им самим до fork
+    db.dispose_engines(server.app.wsgi(), close=True)
+
+
+def post_fork(server, worker):
+    from api import db, warm_up
+
+    if worker_class == 'gevent':
+        # без этого psycopg2 ждет ответа базы, блокируя весь цикл gevent
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    # у каждого воркера свои пулы; унаследованные объекты соединений не закрываем - они мастера
+    db.dispose_engines(server.app.wsgi(), close=False)
+    warm_up(server.app.wsgi())
+
+
+def child_exit(server, worker):
+    from api.metrics import mark_process_dead
+
+    if Config.METRICS_DIR:
+        # воркер завершился (в том числе по max_requests): его снимок переходит в общий итог
+        mark_process_dead(Config.METRICS_DIR, worker.pid)
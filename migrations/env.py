@@ -70,6 +70,15 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # объекты поисковых индексов создаются вручную (см. api/search.py), а sqlite_sequence - сам SQLite
+    # для таблиц с AUTOINCREMENT: autogenerate не должен предлагать их удалить
+    def include_object(object, name, type_, reflected, compare_to):
+        if reflected and compare_to is None and name is not None:
+            return not name.startswith(('note_fts', 'search_vector', 'ix_note_model_search_vector',
+                                        'user_trigram', 'ix_user_trigram', 'ix_user_model_username_trgm',
+                                        'sqlite_sequence'))
+        return True
+
     connectable = current_app.extensions['migrate'].db.engine
 
     with connectable.connect() as connection:
@@ -77,6 +86,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,49 @@
+"""note full-text search
+
+Revision ID: 7d2e4b9a1c63
+Revises: 3f1b7a2c9d04
+Create Date: 2026-10-18 11:05:41.902114
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2e4b9a1c63'
+down_revision = '3f1b7a2c9d04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Объекты создаются вручную, autogenerate их не видит (см. api/search.py)
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE note_fts USING fts5("
+                   "text, content='note_model', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        op.execute("CREATE TRIGGER note_fts_ai AFTER INSERT ON note_model BEGIN "
+                   "INSERT INTO note_fts(rowid, text) VALUES (new.id, new.text); END")
+        op.execute("CREATE TRIGGER note_fts_ad AFTER DELETE ON note_model BEGIN "
+                   "INSERT INTO note_fts(note_fts, rowid, text) VALUES ('delete', old.id, old.text); END")
+        op.execute("CREATE TRIGGER note_fts_au AFTER UPDATE OF text ON note_model BEGIN "
+                   "INSERT INTO note_fts(note_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+                   "INSERT INTO note_fts(rowid, text) VALUES (new.id, new.text); END")
+        # заполняем индекс существующими заметками
+        op.execute("INSERT INTO note_fts(note_fts) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        # генерируемая колонка заполняется для существующих строк при добавлении
+        op.execute("ALTER TABLE note_model ADD COLUMN search_vector tsvector "
+                   "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED")
+        op.execute("CREATE INDEX ix_note_model_search_vector ON note_model USING gin (search_vector)")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS note_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS note_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS note_fts_ai")
+        op.execute("DROP TABLE IF EXISTS note_fts")
+    elif dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_note_model_search_vector")
+        op.execute("ALTER TABLE note_model DROP COLUMN IF EXISTS search_vector")
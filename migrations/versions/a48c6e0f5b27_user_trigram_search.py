@@ -0,0 +1,50 @@
+"""user trigram search
+
+Revision ID: a48c6e0f5b27
+Revises: 7d2e4b9a1c63
+Create Date: 2026-10-18 11:48:03.551287
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a48c6e0f5b27'
+down_revision = '7d2e4b9a1c63'
+branch_labels = None
+depends_on = None
+
+
+def trigrams(value):
+    value = value.lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def upgrade():
+    # Объекты создаются вручную, autogenerate их не видит (см. api/search.py)
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        op.execute("CREATE TABLE user_trigram ("
+                   "trigram VARCHAR(3) NOT NULL, user_id INTEGER NOT NULL, size INTEGER NOT NULL, "
+                   "PRIMARY KEY (trigram, user_id)) WITHOUT ROWID")
+        op.execute("CREATE INDEX ix_user_trigram_user_id ON user_trigram (user_id)")
+        # заполняем триграммы существующих пользователей
+        user_trigram = sa.table('user_trigram', sa.column('trigram'), sa.column('user_id'), sa.column('size'))
+        rows = []
+        for user_id, username in bind.execute(sa.text("SELECT id, username FROM user_model")):
+            grams = trigrams(username or '')
+            rows += [{'trigram': gram, 'user_id': user_id, 'size': len(grams)} for gram in grams]
+        if rows:
+            op.bulk_insert(user_trigram, rows)
+    elif bind.dialect.name == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute("CREATE INDEX ix_user_model_username_trgm ON user_model USING gin (username gin_trgm_ops)")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TABLE IF EXISTS user_trigram")
+    elif dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_user_model_username_trgm")
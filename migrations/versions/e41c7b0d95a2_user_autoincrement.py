@@ -0,0 +1,32 @@
+"""user autoincrement
+
+Revision ID: e41c7b0d95a2
+Revises: 7868f5890b83
+Create Date: 2026-10-19 09:12:31.804117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41c7b0d95a2'
+down_revision = '7868f5890b83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite без AUTOINCREMENT отдает новому пользователю id последнего удаленного,
+    # а с ним и его неистекшие токены; последовательности PostgreSQL id не повторяют
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table('user_model', recreate='always',
+                                  table_kwargs={'sqlite_autoincrement': True}) as batch_op:
+            pass
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table('user_model', recreate='always',
+                                  table_kwargs={'sqlite_autoincrement': False}) as batch_op:
+            pass
@@ -1,13 +1,45 @@
+import asyncio
+import hashlib
+import io
 import json
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
 from base64 import b64encode
-from unittest import TestCase
+from unittest import TestCase, mock
 
-from api import db
+from PIL import Image
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql.psycopg2 import EXECUTEMANY_VALUES
+from sqlalchemy.engine.url import make_url
+
+os.environ.setdefault('APP_PROFILE', 'test')
+
+from api import (Message, create_app, credential_cache, db, mail, mail_dispatcher,
+                 tag_cache, tag_index, thumbnailer, token_versions)
+from api.asgi import AsgiApp
+from api.cache import TagIndex
+from api.mailer import _STOP, MailDispatcher
+from api.metrics import Registry, mark_process_dead, registry
+from api.models.file import FileModel
 from api.models.note import NoteModel
+from api.models.tag import TagModel
 from api.models.user import UserModel
+from api.pagination import encode_cursor, paginate_ids
+from api.resources import file as file_resource
+from api.models.version import ResourceVersionModel
+from api.replica import _health, _pins, check_replicas, pin_key, refresh_pins
 from app import app
 from config import Config
 
+# база тестов - временный файл на прогон, а не файл в репозитории
+test_directory = tempfile.TemporaryDirectory()
+if not Config.TEST_DATABASE_URI:
+    Config.TEST_DATABASE_URI = 'sqlite:///' + os.path.join(test_directory.name, 'test.db')
+
 
 class TestUsers(TestCase):
     def setUp(self):
@@ -72,8 +104,31 @@ class TestUsers(TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         print(data)
-        self.assertEqual(data[0]["username"], users_data[0]["username"])
-        self.assertEqual(data[1]["username"], users_data[1]["username"])
+        self.assertEqual(data["items"][0]["username"], users_data[0]["username"])
+        self.assertEqual(data["items"][1]["username"], users_data[1]["username"])
+
+    def test_users_find_like(self):
+        """
+        Поиск пользователей по подстроке: самые похожие первыми
+        """
+        for username in ['administrator', 'admin', 'ivan', 'badmin']:
+            UserModel(username=username, password='12345').save()
+
+        res = self.client.get('/users/like?username=ADMIN')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([user["username"] for user in data], ['admin', 'badmin', 'administrator'])
+
+    def test_users_find_like_after_rename(self):
+        user = UserModel(username='ivan', password='12345')
+        user.save()
+        user.username = 'petr'
+        user.save()
+
+        res = self.client.get('/users/like?username=iva')
+        self.assertEqual(json.loads(res.data), [])
+        res = self.client.get('/users/like?username=etr')
+        self.assertEqual([user["username"] for user in json.loads(res.data)], ['petr'])
 
     def test_user_not_found(self):
         """
@@ -118,6 +173,8 @@ class TestNotes(TestCase):
         with self.app.app_context():
             # create all tables
             db.create_all()
+        tag_index.clear()
+        tag_cache.clear()
 
         self.create_and_auth_user()
 
@@ -168,7 +225,312 @@ class TestNotes(TestCase):
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(len(data), 2)
+        self.assertEqual(len(data["items"]), 2)
+
+    def test_get_notes_pagination(self):
+        """
+        Постраничное получение заметок по курсору
+        """
+        for i in range(5):
+            note = NoteModel(author_id=self.user.id, text=f'Test note {i}')
+            note.save()
+
+        res = self.client.get('/notes?limit=2', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual([note["text"] for note in data["items"]], ['Test note 0', 'Test note 1'])
+        texts = []
+        while data["next"]:
+            res = self.client.get(data["next"], headers=self.headers)
+            data = json.loads(res.data)
+            texts += [note["text"] for note in data["items"]]
+        self.assertEqual(texts, ['Test note 2', 'Test note 3', 'Test note 4'])
+
+    def test_get_notes_invalid_cursor(self):
+        res = self.client.get('/notes?after=not-a-cursor', headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+        for value in ({'id': 1}, [[1], 2], None, True, 'abc', [1, 'abc']):
+            cursor = encode_cursor(value)
+            for path in ('/notes', '/users', '/notes/like?text=note', '/notes/tags?tags=1'):
+                res = self.client.get(path + ('&' if '?' in path else '?') + 'after=' + cursor,
+                                      headers=self.headers)
+                self.assertEqual(res.status_code, 400, (path, value))
+
+    def test_search_notes(self):
+        """
+        Полнотекстовый поиск: ранжирование, префиксы, подсветка, архив не ищется
+        """
+        notes_data = [
+            {"text": 'Flask is a web framework'},
+            {"text": 'flask flask flask'},
+            {"text": 'Django is a web framework'},
+            {"text": 'archived flask note', "archive": True},
+        ]
+        for note_data in notes_data:
+            note = NoteModel(author_id=self.user.id, **note_data)
+            note.save()
+
+        res = self.client.get('/notes/like?text=flask', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([note["text"] for note in data["items"]], ['flask flask flask', 'Flask is a web framework'])
+        self.assertIn('<b>Flask</b>', data["items"][1]["snippet"])
+
+        res = self.client.get('/notes/like?text=frame*', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data["items"]), 2)
+
+    def test_search_notes_visibility(self):
+        other = UserModel(username='other', password='other')
+        other.save()
+        NoteModel(author_id=other.id, text='private flask note').save()
+        NoteModel(author_id=other.id, text='public flask note', private=False).save()
+
+        res = self.client.get('/notes/like?text=flask', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual([note["text"] for note in data["items"]], ['public flask note'])
+
+    def test_search_notes_pagination(self):
+        for i in range(5):
+            NoteModel(author_id=self.user.id, text=f'search note {i}').save()
+
+        res = self.client.get('/notes/like?text=search&limit=2', headers=self.headers)
+        data = json.loads(res.data)
+        texts = [note["text"] for note in data["items"]]
+        while data["next"]:
+            data = json.loads(self.client.get(data["next"], headers=self.headers).data)
+            texts += [note["text"] for note in data["items"]]
+        self.assertEqual(sorted(texts), [f'search note {i}' for i in range(5)])
+
+    def test_filter_notes_by_tags(self):
+        """
+        Фильтрация заметок по комбинациям тегов all_of/any_of/none_of
+        """
+        tag_ids = []
+        for name in ['python', 'flask', 'sql']:
+            tag = TagModel(name=name)
+            tag.save()
+            tag_ids.append(tag.id)
+        python, flask, sql = tag_ids
+        notes_tags = {
+            'Note 1': [python, flask],
+            'Note 2': [python],
+            'Note 3': [flask, sql],
+            'Note 4': [],
+        }
+        for text, note_tags in notes_tags.items():
+            note = NoteModel(author_id=self.user.id, text=text)
+            note.save()
+            if note_tags:
+                query = '&'.join(f'tags={tag_id}' for tag_id in note_tags)
+                self.client.put(f'/notes/{note.id}/tags?{query}', headers=self.headers)
+
+        def texts(query):
+            res = self.client.get(f'/notes/tags?{query}', headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+            return [note["text"] for note in json.loads(res.data)["items"]]
+
+        self.assertEqual(texts(f'all_of={python}&all_of={flask}'), ['Note 1'])
+        self.assertEqual(texts(f'any_of={python}&any_of={sql}'), ['Note 1', 'Note 2', 'Note 3'])
+        self.assertEqual(texts(f'any_of={flask}&none_of={sql}'), ['Note 1'])
+        self.assertEqual(texts(f'none_of={python}'), ['Note 3', 'Note 4'])
+        self.assertEqual(texts(f'tags={sql}'), ['Note 3'])
+
+        self.client.delete(f'/notes/3/tags?tags={sql}', headers=self.headers)
+        self.assertEqual(texts(f'tags={sql}'), [])
+
+        res = self.client.get('/notes?tag=flask', headers=self.headers)
+        self.assertEqual([note["text"] for note in json.loads(res.data)["items"]], ['Note 1', 'Note 3'])
+
+    def test_filter_notes_by_tags_bounded_windows(self):
+        """
+        Когда видимых среди кандидатов индекса мало, окон не больше max_windows, остаток страницы - одним SQL
+        """
+        tag = TagModel(name='python')
+        tag.save()
+        tag_id = tag.id
+        other = UserModel(username='other', password='other')
+        other.save()
+        note_ids = []
+        for i in range(8):
+            # первые шесть - чужие приватные: кандидаты из индекса, которые не видны
+            note = NoteModel(author_id=other.id if i < 6 else self.user.id, text=f'Note {i}')
+            note.save()
+            note_ids.append(note.id)
+        with self.app.app_context():
+            NoteModel.bulk_update_tags(note_ids, add=[tag_id])
+        tag_index.clear()
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        self.client.get(f'/notes/tags?tags={tag_id}', headers=self.headers)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            with mock.patch.object(paginate_ids, '__defaults__', (None, 1, 2)):
+                res = self.client.get(f'/notes/tags?tags={tag_id}', headers=self.headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual([note["text"] for note in json.loads(res.data)["items"]], ['Note 6', 'Note 7'])
+        # два окна и один запрос остатка, а не окно на каждого кандидата
+        self.assertEqual(len([st for st in statements if 'EXISTS' in st or 'note_model.id IN' in st]), 3)
+
+    def test_tag_index_rebuild(self):
+        """
+        Фоновая перестройка не теряет привязки, сделанные, пока она читала таблицу
+        """
+        index = TagIndex()
+
+        def loader():
+            index.add(2, 20)  # другой запрос привязал тег во время чтения
+            return [(1, 10)]
+
+        index.start(self.app, loader)
+        self.assertEqual(list(index.select(loader, any_of=[1, 2]).iter_from()), [10, 20])
+        index.rebuild(lambda: [(1, 10), (1, 11), (2, 20)])
+        self.assertEqual(list(index.select(loader, any_of=[1, 2]).iter_from()), [10, 11, 20])
+
+    def test_bulk_tags(self):
+        """
+        Массовая привязка/отвязка тегов: результат по каждой заметке
+        """
+        for name in ['python', 'flask']:
+            TagModel(name=name).save()
+        other = UserModel(username='other', password='other')
+        other.save()
+        for text in ['Note 1', 'Note 2']:
+            NoteModel(author_id=self.user.id, text=text).save()
+        NoteModel(author_id=other.id, text='Other note').save()
+
+        res = self.client.post('/notes/tags/bulk', headers=self.headers,
+                               data=json.dumps({"note_ids": [1, 2, 3, 4], "add": [1, 2]}),
+                               content_type='application/json')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result["status"] for result in data["results"]], ['ok', 'ok', 'forbidden', 'not_found'])
+        res = self.client.get('/notes/tags?all_of=1&all_of=2', headers=self.headers)
+        self.assertEqual([note["text"] for note in json.loads(res.data)["items"]], ['Note 1', 'Note 2'])
+
+        # повторная привязка не падает на уже существующих связях
+        res = self.client.post('/notes/tags/bulk', headers=self.headers,
+                               data=json.dumps({"note_ids": [1, 2], "add": [1], "remove": [2]}),
+                               content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get('/notes/tags?tags=2', headers=self.headers)
+        self.assertEqual(json.loads(res.data)["items"], [])
+
+    def test_tags_deleted_in_other_worker(self):
+        """
+        Запись связей проверяет теги по базе: тег, удаленный другим воркером, не попадает в tags из кэша
+        """
+        tag = TagModel(name='stale')
+        tag.save()
+        tag_id = tag.id
+        note = NoteModel(author_id=self.user.id, text='Note')
+        note.save()
+        note_id = note.id
+        self.client.get('/notes?tag=stale', headers=self.headers)  # тег в кэше этого процесса
+        with self.app.app_context():
+            db.session.execute(TagModel.__table__.delete())
+            db.session.commit()
+        res = self.client.put(f'/notes/{note_id}/tags?tags={tag_id}', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client.post('/notes/tags/bulk', headers=self.headers, content_type='application/json',
+                               data=json.dumps({'note_ids': [note_id], 'add': [tag_id]}))
+        self.assertEqual(res.status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(NoteModel.get_tag_pairs().count(), 0)
+            # и между проверкой и вставкой: связи пишутся только с существующими тегами
+            NoteModel.bulk_update_tags([note_id], add=[tag_id])
+            self.assertEqual(NoteModel.get_tag_pairs().count(), 0)
+
+    def test_bulk_tags_unknown_tag(self):
+        NoteModel(author_id=self.user.id, text='Note 1').save()
+        res = self.client.post('/notes/tags/bulk', headers=self.headers,
+                               data=json.dumps({"note_ids": [1], "add": [42]}),
+                               content_type='application/json')
+        self.assertEqual(res.status_code, 404)
+
+    def test_import_notes(self):
+        """
+        Импорт заметок из NDJSON: результат по каждой строке
+        """
+        lines = [
+            {"text": 'Imported note 1', "private": False, "tags": ['import', 'first']},
+            'not a json',
+            {"private": True},
+            {"text": 'Imported note 2', "tags": ['import']},
+        ]
+        body = '\n'.join(line if isinstance(line, str) else json.dumps(line) for line in lines) + '\n'
+        res = self.client.post('/notes/import', headers=self.headers, data=body,
+                               content_type='application/x-ndjson')
+        results = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result["status"] for result in results], ['ok', 'error', 'error', 'ok'])
+        self.assertIn('text', results[2]["errors"])
+
+        res = self.client.get(f'/notes/{results[0]["id"]}', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertFalse(data["private"])
+        self.assertEqual(sorted(tag["name"] for tag in data["tags"]), ['first', 'import'])
+        res = self.client.get('/notes?tag=import', headers=self.headers)
+        self.assertEqual([note["text"] for note in json.loads(res.data)["items"]],
+                         ['Imported note 1', 'Imported note 2'])
+
+    def test_export_notes(self):
+        """
+        Выгрузка своих заметок в NDJSON и JSON
+        """
+        tag = TagModel(name='export')
+        tag.save()
+        other = UserModel(username='other', password='other')
+        other.save()
+        for i in range(3):
+            NoteModel(author_id=self.user.id, text=f'Export note {i}', archive=i == 2).save()
+        NoteModel(author_id=other.id, text='Other note', private=False).save()
+        self.client.put(f'/notes/1/tags?tags={tag.id}', headers=self.headers)
+
+        res = self.client.get('/notes/export', headers=self.headers)
+        notes = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([note["text"] for note in notes], ['Export note 0', 'Export note 1', 'Export note 2'])
+        self.assertEqual([tag["name"] for tag in notes[0]["tags"]], ['export'])
+        self.assertEqual(notes[0]["author"]["username"], 'admin')
+
+        res = self.client.get('/notes/export?format=json', headers=self.headers)
+        self.assertEqual(json.loads(res.data), notes)
+
+    def count_statements(self, path):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client.get(path, headers=self.headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(res.status_code, 200)
+        return len(statements)
+
+    def test_get_notes_constant_statements(self):
+        """
+        Число SQL запросов на список заметок не зависит от размера страницы
+        """
+        tag = TagModel(name='tag')
+        tag.save()
+        for i in range(10):
+            note = NoteModel(author_id=self.user.id, text=f'Test note {i}')
+            note.save()
+            self.client.put(f'/notes/{note.id}/tags?tags={tag.id}', headers=self.headers)
+
+        self.assertEqual(self.count_statements('/notes?limit=2'), self.count_statements('/notes?limit=10'))
 
     def test_get_note_by_id(self):
         notes_data = [
@@ -193,6 +555,123 @@ class TestNotes(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["text"], notes_data[0]["text"])
 
+    def test_get_note_conditional(self):
+        """
+        Условный GET заметки: 304 по ETag одним запросом, новый ETag после изменения
+        """
+        note = NoteModel(author_id=self.user.id, text='Conditional note', private=False)
+        note.save()
+        res = self.client.get(f'/notes/{note.id}', headers=self.headers)
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Last-Modified', res.headers)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client.get(f'/notes/{note.id}', headers=dict(self.headers, **{'If-None-Match': etag}))
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        # из note_model только проверка доступа по id, сама заметка не читается
+        note_statements = [statement for statement in statements if 'note_model' in statement]
+        self.assertEqual(len(note_statements), 1)
+        self.assertNotIn('note_model.text', note_statements[0])
+
+        tag = TagModel(name='conditional')
+        tag.save()
+        self.client.put(f'/notes/{note.id}/tags?tags={tag.id}', headers=self.headers)
+        res = self.client.get(f'/notes/{note.id}', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([tag["name"] for tag in json.loads(res.data)["tags"]], ['conditional'])
+
+        # ETag зависит от пользователя: чужой ETag не дает 304 в обход проверки доступа
+        other = UserModel(username='other', password='other')
+        other.save()
+        other_headers = {
+            'Authorization': 'Basic ' + b64encode(b"other:other").decode('utf-8'),
+            'If-None-Match': res.headers['ETag'],
+        }
+        res = self.client.get(f'/notes/{note.id}', headers=other_headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_conditional_does_not_reveal_notes(self):
+        """
+        ETag, подобранный для чужой приватной или несуществующей заметки, не дает 304
+        """
+        user_id = self.user.id
+        other = UserModel(username='other', password='other')
+        other.save()
+        note = NoteModel(author_id=other.id, text='Secret note', private=True)
+        note.save()
+        note_id = note.id
+        headers = {'Authorization': 'Basic ' + b64encode(b"other:other").decode('utf-8')}
+        etag = self.client.get(f'/notes/{note_id}', headers=headers).headers['ETag']
+        last_modified = self.client.get(f'/notes/{note_id}', headers=headers).headers['Last-Modified']
+        for conditions in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified}):
+            res = self.client.get(f'/notes/{note_id}', headers=dict(self.headers, **conditions))
+            self.assertEqual(res.status_code, 404)
+        # ETag без секрета (sha1 частей) для несуществующей заметки
+        parts = f'note:{note_id + 1}=0;users=0;tags=0;user={user_id}'
+        res = self.client.get(f'/notes/{note_id + 1}', headers=dict(
+            self.headers, **{'If-None-Match': '"' + hashlib.sha1(parts.encode()).hexdigest() + '"'}))
+        self.assertEqual(res.status_code, 404)
+        res = self.client.get('/users/1000', headers={'If-None-Match': '*'})
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_tags_conditional(self):
+        tag = TagModel(name='first')
+        tag.save()
+        res = self.client.get('/tags')
+        self.assertEqual(res.status_code, 200)
+        headers = {'If-None-Match': res.headers['ETag']}
+        self.assertEqual(self.client.get('/tags', headers=headers).status_code, 304)
+        self.assertEqual(self.client.get('/tags', headers={'If-Modified-Since': res.headers['Last-Modified']})
+                         .status_code, 304)
+        TagModel(name='second').save()
+        res = self.client.get('/tags', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)), 2)
+
+    def test_tag_cache(self):
+        """
+        Повторное чтение тегов идет из кэша, переименование его сбрасывает
+        """
+        tag = TagModel(name='cached')
+        tag.save()
+        self.client.get(f'/tags/{tag.id}')
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client.get(f'/tags/{tag.id}')
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(json.loads(res.data), {"id": tag.id, "name": 'cached'})
+        self.assertEqual([statement for statement in statements if 'FROM tag' in statement], [])
+
+        admin = UserModel(username='root', password='root', role='admin')
+        admin.save()
+        headers = {'Authorization': 'Basic ' + b64encode(b"root:root").decode('utf-8')}
+        self.client.put(f'/tags/{tag.id}', headers=headers, json={"name": 'renamed'})
+        res = self.client.get(f'/tags/{tag.id}')
+        self.assertEqual(json.loads(res.data)["name"], 'renamed')
+        res = self.client.get('/notes?tag=renamed', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+
     def test_note_not_found(self):
         """
         Получение заметки с несуществующим id
@@ -225,9 +704,9 @@ class TestNotes(TestCase):
         res = self.client.get('/notes', headers=self.headers)
         data = json.loads(res.data)
 
-        self.assertFalse(data[0]["private"])
-        self.assertTrue(data[1]["private"])
-        self.assertTrue(data[2]["private"])
+        self.assertFalse(data["items"][0]["private"])
+        self.assertTrue(data["items"][1]["private"])
+        self.assertTrue(data["items"][2]["private"])
 
     def test_edit_note(self):
         """
@@ -283,3 +762,1127 @@ class TestNotes(TestCase):
             # drop all tables
             db.session.remove()
             db.drop_all()
+
+
+class TestAuthCache(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            # create all tables
+            db.create_all()
+        credential_cache.clear()
+
+        self.user = UserModel(username='admin', password='admin', role='admin')
+        self.user.save()
+
+    def auth_headers(self, username, password):
+        return {
+            'Authorization': 'Basic ' + b64encode(f"{username}:{password}".encode('ascii')).decode('utf-8')
+        }
+
+    def test_repeated_auth_hits_cache(self):
+        headers = self.auth_headers('admin', 'admin')
+        self.client.get('/notes', headers=headers)
+        hits = credential_cache.stats()['hits']
+        res = self.client.get('/notes', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        stats = credential_cache.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['hits'], hits + 1)
+
+    def test_wrong_password_not_cached(self):
+        res = self.client.get('/notes', headers=self.auth_headers('admin', 'wrong'))
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(credential_cache.stats()['size'], 0)
+
+    def test_password_change_invalidates_cache(self):
+        headers = self.auth_headers('admin', 'admin')
+        self.client.get('/notes', headers=headers)
+        self.user.hash_password('new password')
+        self.user.save()
+        self.assertEqual(credential_cache.stats()['size'], 0)
+        res = self.client.get('/notes', headers=headers)
+        self.assertEqual(res.status_code, 401)
+
+    def test_password_change_in_other_worker(self):
+        headers = self.auth_headers('admin', 'admin')
+        self.client.get('/notes', headers=headers)
+        # другой воркер меняет пароль: кэш этого процесса об этом не знает
+        with self.app.app_context():
+            db.session.execute(UserModel.__table__.update().values(
+                password_hash=UserModel(username='other', password='new password').password_hash))
+            db.session.commit()
+        res = self.client.get('/notes', headers=headers)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(credential_cache.stats()['size'], 0)
+
+    def test_cache_stats_endpoint(self):
+        res = self.client.get('/auth/cache', headers=self.auth_headers('admin', 'admin'))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('hits', data)
+        self.assertIn('misses', data)
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class TestTokenAuth(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            # create all tables
+            db.create_all()
+        token_versions.clear()
+
+        self.user = UserModel(username='admin', password='admin', role='admin')
+        self.user.save()
+
+    def auth_headers(self, username, password):
+        return {
+            'Authorization': 'Basic ' + b64encode(f"{username}:{password}".encode('ascii')).decode('utf-8')
+        }
+
+    def get_token(self):
+        res = self.client.get('/auth/token', headers=self.auth_headers('admin', 'admin'))
+        return json.loads(res.data)['token']
+
+    def test_token_auth_does_not_query_users(self):
+        headers = self.auth_headers(self.get_token(), '')
+        self.client.get('/notes', headers=headers)  # прогрев списка отозванных токенов
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client.get('/notes', headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse([st for st in statements if st.startswith('SELECT user_model')])
+
+    def test_logout_revokes_token(self):
+        headers = self.auth_headers(self.get_token(), '')
+        res = self.client.delete('/auth/token', headers=headers)
+        self.assertEqual(res.status_code, 204)
+        res = self.client.get('/notes', headers=headers)
+        self.assertEqual(res.status_code, 401)
+
+    def test_deleted_user_token_revoked_in_other_worker(self):
+        headers = self.auth_headers(self.get_token(), '')
+        self.client.get('/notes', headers=headers)
+        # другой воркер удаляет пользователя: здесь об этом узнают при перечитывании версий
+        with self.app.app_context():
+            db.session.execute(UserModel.__table__.delete())
+            db.session.commit()
+        with mock.patch.object(token_versions, 'refresh_interval', 0):
+            res = self.client.get('/notes', headers=headers)
+        self.assertEqual(res.status_code, 401)
+        # новый пользователь не получает id удаленного, а его токены - пропускаются
+        user = UserModel(username='other', password='other', role='admin')
+        user.save()
+        self.assertNotEqual(user.id, self.user.id)
+        res = self.client.get('/auth/token', headers=self.auth_headers('other', 'other'))
+        token = json.loads(res.data)['token']
+        res = self.client.get('/notes', headers=self.auth_headers(token, ''))
+        self.assertEqual(res.status_code, 200)
+
+    def test_role_change_revokes_token(self):
+        headers = self.auth_headers(self.get_token(), '')
+        self.user.role = 'user'
+        self.user.save()
+        res = self.client.get('/notes', headers=headers)
+        self.assertEqual(res.status_code, 401)
+
+    def tearDown(self):
+        with self.app.app_context():
+            # drop all tables
+            db.session.remove()
+            db.drop_all()
+
+
+class TestEngine(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+
+    def test_sqlite_pragmas(self):
+        """
+        PRAGMA профиля выполняются на каждом соединении, параметры пула для SQLite отброшены
+        """
+        pragmas = Config.SQLITE_PRAGMAS
+        with self.app.app_context():
+            connection = db.engine.connect()
+            try:
+                self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(),
+                                 pragmas.get('journal_mode', 'delete').lower())
+                self.assertEqual(connection.execute("PRAGMA busy_timeout").scalar(), pragmas['busy_timeout'])
+            finally:
+                connection.close()
+
+    def test_postgresql_executemany_mode(self):
+        """
+        executemany на PostgreSQL идет пакетами (execute_values), а не запросом на строку; соединения не нужно
+        """
+        with self.app.app_context():
+            engine = db.create_engine(make_url('postgresql://user@localhost/notes'),
+                                      dict(Config.SQLALCHEMY_ENGINE_OPTIONS))
+        self.assertEqual(engine.dialect.executemany_mode, EXECUTEMANY_VALUES)
+        self.assertEqual(engine.dialect.executemany_values_page_size,
+                         Config.POSTGRESQL_ENGINE_OPTIONS['executemany_values_page_size'])
+
+    def test_dispose_engines(self):
+        with self.app.app_context():
+            db.engine.connect().close()
+            pool = db.engine.pool
+            db.dispose_engines(self.app, close=False)
+            self.assertIsNot(db.engine.pool, pool)
+
+
+class TestAppFactory(TestCase):
+    def test_create_app(self):
+        """
+        Второе приложение со своими настройками: свои маршруты, документация и база, приложение по умолчанию прежнее
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            class OtherConfig(Config):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'other.db')
+                UPLOAD_FOLDER = os.path.join(directory, 'upload')
+
+            other = create_app(OtherConfig)
+            self.assertIs(db.app, app)
+            self.assertEqual(sorted(rule.rule for rule in other.url_map.iter_rules()),
+                             sorted(rule.rule for rule in app.url_map.iter_rules()))
+            self.assertEqual(json.loads(other.test_client().get('/swagger').data)["paths"].keys(),
+                             json.loads(app.test_client().get('/swagger').data)["paths"].keys())
+            with other.app_context():
+                db.create_all()
+                UserModel(username='other', password='other').save()
+                self.assertEqual(UserModel.query.count(), 1)
+                db.session.remove()
+            # загрузки - в папку своего приложения
+            os.makedirs(OtherConfig.UPLOAD_FOLDER)
+            res = other.test_client().put('/upload', data={"image": (io.BytesIO(b'other'), 'other.txt')},
+                                          content_type='multipart/form-data')
+            self.assertEqual(res.status_code, 201)
+            self.assertEqual(other.test_client().get(json.loads(res.data)["download"]).data, b'other')
+            thumbnailer.wait(timeout=30)
+            self.assertEqual(sorted(os.listdir(OtherConfig.UPLOAD_FOLDER)), ['other.txt', 'thumbnails'])
+            db.get_engine(other).dispose()
+
+
+class TestReplicas(TestCase):
+    def setUp(self):
+        self.app = app
+        self.directory = tempfile.TemporaryDirectory()
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI,
+            'SQLALCHEMY_BINDS': {'replica_0': 'sqlite:///' + os.path.join(self.directory.name, 'replica.db')},
+        })
+        self.client = self.app.test_client()
+        _health.clear()
+        _pins.clear()
+
+        with self.app.app_context():
+            db.create_all()
+            replica = db.get_engine(bind='replica_0')
+            db.metadata.create_all(replica)
+            replica.execute(UserModel.__table__.insert(), username='replica', role='simple_user')
+        UserModel(username='primary', password='primary').save()
+        check_replicas(self.app)
+
+    def usernames(self):
+        return [user["username"] for user in json.loads(self.client.get('/users').data)["items"]]
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.usernames(), ['replica'])
+
+    def test_read_your_writes(self):
+        res = self.client.post('/users', json={"username": 'new', "password": 'new'})
+        self.assertEqual(res.status_code, 201)
+        # после своей записи клиент прикреплен к основной базе
+        self.assertEqual(self.usernames(), ['primary', 'new'])
+
+    def test_read_your_writes_without_cookie(self):
+        # клиент с Basic auth cookie не хранит: закрепление - по пользователю
+        client = self.app.test_client(use_cookies=False)
+        headers = {'Authorization': 'Basic ' + b64encode(b"primary:primary").decode('utf-8')}
+        res = client.post('/notes', headers=headers, json={"text": 'Just written', "private": True})
+        self.assertEqual(res.status_code, 201)
+        res = client.get('/notes', headers=headers)
+        self.assertEqual([note["text"] for note in json.loads(res.data)["items"]], ['Just written'])
+
+    def test_pin_from_other_worker(self):
+        headers = {'Authorization': 'Basic ' + b64encode(b"primary:primary").decode('utf-8')}
+        client = self.app.test_client(use_cookies=False)
+        # запись пользователя в другом воркере: заметка и отметка только в основной базе
+        with self.app.app_context():
+            author_id = UserModel.query.filter_by(username='primary').one().id
+            NoteModel(author_id=author_id, text='Other worker', private=True).save()
+        self.assertEqual(json.loads(client.get('/notes', headers=headers).data)["items"], [])
+        with self.app.app_context():
+            ResourceVersionModel.bump(pin_key(author_id))
+            db.session.commit()
+        refresh_pins(self.app)
+        res = client.get('/notes', headers=headers)
+        self.assertEqual([note["text"] for note in json.loads(res.data)["items"]], ['Other worker'])
+
+    def test_replica_read_does_not_query_pins(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            # запросы фонового потока реплик не в счет
+            if threading.current_thread() is threading.main_thread():
+                statements.append(statement)
+
+        self.usernames()  # первое чтение в процессе запускает поток реплик
+        with self.app.app_context():
+            engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            res = self.client.get('/notes', headers={
+                'Authorization': 'Basic ' + b64encode(b"primary:primary").decode('utf-8')})
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse([statement for statement in statements if 'resource_version' in statement])
+
+    def test_forged_pin_cookie(self):
+        self.client.set_cookie('localhost', 'primary_until', '9999999999')
+        self.assertEqual(self.usernames(), ['replica'])
+
+    def test_shared_caches_filled_from_primary(self):
+        tag_cache.clear()
+        TagModel(name='primary-tag').save()
+        res = self.client.get('/tags')
+        self.assertEqual([tag["name"] for tag in json.loads(res.data)], ['primary-tag'])
+        res = self.client.get('/notes?tag=primary-tag',
+                              headers={'Authorization': 'Basic ' + b64encode(b"primary:primary").decode('utf-8')})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(tag_cache.get_ids(['primary-tag'], lambda names: []), {'primary-tag': 1})
+
+    def test_unavailable_replica_falls_back_to_primary(self):
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica_0': 'sqlite:////nonexistent/replica.db'}
+        check_replicas(self.app)
+        self.assertEqual(self.usernames(), ['primary'])
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            for bind in self.app.config['SQLALCHEMY_BINDS']:
+                db.get_engine(bind=bind).dispose()
+            self.app.config['SQLALCHEMY_BINDS'] = {}
+            db.drop_all()
+        self.directory.cleanup()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Минимальный SMTP сервер для тестов: принимает любые письма и складывает их в server.messages
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                self.server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class TestMail(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI,
+            'MAIL_NOTIFICATIONS': True,
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+        self.server.daemon_threads = True
+        self.server.messages = []
+        self.server.connections = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.state = self.app.extensions['mail']
+        self.saved_state = dict(vars(self.state))
+        self.state.server, self.state.port = self.server.server_address
+        self.state.use_ssl = self.state.use_tls = False
+        self.state.username = self.state.password = None
+        self.state.suppress = False
+
+        UserModel(username='admin', password='admin').save()
+        self.headers = {'Authorization': 'Basic ' + b64encode(b"admin:admin").decode('utf-8')}
+
+    def test_public_notes_notify_over_one_connection(self):
+        for number in range(3):
+            res = self.client.post('/notes', headers=self.headers,
+                                   json={"text": f'Public note {number}', "private": False})
+            self.assertEqual(res.status_code, 201)
+        res = self.client.post('/notes', headers=self.headers, json={"text": 'Private note'})
+        self.client.put(f'/notes/{json.loads(res.data)["id"]}', headers=self.headers, json={"private": False})
+        mail_dispatcher.join()
+        self.assertEqual(len(self.server.messages), 4)
+        self.assertIn(b'Private note', self.server.messages[3])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_smtp_failure_does_not_block_request(self):
+        # сервер закрыт: соединиться не удастся, письмо уйдет в повторы и будет отброшено
+        self.server.shutdown()
+        self.server.server_close()
+        mail_dispatcher.backoff = 0.01
+        failed = mail_dispatcher.stats()['failed']
+        started = time.monotonic()
+        res = self.client.post('/notes', headers=self.headers, json={"text": 'Public note', "private": False})
+        self.assertEqual(res.status_code, 201)
+        self.assertLess(time.monotonic() - started, 1)
+        mail_dispatcher.join()
+        self.assertEqual(mail_dispatcher.stats()['failed'], failed + 1)
+
+    def test_bad_message_does_not_stop_worker(self):
+        failed = mail_dispatcher.stats()['failed']
+        with self.app.app_context():
+            # перевод строки в теме - BadHeaderError из flask_mail, а не ошибка SMTP
+            mail_dispatcher.send(Message('bad\nsubject', sender='a@b.c', recipients=['a@b.c'], body='bad'))
+            mail_dispatcher.send(Message('good', sender='a@b.c', recipients=['a@b.c'], body='good'))
+        mail_dispatcher.join()
+        self.assertEqual(mail_dispatcher.stats()['failed'], failed + 1)
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(mail_dispatcher.stats()['workers'], Config.MAIL_WORKERS)
+
+    def test_stop_with_full_queue(self):
+        dispatcher = MailDispatcher(mail, workers=1, queue_size=1)
+        dispatcher._queue.put('stuck')
+        # поток, который очередь уже не разбирает
+        worker = threading.Thread(target=time.sleep, args=(0.5,), daemon=True)
+        worker.start()
+        dispatcher._threads, dispatcher._pid = [worker], os.getpid()
+        started = time.monotonic()
+        dispatcher.stop(timeout=0.1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_stop_during_batch_with_full_queue(self):
+        dispatcher = MailDispatcher(mail, workers=1, queue_size=2)
+        dispatcher._app = self.app
+        dispatcher._queue.put(Message('last', sender='a@b.c', recipients=['a@b.c'], body='last'))
+        dispatcher._queue.put(_STOP)
+        get_nowait = dispatcher._queue.get_nowait
+
+        def racing_get_nowait():
+            # send() из запроса успевает занять освободившееся место
+            message = get_nowait()
+            dispatcher._queue.put_nowait(Message('late', sender='a@b.c', recipients=['a@b.c'], body='late'))
+            dispatcher._queue.put_nowait(Message('late', sender='a@b.c', recipients=['a@b.c'], body='late'))
+            return message
+
+        with mock.patch.object(dispatcher._queue, 'get_nowait', racing_get_nowait):
+            worker = threading.Thread(target=dispatcher._work, daemon=True)
+            worker.start()
+            worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_full_queue_drops_messages(self):
+        dispatcher = MailDispatcher(mail, workers=0, queue_size=1)
+        with self.app.app_context():
+            self.assertTrue(dispatcher.send(Message('first', sender='a@b.c', recipients=['a@b.c'])))
+            self.assertFalse(dispatcher.send(Message('second', sender='a@b.c', recipients=['a@b.c'])))
+        self.assertEqual(dispatcher.stats()['dropped'], 1)
+
+    def tearDown(self):
+        mail_dispatcher.stop()
+        mail_dispatcher.backoff = Config.MAIL_RETRY_BACKOFF
+        vars(self.state).update(self.saved_state)
+        self.app.config['MAIL_NOTIFICATIONS'] = Config.MAIL_NOTIFICATIONS
+        self.server.shutdown()
+        self.server.server_close()
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class TestUploads(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+        self.directory = tempfile.TemporaryDirectory()
+        self.patches = [
+            mock.patch.dict(self.app.config, {'UPLOAD_FOLDER': os.path.join(self.directory.name, 'upload'),
+                                              'UPLOAD_PARTIAL_FOLDER': os.path.join(self.directory.name, 'partial'),
+                                              'UPLOAD_MAX_CHUNK': 4}),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.upload_folder = self.app.config['UPLOAD_FOLDER']
+        os.makedirs(self.upload_folder)
+
+    def start(self, data, **kwargs):
+        res = self.client.post('/upload/sessions', json=dict({"filename": '../photo.png', "size": len(data)}, **kwargs))
+        self.assertEqual(res.status_code, 201)
+        return json.loads(res.data)["id"]
+
+    def put_chunk(self, session_id, data, start, size):
+        return self.client.put(f'/upload/sessions/{session_id}', data=data[start:start + 4],
+                               headers={'Content-Range': f'bytes {start}-{min(start + 4, size) - 1}/{size}'})
+
+    def test_chunked_upload(self):
+        data = b'0123456789'
+        session_id = self.start(data)
+        self.assertEqual(self.put_chunk(session_id, data, 0, len(data)).status_code, 200)
+        # повтор уже принятого куска - конфликт с текущим смещением, по нему и продолжаем
+        res = self.put_chunk(session_id, data, 0, len(data))
+        self.assertEqual(res.status_code, 409)
+        offset = json.loads(self.client.get(f'/upload/sessions/{session_id}').data)["offset"]
+        self.assertEqual(offset, 4)
+        for start in range(offset, len(data), 4):
+            self.assertEqual(self.put_chunk(session_id, data, start, len(data)).status_code, 200)
+
+        res = self.client.post(f'/upload/sessions/{session_id}/complete',
+                               json={"sha256": hashlib.sha256(data).hexdigest()})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(json.loads(res.data)["url"], os.path.join(Config.UPLOAD_FOLDER_NAME, 'photo.png'))
+        with open(os.path.join(self.upload_folder, 'photo.png'), 'rb') as file:
+            self.assertEqual(file.read(), data)
+        self.assertEqual(self.client.get(f'/upload/sessions/{session_id}').status_code, 404)
+
+    def test_concurrent_complete(self):
+        """
+        Второй complete открыл часть до того, как первый ее перенес, а заблокировал после:
+        файл создает один запрос, второй получает 409, а не 500
+        """
+        data = b'0123'
+        session_id = self.start(data)
+        self.put_chunk(session_id, data, 0, len(data))
+        body = {"sha256": hashlib.sha256(data).hexdigest()}
+        lock = file_resource.lock
+        opened, completed = threading.Event(), threading.Event()
+        results = []
+
+        def racing_lock(file):
+            if not opened.is_set():
+                opened.set()
+                completed.wait(5)
+            lock(file)
+
+        def complete():
+            results.append(self.app.test_client().post(f'/upload/sessions/{session_id}/complete', json=body))
+
+        with mock.patch.object(file_resource, 'lock', racing_lock):
+            loser = threading.Thread(target=complete)
+            loser.start()
+            opened.wait(5)
+            complete()
+            completed.set()
+            loser.join()
+        self.assertEqual([res.status_code for res in results], [201, 409])
+        thumbnailer.wait(timeout=30)
+        self.assertEqual(sorted(os.listdir(self.upload_folder)), ['photo.png', 'thumbnails'])
+        with self.app.app_context():
+            self.assertEqual(FileModel.query.count(), 1)
+
+    def test_chunk_after_complete(self):
+        """
+        Кусок, пришедший, пока тот же клиент завершал загрузку, не создает заново файл части без сессии
+        """
+        data = b'0123'
+        session_id = self.start(data)
+        self.put_chunk(session_id, data, 0, len(data))
+        parse = file_resource.parse_content_range_header
+
+        def complete_first(header):
+            # complete переносит часть между чтением сессии и открытием файла куском
+            thread = threading.Thread(target=lambda: self.app.test_client().post(
+                f'/upload/sessions/{session_id}/complete', json={"sha256": hashlib.sha256(data).hexdigest()}))
+            thread.start()
+            thread.join()
+            return parse(header)
+
+        with mock.patch.object(file_resource, 'parse_content_range_header', complete_first):
+            res = self.put_chunk(session_id, data, 0, len(data))
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(os.listdir(self.app.config['UPLOAD_PARTIAL_FOLDER']), [])
+        thumbnailer.wait(timeout=30)
+
+    def test_checksum_mismatch(self):
+        data = b'abc'
+        session_id = self.start(data, sha256=hashlib.sha256(b'other').hexdigest())
+        self.put_chunk(session_id, data, 0, len(data))
+        res = self.client.post(f'/upload/sessions/{session_id}/complete', json={})
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(os.listdir(self.upload_folder), [])
+
+    def test_size_limits(self):
+        res = self.client.post('/upload/sessions', json={"filename": 'big', "size": Config.UPLOAD_MAX_SIZE + 1})
+        self.assertEqual(res.status_code, 413)
+        session_id = self.start(b'0123456789')
+        res = self.client.put(f'/upload/sessions/{session_id}', data=b'012345',
+                              headers={'Content-Range': 'bytes 0-5/10'})
+        self.assertEqual(res.status_code, 413)
+
+    def test_thumbnails(self):
+        """
+        Копии строятся в фоне; пока их нет, вместо них отдается оригинал
+        """
+        image = io.BytesIO()
+        Image.new('RGB', (600, 400), 'red').save(image, 'PNG')
+        image.seek(0)
+        res = self.client.put('/upload', data={"image": (image, 'avatar.png')}, content_type='multipart/form-data')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data["thumbnails"], {"64": data["url"], "256": data["url"]})
+
+        thumbnailer.wait(timeout=30)
+        user = UserModel(username='admin', password='admin', photo_id=data["id"])
+        user.save()
+        res = self.client.get(f'/users/{user.id}')
+        thumbnails = json.loads(res.data)["photo"]["thumbnails"]
+        self.assertEqual(thumbnails["64"], f"{Config.UPLOAD_FOLDER_NAME}/thumbnails/{data['id']}_avatar_64.webp")
+        with Image.open(os.path.join(self.upload_folder, 'thumbnails', f"{data['id']}_avatar_256.webp")) as thumbnail:
+            self.assertEqual(thumbnail.size, (256, 171))
+
+        # новые копии меняют ETag пользователя, у которого это фото
+        with self.app.app_context():
+            FileModel.query.get(data["id"]).set_derivatives({})
+        res = self.client.get(f'/users/{user.id}', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["photo"]["thumbnails"]["64"], data["url"])
+
+    def test_download(self):
+        res = self.client.put('/upload', data={"image": (io.BytesIO(b'0123456789'), 'notes.txt')},
+                              content_type='multipart/form-data')
+        download = json.loads(res.data)["download"]
+        self.assertTrue(download.startswith('/uploads/notes.txt?v='))
+        res = self.client.get(download)
+        self.assertEqual(res.data, b'0123456789')
+        self.assertIn('immutable', res.headers['Cache-Control'])
+        res = self.client.get(download, headers={'Range': 'bytes=2-5'})
+        self.assertEqual((res.status_code, res.data), (206, b'2345'))
+        # без версии (или со старой) - только с проверкой ETag
+        res = self.client.get('/uploads/notes.txt', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(self.client.get('/uploads/../test.db').status_code, 404)
+
+    def test_download_offload(self):
+        with open(os.path.join(self.upload_folder, 'notes.txt'), 'wb') as file:
+            file.write(b'0123456789')
+        self.app.config['UPLOAD_SENDFILE'] = 'x-accel'
+        try:
+            res = self.client.get('/uploads/notes.txt', headers={'Range': 'bytes=2-5'})
+            # Range и само тело - забота nginx
+            self.assertEqual((res.status_code, res.data), (200, b''))
+            self.assertEqual(res.headers['X-Accel-Redirect'], Config.UPLOAD_ACCEL_PREFIX + 'notes.txt')
+            self.assertNotIn('X-Sendfile', res.headers)
+            res = self.client.get('/uploads/notes.txt', headers={'If-None-Match': res.headers['ETag']})
+            self.assertEqual(res.status_code, 304)
+            self.assertNotIn('X-Accel-Redirect', res.headers)
+
+            self.app.config['UPLOAD_SENDFILE'] = 'x-sendfile'
+            res = self.client.get('/uploads/notes.txt')
+            self.assertEqual(res.headers['X-Sendfile'], os.path.join(self.upload_folder, 'notes.txt'))
+        finally:
+            self.app.config['UPLOAD_SENDFILE'] = None
+
+    def tearDown(self):
+        thumbnailer.wait(timeout=30)
+        for patch in self.patches:
+            patch.stop()
+        self.directory.cleanup()
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+        registry.clear()
+        UserModel(username='admin', password='admin').save()
+
+    def test_metrics(self):
+        self.client.get('/users/1')
+        self.client.get('/users/1')
+        self.client.get('/users/100')
+        text = self.client.get('/metrics').data.decode()
+        self.assertIn('http_requests_total{resource="UserResource",method="GET",status="200"} 2', text)
+        self.assertIn('http_requests_total{resource="UserResource",method="GET",status="404"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{resource="UserResource",method="GET",le="+Inf"} 3', text)
+        self.assertIn('http_request_duration_seconds_count{resource="UserResource",method="GET"} 3', text)
+        sql = [line for line in text.splitlines() if line.startswith('sql_statements_total{resource="UserResource"')]
+        self.assertGreaterEqual(int(sql[0].split()[-1]), 3)
+
+    def test_workers_aggregated(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config['METRICS_DIR'] = directory
+            try:
+                # снимок другого воркера
+                other = Registry(Config.METRICS_BUCKETS)
+                other.observe('UserResource', 'GET', 200, 0.02, 2, 0.001)
+                with open(os.path.join(directory, '1.json'), 'w') as file:
+                    json.dump(other.snapshot(), file)
+                self.client.get('/users/1')
+                text = self.client.get('/metrics').data.decode()
+            finally:
+                self.app.config['METRICS_DIR'] = None
+        self.assertIn('http_requests_total{resource="UserResource",method="GET",status="200"} 2', text)
+        self.assertIn('http_request_duration_seconds_bucket{resource="UserResource",method="GET",le="0.025"} 2', text)
+
+    def test_dead_worker_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for pid in (1, 2):
+                worker = Registry(Config.METRICS_BUCKETS)
+                worker.observe('UserResource', 'GET', 200, 0.02, 2, 0.001)
+                with open(os.path.join(directory, f'{pid}.json'), 'w') as file:
+                    json.dump(worker.snapshot(), file)
+            # оба воркера завершились: их снимки - в общем итоге, новый воркер с тем же pid начнет с чистого
+            mark_process_dead(directory, 1)
+            mark_process_dead(directory, 2)
+            self.assertEqual(sorted(os.listdir(directory)), ['dead.json'])
+            self.app.config['METRICS_DIR'] = directory
+            try:
+                self.client.get('/users/1')
+                text = self.client.get('/metrics').data.decode()
+            finally:
+                self.app.config['METRICS_DIR'] = None
+        self.assertIn('http_requests_total{resource="UserResource",method="GET",status="200"} 3', text)
+
+    def test_label_escaping(self):
+        registry.observe('UserResource', 'G"E\\T\n', 200, 0.02, 0, 0.0)
+        text = self.client.get('/metrics').data.decode()
+        self.assertIn('http_requests_total{resource="UserResource",method="G\\"E\\\\T\\n",status="200"} 1', text)
+
+    def test_token(self):
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        try:
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            res = self.client.get('/metrics', headers={'Authorization': 'Bearer other'})
+            self.assertEqual(res.status_code, 401)
+            res = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(res.status_code, 200)
+        finally:
+            self.app.config['METRICS_TOKEN'] = None
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class TestSeed(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        self.client = self.app.test_client()
+        self.runner = self.app.test_cli_runner()
+        with self.app.app_context():
+            db.create_all()
+
+    def seed(self, *args):
+        return self.runner.invoke(args=['seed', '--users', '5', '--notes', '300', '--tags', '10', '--batch', '100',
+                                        *args])
+
+    def notes(self):
+        with self.app.app_context():
+            return db.session.query(NoteModel.id, NoteModel.author_id, NoteModel.text, NoteModel.private,
+                                    NoteModel.archive).order_by(NoteModel.id).all()
+
+    def test_seed(self):
+        res = self.seed('--seed', '7', '--archived', '0')
+        self.assertEqual(res.exit_code, 0, res.output)
+        notes = self.notes()
+        self.assertEqual(len(notes), 300)
+        self.assertFalse(any(note.archive for note in notes))
+        # первый автор по Ципфу самый частый
+        authors = [note.author_id for note in notes]
+        self.assertEqual(max(set(authors), key=authors.count), 1)
+
+        # непустая база без --drop не перезаписывается
+        self.assertNotEqual(self.seed().exit_code, 0)
+        self.assertEqual(self.seed('--seed', '7', '--archived', '0', '--drop').exit_code, 0)
+        self.assertEqual(self.notes(), notes)
+
+        headers = {'Authorization': 'Basic ' + b64encode(b"user1:password").decode('utf-8')}
+        res = self.client.get('/notes/like?text=lorem0', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(json.loads(res.data)["items"])
+        res = self.client.get('/users/like?username=user1')
+        self.assertEqual(json.loads(res.data)[0]["username"], 'user1')
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class TestAsgi(TestCase):
+    """
+    ASGI режим без сервера: scope/receive/send подаются напрямую в цикле событий
+    """
+
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        with self.app.app_context():
+            db.create_all()
+        UserModel(username='admin', password='admin').save()
+        self.headers = [(b'authorization', b'Basic ' + b64encode(b"admin:admin"))]
+        # маленький буфер: и тело запроса, и ответ идут несколькими частями
+        self.application = AsgiApp(self.app, threads=2, buffer_size=16, max_body=1024)
+
+    def request(self, method, path, query=b'', headers=(), chunks=(b'',), auth=True):
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': number < len(chunks) - 1}
+                    for number, chunk in enumerate(chunks)]
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(0)  # медленный клиент: части тела приходят в разных итерациях цикла
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+                 'query_string': query, 'root_path': '', 'headers': [*(self.headers if auth else []), *headers],
+                 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)}
+        asyncio.run(self.application(scope, receive, send))
+        start, *bodies = sent
+        self.assertFalse(bodies[-1].get('more_body', False))
+        return start['status'], dict(start['headers']), b''.join(body['body'] for body in bodies)
+
+    def test_same_api(self):
+        body = json.dumps({"text": 'Async note', "private": False}).encode()
+        status, headers, data = self.request('POST', '/notes', headers=[(b'content-type', b'application/json')],
+                                             chunks=[body[:10], body[10:]])
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(data)["text"], 'Async note')
+        status, headers, data = self.request('GET', '/notes', query=b'limit=5')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(data), json.loads(self.app.test_client().get(
+            '/notes?limit=5', headers={'Authorization': 'Basic ' + b64encode(b"admin:admin").decode()}).data))
+        self.assertEqual(self.request('GET', '/notes', auth=False)[0], 401)
+        self.assertEqual(self.request('POST', '/notes', chunks=[b'x' * 1000, b'x' * 100])[0], 413)
+
+    def test_stream_finished_before_send(self):
+        """
+        Потоковый ответ больше буфера генерируется до конца (и курсор закрывается) до первой отправки:
+        поток пула не ждет клиента
+        """
+        events = []
+
+        def stream():
+            try:
+                yield from (b'0123456789' for _ in range(10))
+            finally:
+                events.append('closed')
+
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return stream()
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            events.append(message)
+
+        application = AsgiApp(wsgi_app, threads=1, buffer_size=16)
+        asyncio.run(application({'type': 'http', 'method': 'GET', 'path': '/export'}, receive, send))
+        application.executor.shutdown()
+        closed, start, *bodies = events
+        self.assertEqual((closed, start['status']), ('closed', 200))
+        self.assertEqual(b''.join(body['body'] for body in bodies), b'0123456789' * 10)
+        self.assertEqual([body['more_body'] for body in bodies], [True] * (len(bodies) - 1) + [False])
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(self.app.config, {'UPLOAD_FOLDER': directory}):
+            with open(os.path.join(directory, 'notes.txt'), 'wb') as file:
+                file.write(b'0123456789' * 5)
+            status, headers, data = self.request('GET', '/uploads/notes.txt')
+            self.assertEqual((status, data), (200, b'0123456789' * 5))
+            self.assertEqual(headers[b'content-length'], b'50')
+            status, headers, data = self.request('GET', '/uploads/notes.txt', headers=[(b'range', b'bytes=2-5')])
+            self.assertEqual((status, data), (206, b'2345'))
+
+    def tearDown(self):
+        self.application.executor.shutdown()
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class TestCounters(TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+        tag_index.clear()
+        tag_cache.clear()
+        self.user = UserModel(username='admin', password='admin')
+        self.user.save()
+        TagModel(name='first').save()
+        TagModel(name='second').save()
+        self.headers = {'Authorization': 'Basic ' + b64encode(b"admin:admin").decode('utf-8')}
+
+    def counters(self):
+        """
+        (пользователь, {тег: счетчики}) - (всего, публичных, в архиве)
+        """
+        with self.app.app_context():
+            user = db.session.query(UserModel.note_count, UserModel.public_note_count,
+                                    UserModel.archived_note_count).filter_by(id=self.user.id).one()
+            tags = db.session.query(TagModel.name, TagModel.note_count, TagModel.public_note_count,
+                                    TagModel.archived_note_count)
+            return tuple(user), {name: tuple(counts) for name, *counts in tags}
+
+    def request(self, method, url, **kwargs):
+        # в отдельном потоке: у него своя сессия, как у параллельного запроса в другом воркере
+        client = self.app.test_client()
+        thread = threading.Thread(target=getattr(client, method), args=(url,),
+                                  kwargs=dict(headers=self.headers, **kwargs))
+        thread.start()
+        thread.join()
+
+    def test_concurrent_state_changes(self):
+        """
+        Заметку прочитали до того, как ее изменил параллельный запрос: его переход не учитывается второй раз
+        """
+        self.client.post('/notes', headers=self.headers, json={"text": 'Raced', "private": False})
+        self.client.put('/notes/1/tags?tags=1', headers=self.headers)
+        with self.app.app_context():
+            note = NoteModel.query.get(1)
+            self.request('delete', '/notes/1')
+            note.archivated()
+        self.assertEqual(self.counters(), ((1, 0, 1), {'first': (1, 0, 1), 'second': (0, 0, 0)}))
+
+        self.client.put('/notes/1/restore', headers=self.headers)
+        with self.app.app_context():
+            note = NoteModel.query.get(1)
+            self.request('delete', '/notes/1')
+            # смена private не возвращает заметку из архива
+            note.private = True
+            note.save()
+        self.assertEqual(self.counters(), ((1, 0, 1), {'first': (1, 0, 1), 'second': (0, 0, 0)}))
+        with self.app.app_context():
+            self.assertEqual(db.session.query(NoteModel.private, NoteModel.archive).filter_by(id=1).one(),
+                             (True, True))
+
+    def test_counters(self):
+        for private in (True, False, False):
+            self.client.post('/notes', headers=self.headers, json={"text": 'Counted', "private": private})
+        self.assertEqual(self.counters(), ((3, 2, 0), {'first': (0, 0, 0), 'second': (0, 0, 0)}))
+
+        self.client.put('/notes/1/tags?tags=1&tags=2', headers=self.headers)
+        # уже привязанный тег не считается второй раз
+        res = self.client.post('/notes/tags/bulk', headers=self.headers, json={"note_ids": [1, 2, 3], "add": [1]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.counters()[1], {'first': (3, 2, 0), 'second': (1, 0, 0)})
+
+        self.client.delete('/notes/2', headers=self.headers)
+        self.client.put('/notes/1', headers=self.headers, json={"private": False})
+        self.assertEqual(self.counters(), ((3, 2, 1), {'first': (3, 2, 1), 'second': (1, 1, 0)}))
+        self.client.put('/notes/2/restore', headers=self.headers)
+        self.client.delete('/notes/1/tags?tags=1&tags=2', headers=self.headers)
+        res = self.client.post('/notes/import', headers=self.headers, content_type='application/x-ndjson',
+                               data=json.dumps({"text": 'Imported', "private": False, "tags": ['second']}) + '\n')
+        self.assertEqual(json.loads(res.data)["status"], 'ok')
+        self.assertEqual(self.counters(), ((4, 4, 0), {'first': (2, 2, 0), 'second': (1, 1, 0)}))
+
+        # счетчики сходятся с пересчетом, а испорченные пересчет исправляет
+        runner = self.app.test_cli_runner()
+        self.assertIn('user_model: 0 fixed, tag: 0 fixed', runner.invoke(args=['repair-counters']).output)
+        with self.app.app_context():
+            TagModel.query.filter_by(name='second').update({'note_count': 10})
+            db.session.commit()
+        self.assertIn('tag: 1 fixed', runner.invoke(args=['repair-counters']).output)
+        self.assertEqual(self.counters()[1]['second'], (1, 1, 0))
+
+    def test_popular_tags(self):
+        for _ in range(2):
+            self.client.post('/notes', headers=self.headers, json={"text": 'Popular', "private": False})
+        self.client.put('/notes/1/tags?tags=1&tags=2', headers=self.headers)
+        self.client.put('/notes/2/tags?tags=2', headers=self.headers)
+        res = self.client.get('/tags?sort=popular&limit=1')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data), [{"id": 2, "name": 'second', "note_count": 2,
+                                                 "public_note_count": 2, "archived_note_count": 0}])
+        self.assertEqual(self.client.get('/tags?sort=name').status_code, 422)
+        # каталог - по-прежнему имена из кэша, с ETag
+        res = self.client.get('/tags')
+        self.assertEqual([tag["name"] for tag in json.loads(res.data)], ['first', 'second'])
+        self.assertIn('ETag', res.headers)
+
+    def test_user_counters_etag(self):
+        res = self.client.get(f'/users/{self.user.id}')
+        self.assertEqual(json.loads(res.data)["note_count"], 0)
+        self.client.post('/notes', headers=self.headers, json={"text": 'Counted'})
+        res = self.client.get(f'/users/{self.user.id}', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)["note_count"], 1)
+        # в заметке автор и теги без счетчиков
+        data = json.loads(self.client.get('/notes/1', headers=self.headers).data)
+        self.assertNotIn('note_count', data["author"])
+        # и в экспорте - тот же автор, что в GET /notes/<id>
+        exported = json.loads(self.client.get('/notes/export?format=json', headers=self.headers).data)
+        self.assertEqual(exported[0]["author"], data["author"])
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class TestQueryPlans(TestCase):
+    """
+    Все SELECT, которые выполняют /notes* и популярные теги, проходят по индексам, без полного просмотра
+    """
+
+    def setUp(self):
+        self.app = app
+        self.app.config.update({
+            'SQLALCHEMY_DATABASE_URI': Config.TEST_DATABASE_URI
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+        tag_index.clear()
+        tag_cache.clear()
+        self.user = UserModel(username='admin', password='admin')
+        self.user.save()
+        other = UserModel(username='other', password='other')
+        other.save()
+        TagModel(name='first').save()
+        TagModel(name='second').save()
+        for author, private, archive in [(self.user, True, False), (other, False, False),
+                                         (other, True, False), (self.user, False, True)]:
+            NoteModel(author_id=author.id, text='Plan note', private=private, archive=archive).save()
+        self.headers = {'Authorization': 'Basic ' + b64encode(b"admin:admin").decode('utf-8')}
+        self.client.put('/notes/1/tags?tags=1', headers=self.headers)
+
+    def statements(self, method, url, **kwargs):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            res = self.client.open(url, method=method, headers=self.headers, **kwargs)
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+        self.assertLess(res.status_code, 400, f'{method} {url}: {res.data}')
+        return engine, statements
+
+    def full_scans(self, engine, statement, parameters):
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if engine.dialect.name == 'postgresql':
+                # без seq scan планировщик берет индекс, если он вообще подходит
+                cursor.execute('SET enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                plan = [row[0] for row in cursor.fetchall()]
+                return [line for line in plan if re.search(r'Seq Scan on (note_model|tags?)\b', line)]
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            return [line for line in plan if re.match(r'SCAN (note_model|tags?)(_\d+)?\b', line) and 'INDEX' not in line]
+        finally:
+            connection.close()
+
+    def test_notes_endpoints_use_indexes(self):
+        cursor = json.loads(self.client.get('/notes?limit=1', headers=self.headers).data)["next"]
+        requests = [
+            ('GET', '/notes'),
+            ('GET', cursor),
+            ('GET', '/notes?private=true'),
+            ('GET', '/notes?private=false'),
+            ('GET', '/notes?username=other'),
+            ('GET', '/notes?tag=first'),
+            ('GET', '/notes/2'),
+            ('GET', '/notes/like?text=plan'),
+            ('GET', '/notes/tags?all_of=1'),
+            ('GET', '/notes/tags?none_of=1'),
+            ('GET', '/notes/export'),
+            ('PUT', '/notes/1/tags?tags=2'),
+            ('DELETE', '/notes/1/tags?tags=2'),
+            ('PUT', '/notes/1'),
+            ('POST', '/notes/tags/bulk'),
+            ('PUT', '/notes/4/restore'),
+            ('DELETE', '/notes/1'),
+            ('GET', '/tags?sort=popular&limit=5'),
+        ]
+        bodies = {'/notes/1': {"text": 'Edited'}, '/notes/tags/bulk': {"note_ids": [1], "add": [2]}}
+        for method, url in requests:
+            engine, statements = self.statements(method, url, json=bodies.get(url.split('?')[0]))
+            self.assertTrue(statements)
+            for statement, parameters in statements:
+                if 'WHERE' not in statement:
+                    # намеренное чтение всей таблицы: загрузка индекса тегов
+                    continue
+                self.assertEqual(self.full_scans(engine, statement, parameters), [], f'{method} {url}: {statement}')
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()